@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+'''
+    Benchmark of JSON codecs on Stratum and getwork traffic.
+
+    Encodes and decodes realistic messages (mining.notify with long merkle
+    branches, mining.submit and its response, getwork response) by every
+    installed JSON library and reports microseconds per message. Library
+    selected by mining_libs.jsoncodec is marked by '*', libraries failing
+    jsoncodec.test() (so never selected) by '!'.
+
+    Usage: python benchmarks/codec.py [--messages N] [--branches N]
+'''
+
+import argparse
+import binascii
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mining_libs import jsoncodec
+
+def randhex(n):
+    return binascii.hexlify(os.urandom(n))
+
+def build_notify(branches):
+    return {'id': None, 'method': 'mining.notify',
+            'params': ['1f3a', randhex(32), randhex(59), randhex(120), [ randhex(32) for _ in range(branches) ],
+                       '20000000', '1a0abbcc', '504e86ed', True]}
+
+def build_messages(branches):
+    submit = {'id': 42, 'method': 'mining.submit', 'params': ['worker.1', '1f3a', randhex(4), '504e86ed', randhex(4)]}
+    submit_response = {'id': 42, 'result': True, 'error': None}
+    getwork = {'id': 1, 'error': None, 'result': {'data': randhex(128), 'midstate': randhex(32),
+               'hash1': '00' * 32 + '000000800000000000000000000000000000000000000000000000000000010000',
+               'target': 'ffff'.rjust(64, '0')}}
+    return [('notify/%d branches' % branches, build_notify(branches)),
+            ('notify/%d branches' % (branches * 2), build_notify(branches * 2)),
+            ('submit', submit), ('submit response', submit_response), ('getwork', getwork)]
+
+def get_codecs():
+    codecs = [('json', json.dumps, json.loads)]
+    for use in (jsoncodec._use_simplejson, jsoncodec._use_ujson):
+        try:
+            codecs.append(use())
+        except (ImportError, AttributeError):
+            pass
+    return codecs
+
+def measure(func, values):
+    start = time.time()
+    for value in values:
+        func(value)
+    return (time.time() - start) / len(values) * 1e6
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of JSON codecs')
+    parser.add_argument('--messages', dest='messages', type=int, default=20000, help='Messages encoded and decoded by every codec')
+    parser.add_argument('--branches', dest='branches', type=int, default=12, help='Length of merkle branch in mining.notify')
+    args = parser.parse_args()
+
+    print "selected codec: %s" % jsoncodec.NAME
+    print "%-12s %-20s %8s %10s %10s" % ('codec', 'message', 'bytes', 'dumps us', 'loads us')
+    for (name, dumps, loads) in get_codecs():
+        usable = jsoncodec.test(dumps, loads)
+        for (message_name, message) in build_messages(args.branches):
+            encoded = json.dumps(message)
+            print "%-12s %-20s %8d %10.2f %10.2f" % (name + ('*' if name == jsoncodec.NAME else '') + ('' if usable else '!'),
+                        message_name, len(encoded), measure(dumps, [message] * args.messages),
+                        measure(loads, [encoded] * args.messages))
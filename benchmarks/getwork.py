@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+    Benchmark of getwork response serialization.
+
+    Generates getworks of a random job for every target mode and with
+    or without midstate, then serializes the same works by json.dumps()
+    (Root.json_response) and by the response templates (Root.getwork_response).
+    Checks both give the same JSON and reports serialization cost per getwork.
+
+    Usage: python benchmarks/getwork.py [--getworks N]
+'''
+
+import argparse
+import binascii
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mining_libs import getwork_listener
+from mining_libs import jobs
+
+# (name, JobRegistry options)
+TARGET_MODES = [('diff1', {}),
+                ('real', {'real_target': True}),
+                ('old', {'use_old_target': True})]
+
+def build_job():
+    def randhex(n):
+        return binascii.hexlify(os.urandom(n))
+
+    return jobs.Job.build_from_broadcast('1', randhex(32), randhex(50), randhex(50),
+                [ randhex(32) for _ in range(12) ], '00000002', '1a0abbcc', '504e86ed')
+
+class ReplayRegistry(object):
+    '''Serves pregenerated getworks, so only serialization is measured'''
+    def __init__(self, works):
+        self.works = iter(works)
+
+    def getwork(self, no_midstate=True):
+        return next(self.works)
+
+def generate(options, no_midstate, n):
+    registry = jobs.JobRegistry(None, cmd=None, no_midstate=False, real_target=options.get('real_target', False),
+                                use_old_target=options.get('use_old_target', False))
+    registry.set_extranonce('0a0b0c0d', 4)
+    registry.set_difficulty(8)
+    registry.add_template(build_job(), True)
+    return [ registry.getwork(no_midstate=no_midstate) for _ in range(n) ]
+
+def measure(works):
+    '''Returns (responses, seconds) of json.dumps and of templates'''
+    root = getwork_listener.Root(ReplayRegistry(works), None, None, 0)
+
+    start = time.time()
+    dumped = [ root.json_response(i, work) for (i, work) in enumerate(works) ]
+    dumps_time = time.time() - start
+
+    start = time.time()
+    templated = [ root.getwork_response(i, True) for i in range(len(works)) ]
+    template_time = time.time() - start
+    return (dumped, dumps_time, templated, template_time)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of getwork response serialization')
+    parser.add_argument('--getworks', dest='getworks', type=int, default=50000, help='Number of serialized getworks')
+    args = parser.parse_args()
+
+    print "%-8s %-9s %14s %14s %8s" % ('target', 'midstate', 'json.dumps us', 'template us', 'speedup')
+    for (name, options) in TARGET_MODES:
+        for no_midstate in (False, True):
+            works = generate(options, no_midstate, args.getworks)
+            (dumped, dumps_time, templated, template_time) = measure(works)
+
+            for i in range(0, len(works), max(1, len(works) / 100)):
+                if json.loads(dumped[i]) != json.loads(templated[i]):
+                    print "%-8s templated response differs: %s" % (name, templated[i])
+                    sys.exit(1)
+
+            n = float(len(works))
+            print "%-8s %-9s %14.2f %14.2f %7.1fx" % (name, 'no' if no_midstate else 'yes', dumps_time / n * 1e6,
+                                                   template_time / n * 1e6, dumps_time / template_time)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+'''
+    Memory benchmark of the proxy's hot objects.
+
+    Measures resident memory needed by single connected Stratum miner
+    (connection, session, subscriptions, extranonce tail and worker record)
+    and by single job retained in the job store.
+
+    Usage: python benchmarks/memory.py [--miners N] [--jobs N]
+'''
+
+import argparse
+import binascii
+import gc
+import os
+import sys
+import weakref
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.test.proto_helpers import StringTransport
+
+from stratum.services import ServiceEventHandler
+
+from mining_libs import downstream
+from mining_libs import jobs
+from mining_libs import stratum_listener
+from mining_libs import upstream
+from mining_libs import worker_registry
+
+class NullTransport(StringTransport):
+    '''Transport which forgets all written data'''
+    def write(self, data):
+        pass
+
+class FakeUpstream(object):
+    '''Just enough of upstream factory to make mining.subscribe work'''
+    class client(object):
+        connected = True
+
+def get_rss():
+    '''Current resident set size in bytes'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except IOError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def build_job(job_id, branches=12, coinbase_size=100):
+    def randhex(n):
+        return binascii.hexlify(os.urandom(n))
+
+    return jobs.Job.build_from_broadcast(job_id, randhex(32), randhex(coinbase_size / 2), randhex(coinbase_size / 2),
+                [ randhex(32) for _ in range(branches) ], '00000002', '1a0abbcc', '504e86ed')
+
+def connect_miner(factory, workers, i):
+    conn = factory.buildProtocol(IPv4Address('TCP', '127.0.0.1', i))
+    conn.makeConnection(NullTransport())
+    conn.on_finish = defer.Deferred()
+
+    service = stratum_listener.StratumProxyService()
+    service.connection_ref = weakref.ref(conn)
+    service.subscribe()
+    conn.on_finish.callback(True)
+
+    workers._on_authorized(True, ('worker%d' % i, 'x'))
+    return conn
+
+def measure_miners(n):
+    workers = worker_registry.WorkerRegistry(None)
+    pool = upstream.UpstreamPool()
+    session = pool.add(FakeUpstream, workers, jobs.JobStore())
+    session.set_extranonce('0a0b0c0d', 4)
+    stratum_listener.StratumProxyService._set_upstream(pool)
+    stratum_listener.MiningSubscription.on_template(session, build_job('0'), True)
+
+    factory = downstream.AdmissionControlFactory(debug=False, event_handler=ServiceEventHandler)
+
+    gc.collect()
+    start = get_rss()
+    conns = [ connect_miner(factory, workers, i) for i in xrange(n) ]
+    factory.coalescer.flush() # Reactor isn't running, output would stay buffered
+    gc.collect()
+    return (get_rss() - start) / float(len(conns))
+
+def measure_jobs(n):
+    store = jobs.JobStore(max_jobs=n)
+
+    gc.collect()
+    start = get_rss()
+    for i in xrange(n):
+        store.add(build_job('%x' % i), False)
+    gc.collect()
+    return (get_rss() - start) / float(len(store.jobs))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory benchmark of the proxy objects')
+    parser.add_argument('--miners', dest='miners', type=int, default=10000, help='Number of simulated Stratum miners')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1000, help='Number of retained jobs')
+    args = parser.parse_args()
+
+    # Jobs go first, memory released by miners would be reused by jobs otherwise
+    print "%d bytes per retained job (%d jobs)" % (measure_jobs(args.jobs), args.jobs)
+    print "%d bytes per connected miner (%d miners)" % (measure_miners(args.miners), args.miners)
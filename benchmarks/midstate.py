@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''
+    Benchmark of midstate implementations.
+
+    Computes midstates of the same random blocks by every available
+    implementation, checks they agree and reports midstates per second:
+
+      python        -- mining_libs.midstate.calculateMidstate, one block per call
+      openssl       -- mining_libs.midstate_openssl, one block per call
+      c             -- midstatec.midstate, one block per call
+      numpy batch   -- mining_libs.midstate_batch, vectorized over the batch
+      c batch       -- midstatec.midstate_batch, contiguous buffer
+      c batch/PATH  -- the same by every code path the CPU supports
+
+    Usage: python benchmarks/midstate.py [--blocks N] [--batch N]
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mining_libs import midstate
+from mining_libs import midstate_batch
+
+try:
+    import midstatec
+except ImportError:
+    midstatec = None
+
+def measure(func, blocks, batch):
+    '''Returns (midstates, seconds), func takes list of blocks'''
+    result = []
+    start = time.time()
+    for i in range(0, len(blocks), batch):
+        result.extend(func(blocks[i:i+batch]))
+    return (result, time.time() - start)
+
+def get_implementations(args):
+    impls = [('python', lambda blocks: [ midstate.calculateMidstate(b) for b in blocks ], args.python_blocks)]
+    if midstate_batch._openssl_midstate != None:
+        impls.append(('openssl', midstate_batch.calculateMidstatesOpenssl, args.blocks))
+    if midstatec != None:
+        impls.append(('c', lambda blocks: [ midstatec.midstate(b) for b in blocks ], args.blocks))
+    if midstate_batch.numpy != None:
+        impls.append(('numpy batch', midstate_batch.calculateMidstatesNumpy, args.blocks))
+    if midstatec != None:
+        impls.append(('c batch', midstatec.midstate_batch, args.blocks))
+        for path in midstatec.paths():
+            impls.append(('c batch/%s' % path, lambda blocks, path=path: midstatec.midstate_batch(blocks, path), args.blocks))
+    return impls
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of midstate implementations')
+    parser.add_argument('--blocks', dest='blocks', type=int, default=100000, help='Number of hashed blocks')
+    parser.add_argument('--python-blocks', dest='python_blocks', type=int, default=10000, help='Number of blocks hashed by pure-Python implementation')
+    parser.add_argument('--batch', dest='batch', type=int, default=1024, help='Blocks per call of batched implementations')
+    args = parser.parse_args()
+
+    blocks = [ os.urandom(64) for _ in range(max(args.blocks, args.python_blocks)) ]
+    reference = None
+
+    print "midstate backend of batches: %s" % midstate_batch.BACKEND
+    if midstatec != None:
+        print "midstatec code paths: %s" % ', '.join(midstatec.paths())
+    print "%-16s %10s %12s %10s" % ('implementation', 'blocks', 'midstates/s', 'us each')
+    for (name, func, count) in get_implementations(args):
+        (result, seconds) = measure(func, blocks[:count], args.batch)
+        if reference == None:
+            reference = result
+        elif result[:len(reference)] != reference[:len(result)]:
+            print "%-16s returned wrong midstates!" % name
+            continue
+        print "%-16s %10d %12.0f %10.2f" % (name, count, count / seconds, seconds / count * 1e6)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+'''
+    Replay benchmark of the proxy, runs without network access.
+
+    Starts the proxy as a subprocess connected to local fake pool and
+    drives it by simulated Stratum and getwork miners. The pool replays
+    jobs recorded by `mining_proxy.py --record FILE`, share rate of simulated
+    miners follows the recorded submits. Without recording, jobs are generated
+    from fixed random seed, so every run sees the same traffic. Pool validates
+    every share, failures are reported as rejected shares.
+
+    Reports throughput and latency percentiles of every request type
+    and resident memory and CPU time of the proxy process.
+
+    Usage: python benchmarks/replay.py [--record FILE] [--miners N] [--getwork-miners N] [--duration S]
+'''
+
+import argparse
+import base64
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, protocol, defer
+from twisted.protocols.basic import LineReceiver
+
+from mining_libs import fake_pool
+
+PROXY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mining_proxy.py')
+
+# Every share meets the target, so the proxy forwards all of them to the pool
+EASY_DIFFICULTY = 2 ** -32
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = {} # Request type -> list of latencies in seconds
+        self.errors = {}
+
+    def add(self, name, latency):
+        self.latencies.setdefault(name, []).append(latency)
+
+    def error(self, name):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, duration):
+        print "%-16s %8s %8s %8s %8s %8s %8s" % ('request', 'count', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'errors')
+        for name in sorted(set(self.latencies.keys() + self.errors.keys())):
+            values = sorted(self.latencies.get(name, []))
+            def percentile(p):
+                if not values:
+                    return float('nan')
+                return values[min(len(values) - 1, int(len(values) * p))] * 1000
+            print "%-16s %8d %8.1f %8.2f %8.2f %8.2f %8d" % (name, len(values), len(values) / duration,
+                        percentile(0.5), percentile(0.9), percentile(0.99), self.errors.get(name, 0))
+
+def load_recording(filename):
+    '''Returns upstream events and average share rate per worker'''
+    upstream = []
+    submits = 0
+    workers = set()
+    last = 0
+    with open(filename) as fp:
+        for line in fp:
+            event = json.loads(line)
+            last = event['time']
+            if event['source'] == 'upstream':
+                upstream.append((event['time'], event['method'], event['params']))
+            elif event['method'] == 'mining.submit':
+                submits += 1
+                workers.add(event['params'][0])
+
+    share_rate = submits / float(len(workers) * last) if workers and last else None
+    return (upstream, share_rate)
+
+def start_replay(pool, events, speed):
+    for (t, method, params) in events:
+        if method == 'mining.notify':
+            reactor.callLater(t / speed, pool.add_job, params)
+        # Recorded difficulty would make simulated shares invalid, so it's not replayed
+
+class StratumMiner(LineReceiver):
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.msg_id = 0
+        self.pending = {} # id -> (request type, start time)
+        self.job = None
+        self.extranonce2_size = None
+        self.request('subscribe', 'mining.subscribe', [])
+        self.request('authorize', 'mining.authorize', ['miner%d' % self.factory.index, 'x'])
+
+    def request(self, name, method, params):
+        self.msg_id += 1
+        self.pending[self.msg_id] = (name, time.time())
+        self.sendLine(json.dumps({'id': self.msg_id, 'method': method, 'params': params}))
+
+    def lineReceived(self, line):
+        if not line.strip():
+            return
+        msg = json.loads(line)
+        if msg.get('method') == 'mining.notify':
+            self.job = msg['params']
+            return
+        if msg.get('id') not in self.pending:
+            return
+
+        (name, start) = self.pending.pop(msg['id'])
+        if msg.get('error'):
+            self.factory.stats.error(name)
+        else:
+            self.factory.stats.add(name, time.time() - start)
+
+        if name == 'subscribe' and msg.get('result'):
+            self.extranonce2_size = msg['result'][2]
+            self.schedule_share()
+
+    def schedule_share(self):
+        rnd = self.factory.rnd
+        reactor.callLater(rnd.expovariate(self.factory.share_rate), self.submit)
+
+    def submit(self):
+        if not self.connected:
+            return
+        if self.job != None:
+            rnd = self.factory.rnd
+            extranonce2 = '%0*x' % (self.extranonce2_size * 2, rnd.randint(0, 256 ** self.extranonce2_size - 1))
+            self.request('submit', 'mining.submit', ['miner%d' % self.factory.index, self.job[0],
+                         extranonce2, self.job[7], '%08x' % rnd.randint(0, 2 ** 32 - 1)])
+        self.schedule_share()
+
+class StratumMinerFactory(protocol.ClientFactory):
+    protocol = StratumMiner
+
+    def __init__(self, index, stats, rnd, share_rate):
+        self.index = index
+        self.stats = stats
+        self.rnd = rnd
+        self.share_rate = share_rate
+
+    def clientConnectionFailed(self, connector, reason):
+        self.stats.error('connect')
+
+class GetworkMiner(object):
+    '''Asks for getwork periodically and submits every work back'''
+
+    def __init__(self, index, port, stats, rnd, interval):
+        from twisted.web.client import Agent, HTTPConnectionPool
+        self.url = 'http://127.0.0.1:%d/' % port
+        self.auth = 'Basic ' + base64.b64encode('getwork%d:x' % index)
+        self.agent = Agent(reactor, pool=HTTPConnectionPool(reactor))
+        self.stats = stats
+        self.rnd = rnd
+        self.interval = interval
+        self.msg_id = 0
+
+    @defer.inlineCallbacks
+    def call(self, name, params):
+        from twisted.web.client import FileBodyProducer, readBody
+        from twisted.web.http_headers import Headers
+        from StringIO import StringIO
+
+        self.msg_id += 1
+        body = FileBodyProducer(StringIO(json.dumps({'id': self.msg_id, 'method': 'getwork', 'params': params})))
+        start = time.time()
+        try:
+            response = (yield self.agent.request('POST', self.url, Headers({'Authorization': [self.auth],
+                                        'Content-Type': ['application/json']}), body))
+            result = json.loads((yield readBody(response)))
+        except Exception:
+            self.stats.error(name)
+            defer.returnValue(None)
+
+        if result.get('error'):
+            self.stats.error(name)
+        else:
+            self.stats.add(name, time.time() - start)
+        defer.returnValue(result.get('result'))
+
+    @defer.inlineCallbacks
+    def run(self):
+        work = (yield self.call('getwork', []))
+        if work != None:
+            yield self.call('getwork.submit', [work['data']])
+        reactor.callLater(self.rnd.expovariate(1.0 / self.interval), self.run)
+
+def get_free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def get_process_stats(pid):
+    '''Resident memory (kB) and CPU time (seconds) of given process'''
+    rss = 0
+    with open('/proc/%d/status' % pid) as fp:
+        for line in fp:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+    with open('/proc/%d/stat' % pid) as fp:
+        fields = fp.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    return (rss, cpu)
+
+@defer.inlineCallbacks
+def run(args, pool, events, proxy, stratum_port, getwork_port):
+    stats = Stats()
+    rnd = random.Random(args.seed)
+
+    yield pool.first_subscribe
+    if args.record:
+        start_replay(pool, events, args.speed)
+    pool.start()
+
+    # Let the proxy process the first job
+    d = defer.Deferred()
+    reactor.callLater(0.5, d.callback, True)
+    yield d
+
+    # Ramp up miners, so they don't overflow the listen queue
+    for i in range(args.miners):
+        reactor.callLater(args.ramp * i / max(args.miners, 1), reactor.connectTCP, '127.0.0.1', stratum_port,
+                          StratumMinerFactory(i, stats, rnd, args.share_rate))
+    for i in range(args.getwork_miners):
+        miner = GetworkMiner(i, getwork_port, stats, rnd, args.getwork_interval)
+        reactor.callLater(args.ramp * i / max(args.getwork_miners, 1), miner.run)
+
+    (start_rss, start_cpu) = get_process_stats(proxy.pid)
+    start = time.time()
+    peak_rss = start_rss
+    while time.time() - start < args.duration:
+        d = defer.Deferred()
+        reactor.callLater(1, d.callback, True)
+        yield d
+        peak_rss = max(peak_rss, get_process_stats(proxy.pid)[0])
+
+    (end_rss, end_cpu) = get_process_stats(proxy.pid)
+    duration = time.time() - start
+
+    stats.report(duration)
+    print
+    print "shares accepted by pool: %d (%.1f/s), rejected: %s" % (pool.accepted, pool.accepted / duration, pool.rejected or 0)
+    print "proxy memory: %d kB at start, %d kB peak, %d kB at end" % (start_rss, peak_rss, end_rss)
+    print "proxy CPU time: %.2fs (%.0f%% of one core)" % (end_cpu - start_cpu, (end_cpu - start_cpu) / duration * 100)
+    reactor.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay benchmark of the proxy')
+    parser.add_argument('--record', dest='record', type=str, help='Traffic recorded by mining_proxy.py --record')
+    parser.add_argument('--miners', dest='miners', type=int, default=1000, help='Number of simulated Stratum miners')
+    parser.add_argument('--getwork-miners', dest='getwork_miners', type=int, default=50, help='Number of simulated getwork miners')
+    parser.add_argument('--duration', dest='duration', type=float, default=30, help='Length of measurement in seconds')
+    parser.add_argument('--ramp', dest='ramp', type=float, default=2, help='Seconds for connecting all miners')
+    parser.add_argument('--speed', dest='speed', type=float, default=1, help='Replay recorded traffic faster by this factor')
+    parser.add_argument('--share-rate', dest='share_rate', type=float, help='Shares per second of single Stratum miner (default: from recording or 0.2)')
+    parser.add_argument('--getwork-interval', dest='getwork_interval', type=float, default=5, help='Average seconds between getworks of single miner')
+    parser.add_argument('--job-interval', dest='job_interval', type=float, default=30, help='Seconds between generated jobs (without recording)')
+    parser.add_argument('--block-interval', dest='block_interval', type=float, default=600, help='Seconds between generated blocks (without recording)')
+    parser.add_argument('--seed', dest='seed', type=int, default=1, help='Seed of random generator')
+    (args, extra) = parser.parse_known_args()
+    extra = [ a for a in extra if a != '--' ] # Passed to the proxy
+
+    if args.record:
+        (events, recorded_rate) = load_recording(args.record)
+        pool = fake_pool.FakePool(job_interval=0, difficulty=[EASY_DIFFICULTY], seed=args.seed)
+        if events and events[0][1] == 'mining.notify':
+            # Proxy needs a job before miners connect
+            pool.add_job(events.pop(0)[2])
+    else:
+        (events, recorded_rate) = ([], None)
+        pool = fake_pool.FakePool(job_interval=args.job_interval, block_interval=args.block_interval,
+                                  difficulty=[EASY_DIFFICULTY], seed=args.seed)
+    args.share_rate = args.share_rate or recorded_rate or 0.2
+
+    # Every simulated miner needs a socket
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    pool_port = reactor.listenTCP(0, pool, interface='127.0.0.1').getHost().port
+    (stratum_port, getwork_port) = (get_free_port(), get_free_port())
+
+    with open(os.devnull, 'w') as devnull:
+        proxy = subprocess.Popen([sys.executable, PROXY, '-o', '127.0.0.1', '-p', str(pool_port),
+                                  '-sh', '127.0.0.1', '-sp', str(stratum_port), '-oh', '127.0.0.1', '-gp', str(getwork_port),
+                                  '--no-update-check', '-q'] + extra, stdout=devnull, stderr=devnull)
+    try:
+        def start():
+            d = run(args, pool, events, proxy, stratum_port, getwork_port)
+            d.addErrback(lambda failure: (failure.printTraceback(), reactor.stop()))
+        reactor.callWhenRunning(start)
+        reactor.run()
+    finally:
+        proxy.terminate()
+        proxy.wait()
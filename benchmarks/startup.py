@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+    Startup benchmark of the proxy.
+
+    Starts the proxy repeatedly and measures, from the process start:
+      - time-to-listening: Stratum port accepts TCP connections,
+      - time-to-first-job: connected Stratum miner receives its first mining.notify.
+
+    Usage: python benchmarks/startup.py [--runs N] [-o POOL_HOST] [-p POOL_PORT] [-- extra proxy args]
+'''
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+PROXY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mining_proxy.py')
+
+def get_free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_listening(port, deadline):
+    while time.time() < deadline:
+        try:
+            return socket.create_connection(('127.0.0.1', port), timeout=1)
+        except socket.error:
+            time.sleep(0.005)
+    raise Exception("Proxy isn't listening")
+
+def wait_for_job(conn, deadline):
+    conn.sendall(json.dumps({'id': 1, 'method': 'mining.subscribe', 'params': []}) + '\n')
+    buf = ''
+    while time.time() < deadline:
+        conn.settimeout(max(0.01, deadline - time.time()))
+        data = conn.recv(4096)
+        if not data:
+            raise Exception("Proxy closed the connection")
+        buf += data
+        while '\n' in buf:
+            (line, buf) = buf.split('\n', 1)
+            if json.loads(line).get('method') == 'mining.notify':
+                return
+    raise Exception("No job received")
+
+def run_once(args, extra):
+    port = get_free_port()
+    cmd = [sys.executable, PROXY, '-o', args.host, '-p', str(args.port),
+           '-sh', '127.0.0.1', '-sp', str(port), '-gp', str(get_free_port()), '-q'] + extra
+
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+        try:
+            deadline = start + args.timeout
+            conn = wait_for_listening(port, deadline)
+            listening = time.time() - start
+            wait_for_job(conn, deadline)
+            first_job = time.time() - start
+            conn.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    return (listening, first_job)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup benchmark of the proxy')
+    parser.add_argument('-o', '--host', dest='host', type=str, default='stratum.bitcoin.cz', help='Hostname of upstream pool')
+    parser.add_argument('-p', '--port', dest='port', type=int, default=3333, help='Port of upstream pool')
+    parser.add_argument('--runs', dest='runs', type=int, default=5, help='Number of proxy restarts')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=30, help='Give up single run after this many seconds')
+    (args, extra) = parser.parse_known_args()
+    extra = [ a for a in extra if a != '--' ]
+
+    results = []
+    for i in range(args.runs):
+        (listening, first_job) = run_once(args, extra)
+        print "run %d: listening after %.3fs, first job after %.3fs" % (i + 1, listening, first_job)
+        results.append((listening, first_job))
+
+    print "average: listening after %.3fs, first job after %.3fs" % \
+        (sum(r[0] for r in results) / len(results), sum(r[1] for r in results) / len(results))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+'''
+    Benchmark of writes to downstream Stratum connections.
+
+    Runs the proxy's Stratum listener with fake upstream in this process
+    and simulated miners in a child process, then counts writes to the
+    transports of miner connections and output syscalls of the listener:
+    send() on miner sockets and epoll_ctl() registering them for writing.
+    Counted with and without write coalescing:
+
+      broadcast -- mining.set_difficulty and mining.notify sent in the same turn
+      submit    -- every miner submits a share, the response is sent back
+
+    Usage: python benchmarks/writes.py [--connections N]
+'''
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, protocol, defer, stdio
+from twisted.protocols.basic import LineReceiver
+
+# Seconds without a new syscall after which phase is considered done
+SETTLE_TIME = 1.0
+
+class Miner(LineReceiver):
+    '''Subscribes on connect and submits a share when asked by the parent'''
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.factory.miners.append(self)
+        self.sendLine(json.dumps({'id': 1, 'method': 'mining.subscribe', 'params': []}))
+
+    def lineReceived(self, line):
+        pass
+
+    def submit(self):
+        self.sendLine(json.dumps({'id': 2, 'method': 'mining.submit',
+                                  'params': ['miner', '1', '0000', '504e86ed', '00000000']}))
+
+class Control(LineReceiver):
+    '''Commands from the parent process'''
+    delimiter = '\n'
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def lineReceived(self, line):
+        if line == 'submit':
+            for miner in self.factory.miners:
+                miner.submit()
+
+def run_miners(port, connections):
+    factory = protocol.ClientFactory()
+    factory.protocol = Miner
+    factory.miners = []
+    stdio.StandardIO(Control(factory))
+
+    # Ramp up, so connections don't overflow the listen queue
+    for i in range(connections):
+        reactor.callLater(i / 5000.0, reactor.connectTCP, '127.0.0.1', port, factory)
+    reactor.run()
+
+class Counter(object):
+    '''Counts transport writes and epoll_ctl() calls of given file descriptors'''
+    def __init__(self, poller):
+        self.poller = poller
+        self.fds = set()
+        self.ctl = 0
+        self.send = 0
+        self.write = 0
+
+    def _count(self, fd):
+        if fd in self.fds:
+            self.ctl += 1
+
+    def register(self, fd, *args):
+        self._count(fd)
+        return self.poller.register(fd, *args)
+
+    def modify(self, fd, *args):
+        self._count(fd)
+        return self.poller.modify(fd, *args)
+
+    def unregister(self, fd):
+        self._count(fd)
+        return self.poller.unregister(fd)
+
+    def __getattr__(self, name):
+        return getattr(self.poller, name)
+
+    def watch(self, conn):
+        '''Counts write(), send() and epoll_ctl() of the connection'''
+        write = conn.transport.write
+        def counted_write(data):
+            self.write += 1
+            return write(data)
+        conn.transport.write = counted_write
+
+        sock = conn.transport.socket
+        send = sock.send
+        def counted_send(data, *args):
+            self.send += 1
+            return send(data, *args)
+        sock.send = counted_send
+        self.fds.add(sock.fileno())
+
+    def reset(self):
+        (self.ctl, self.send, self.write) = (0, 0, 0)
+
+class FakeUpstream(object):
+    '''Accepts every share immediately'''
+    class client(object):
+        connected = True
+
+    @classmethod
+    def rpc(cls, method, params):
+        return defer.succeed(True)
+
+def setup_listener():
+    from stratum.services import ServiceEventHandler
+    from mining_libs import downstream, jobs, stratum_listener, upstream, worker_registry
+
+    pool = upstream.UpstreamPool()
+    session = pool.add(FakeUpstream, worker_registry.WorkerRegistry(FakeUpstream), jobs.JobStore())
+    session.set_extranonce('0a0b0c0d', 4)
+    stratum_listener.StratumProxyService._set_upstream(pool)
+    stratum_listener.MiningSubscription.on_template(session, build_job('1'), True)
+
+    factory = downstream.AdmissionControlFactory(debug=False, event_handler=ServiceEventHandler)
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1', backlog=1024)
+
+    counter = Counter(reactor._poller)
+    reactor._poller = counter
+    build = factory.buildProtocol
+    factory.conns = []
+    def build_protocol(addr):
+        conn = build(addr)
+        factory.conns.append(conn)
+        return conn
+    factory.buildProtocol = build_protocol
+    return (session, factory, port.getHost().port, counter)
+
+def build_job(job_id, branches=12):
+    import binascii
+    from mining_libs import jobs
+    def randhex(n):
+        return binascii.hexlify(os.urandom(n))
+    return jobs.Job.build_from_broadcast(job_id, randhex(32), randhex(50), randhex(50),
+                [ randhex(32) for _ in range(branches) ], '00000002', '1a0abbcc', '504e86ed')
+
+def sleep(seconds):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, True)
+    return d
+
+@defer.inlineCallbacks
+def settle(counter):
+    '''Waits until all output has been written'''
+    last = None
+    while (counter.send, counter.ctl) != last:
+        last = (counter.send, counter.ctl)
+        yield sleep(SETTLE_TIME)
+
+@defer.inlineCallbacks
+def run(args, session, factory, counter, miners):
+    from mining_libs import stratum_listener
+
+    while len(factory.conns) < args.connections or \
+            len([ c for c in factory.conns if c.get_session().get('tail') ]) < args.connections:
+        yield sleep(0.5)
+    for conn in factory.conns:
+        counter.watch(conn)
+    yield settle(counter)
+
+    print "%-12s %-10s %10s %10s %12s %14s" % ('coalescing', 'phase', 'write()', 'send()', 'epoll_ctl()', 'syscalls/conn')
+    for coalesce in (False, True):
+        factory.coalesce_writes = coalesce
+
+        counter.reset()
+        stratum_listener.DifficultySubscription.on_new_difficulty(session, 2)
+        stratum_listener.MiningSubscription.on_template(session, build_job('2'), True)
+        yield settle(counter)
+        print "%-12s %-10s %10d %10d %12d %14.2f" % ('on' if coalesce else 'off', 'broadcast', counter.write, counter.send, counter.ctl,
+                                                         (counter.send + counter.ctl) / float(args.connections))
+
+        counter.reset()
+        miners.stdin.write('submit\n')
+        miners.stdin.flush()
+        yield settle(counter)
+        print "%-12s %-10s %10d %10d %12d %14.2f" % ('on' if coalesce else 'off', 'submit', counter.write, counter.send, counter.ctl,
+                                                         (counter.send + counter.ctl) / float(args.connections))
+    reactor.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of writes to downstream connections')
+    parser.add_argument('--connections', dest='connections', type=int, default=10000, help='Number of simulated Stratum miners')
+    parser.add_argument('--miners-port', dest='miners_port', type=int, help=argparse.SUPPRESS) # Runs simulated miners
+    args = parser.parse_args()
+
+    # Every connection needs a socket
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if args.miners_port:
+        run_miners(args.miners_port, args.connections)
+        sys.exit(0)
+
+    from stratum import settings
+    settings.LOGLEVEL = 'WARNING'
+    (session, factory, port, counter) = setup_listener()
+
+    miners = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--connections', str(args.connections),
+                               '--miners-port', str(port)], stdin=subprocess.PIPE)
+    try:
+        def start():
+            d = run(args, session, factory, counter, miners)
+            d.addErrback(lambda failure: (failure.printTraceback(), reactor.stop()))
+        reactor.callWhenRunning(start)
+        reactor.run()
+    finally:
+        miners.terminate()
+        miners.wait()
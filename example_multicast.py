@@ -2,6 +2,9 @@
 '''
     This is just an example script for miner developers.
     If you're end user, you don't need to use this script.
+    Found proxies are printed from the least loaded one.
+    Use --simulate N for starting N simulated proxies on this machine,
+    which is handy for testing the discovery without a proxy fleet.
 
     Detector of Stratum mining proxies on local network
     Copyright (C) 2012 Marek Palatinus <slush@satoshilabs.com>
@@ -20,58 +23,57 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-from twisted.internet.protocol import DatagramProtocol
-from twisted.internet import reactor, defer
-
-import json
-
-class MulticastClient(DatagramProtocol):
-
-    def startProtocol(self):
-        self.transport.joinGroup("239.3.3.3")
-        self.transport.write(json.dumps({"id": 0, "method": "mining.get_upstream", "params": []}), ('239.3.3.3', 3333))
-
-    def datagramReceived(self, datagram, address):
-        '''Some data from peers received.
-
-           Example of valid datagram:
-              {"id": 0, "result": [["api-stratum.bitcoin.cz", 3333], 3333, 8332], "error": null}
-
-           First argument - (host, port) of upstream pool
-           Second argument - Stratum port where proxy is listening
-           Third parameter - Getwork port where proxy is listening
-        '''
-        #print "Datagram %s received from %s" % (datagram, address)
+import argparse
+import random
 
-        try:
-            data = json.loads(datagram)
-        except:
-            print "Unparsable datagram received"
-
-
-        if data.get('id') != 0 or data.get('result') == None:
-            return
-
-
-        (proxy_host, proxy_port) = address
-	(pool_host, pool_port) = data['result'][0]
-        stratum_port = data['result'][1]
-        getwork_port = data['result'][2]
+from twisted.internet import reactor, defer
 
-        print "Found stratum proxy on %(proxy_host)s:%(stratum_port)d (stratum), "\
-               "%(proxy_host)s:%(getwork_port)d (getwork), "\
-               "mining for %(pool_host)s:%(pool_port)d" % \
-              {'proxy_host': proxy_host,
-               'pool_host': pool_host,
-               'pool_port': pool_port,
-               'stratum_port': stratum_port,
-               'getwork_port': getwork_port}
+from mining_libs import discovery
+from mining_libs import multicast_responder
+
+def simulate(count):
+    '''Start given count of discovery responders with random load'''
+    for i in range(count):
+        load = (random.randint(0, 100), random.choice([100, 200, None]))
+        responder = multicast_responder.MulticastResponder(('stratum.bitcoin.cz', 3333), 13333 + i, 18332 + i,
+                                                           get_load=lambda load=load: load)
+        reactor.listenMulticast(multicast_responder.MULTICAST_PORT, responder, listenMultiple=True)
+        print "Simulated proxy on ports %d (stratum), %d (getwork) with %s/%s miners" % ((13333 + i, 18332 + i) + load)
+
+@defer.inlineCallbacks
+def main(args):
+    client = discovery.DiscoveryClient(window=args.window)
+    reactor.listenMulticast(0, client)
+
+    if args.simulate:
+        # Let simulated proxies announce themselves to each other
+        d = defer.Deferred()
+        reactor.callLater(0.5, d.callback, True)
+        yield d
+
+    print "Listening for Stratum proxies on local network..."
+    proxies = (yield client.get_proxies())
+    for proxy in proxies:
+        print "Found stratum proxy on %s:%d (stratum), %s:%d (getwork), load %s/%s, rtt %s, mining for %s:%d" % \
+            (proxy.host, proxy.stratum_port, proxy.host, proxy.getwork_port, proxy.miners, proxy.capacity,
+             "%.1fms" % (proxy.rtt * 1000) if proxy.rtt != None else "?", proxy.pool[0], proxy.pool[1])
+
+    if proxies:
+        # Pretend the best proxy doesn't work for us
+        client.mark_failed(proxies[0])
+        best = (yield client.get_best())
+        print "Next best proxy after failure of the first one: %r" % best
 
-def stop():
     print "Local discovery of Stratum proxies is finished."
     reactor.stop()
 
-print "Listening for Stratum proxies on local network..."
-reactor.listenMulticast(3333, MulticastClient(), listenMultiple=True)
-reactor.callLater(5, stop)
-reactor.run()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find Stratum mining proxies on local network.')
+    parser.add_argument('--window', dest='window', type=float, default=discovery.DISCOVERY_WINDOW, help='Seconds to wait for replies')
+    parser.add_argument('--simulate', dest='simulate', type=int, default=0, help='Start given count of simulated proxies on this machine')
+    args = parser.parse_args()
+
+    if args.simulate:
+        simulate(args.simulate)
+    reactor.callWhenRunning(main, args)
+    reactor.run()
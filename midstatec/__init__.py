@@ -0,0 +1 @@
+from midstatec import test, test_path, midstate, midstate_batch, midstate_prefix, midstate_finish, paths
@@ -2,7 +2,7 @@
 
 import struct
 import binascii
-from midstate import SHA256
+from midstate import SHA256, SHA256_batch, SHA256_prefix, SHA256_finish, SHA256_paths as paths
 
 test_data = binascii.unhexlify("0000000293d5a732e749dbb3ea84318bd0219240a2e2945046015880000003f5000000008d8e2673e5a071a2c83c86e28033b1a0a4aac90dde7a0670827cd0c3ef8caf7d5076c7b91a057e0800000000000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000")
 test_target_midstate = binascii.unhexlify("4c8226f95a31c9619f5197809270e4fa0a2d34c10215cf4456325e1237cb009d")
@@ -12,10 +12,40 @@ def midstate(data):
     reversed = struct.pack('>IIIIIIIIIIIIIIII', *struct.unpack('>IIIIIIIIIIIIIIII', data[:64])[::-1])[::-1]
     return struct.pack('<IIIIIIII', *SHA256(reversed))
 
+def midstate_batch(blocks, path=None):
+    '''Midstates of many blocks by single call. Blocks are given as a list
+    of 64-byte strings or as one contiguous string, in the same byte order as for midstate().
+    Code path is picked by CPU features, the fastest one of paths() by default.'''
+    if not isinstance(blocks, bytes):
+        blocks = b''.join(blocks)
+    out = SHA256_batch(blocks) if path is None else SHA256_batch(blocks, path)
+    return [ out[i:i+32] for i in range(0, len(out), 32) ]
+
+def midstate_prefix(data):
+    '''Partial state over the constant prefix (version and prevhash) of the block,
+    the same for all blocks of a job. Data in the same byte order as for midstate().'''
+    return SHA256_prefix(data[:64])
+
+def midstate_finish(prefix, data, path=None):
+    '''The same as midstate(data), but rounds over the prefix are taken from midstate_prefix()'''
+    return SHA256_finish(prefix, data[:64]) if path is None else SHA256_finish(prefix, data[:64], path)
+
+def test_path(path):
+    '''Known midstate in every lane of the code path, then different
+    blocks per lane must give the same midstates as the generic code'''
+    if midstate_batch([test_data[:64]] * 9, path) != [test_target_midstate] * 9:
+        return False
+    if midstate_finish(midstate_prefix(test_data), test_data, path) != test_target_midstate:
+        return False
+    blocks = [ struct.pack('<16I', *[ (j * 0x9e3779b9 + i * 0x7f4a7c15) & 0xffffffff for j in range(16) ]) for i in range(19) ]
+    return midstate_batch(blocks, path) == midstate_batch(blocks, 'generic')
+
 def test():
-    return midstate(test_data) == test_target_midstate
+    return midstate(test_data) == test_target_midstate and all(test_path(path) for path in paths())
 
 if __name__ == '__main__':
     print "target:  ", binascii.hexlify(test_target_midstate)
     print "computed:", binascii.hexlify(midstate(test_data))
+    for path in paths():
+        print "%-9s" % (path + ':'), test_path(path)
     print "passed:  ", test()
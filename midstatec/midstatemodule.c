@@ -34,21 +34,31 @@ static inline uint32_t ror32(const uint32_t v, const uint32_t n) {
 	return (v >> n) | (v << (32 - n));
 };
 
-static inline void update_state(sha256_state_t *state, const uint32_t data[16]) {
-	uint32_t w[64];
-	sha256_state_t t = *state;
+static inline uint32_t read_le32(const unsigned char *p) {
+	return (uint32_t) p[0] | ((uint32_t) p[1] << 8) | ((uint32_t) p[2] << 16) | ((uint32_t) p[3] << 24);
+}
 
-	for (size_t i = 0 ; i < 16; i++) {
-		w[i] = htonl(data[i]);
-	}
+static inline void write_le32(unsigned char *p, const uint32_t v) {
+	p[0] = v; p[1] = v >> 8; p[2] = v >> 16; p[3] = v >> 24;
+}
 
+// Rounds 9 and later depend on words after version and prevhash,
+// the state after the first PREFIX_ROUNDS is constant per job
+#define PREFIX_ROUNDS 9
+
+static inline void expand_words(uint32_t w[64]) {
 	for (size_t i = 16; i < 64; i++) {
 		uint32_t s0 = ror32(w[i - 15], 7) ^ ror32(w[i - 15], 18) ^ (w[i - 15] >> 3);
 		uint32_t s1 = ror32(w[i - 2], 17) ^ ror32(w[i -  2], 19) ^ (w[i -  2] >> 10);
 		w[i] = w[i - 16] + s0 + w[i - 7] + s1;
 	}
+}
 
-	for (size_t i = 0; i < 64; i++) {
+// Rounds from start to end (exclusive) applied on working variables
+static inline void run_rounds(sha256_state_t *state, const uint32_t w[64], size_t start, size_t end) {
+	sha256_state_t t = *state;
+
+	for (size_t i = start; i < end; i++) {
         uint32_t s0  = ror32(t.h[0], 2) ^ ror32(t.h[0], 13) ^ ror32(t.h[0], 22);
 		uint32_t maj = (t.h[0] & t.h[1]) ^ (t.h[0] & t.h[2]) ^ (t.h[1] & t.h[2]);
 		uint32_t t2  = s0 + maj;
@@ -66,6 +76,16 @@ static inline void update_state(sha256_state_t *state, const uint32_t data[16])
 		t.h[0] = t1 + t2;
 	}
 
+	*state = t;
+}
+
+// Compresses single block, first 16 words of w are the block in host order,
+// the rest of message schedule is computed here
+static inline void update_state_words(sha256_state_t *state, uint32_t w[64]) {
+	sha256_state_t t = *state;
+
+	expand_words(w);
+	run_rounds(&t, w, 0, 64);
 	for (size_t i = 0; i < 8; i++) {
 		state->h[i] += t.h[i];
 	}
@@ -77,15 +97,321 @@ static inline void init_state(sha256_state_t *state) {
 	}
 }
 
+// Code paths selected at runtime, so the module is built without -march
+// and still uses SIMD instructions of the CPU it runs on
+enum {
+	PATH_GENERIC, // Scalar code, one block at a time
+	PATH_SSE4,    // Four blocks in parallel lanes of SSE registers
+	PATH_AVX2,    // Eight blocks in parallel lanes of AVX2 registers
+	PATH_SHANI,   // One block at a time by SHA-256 instructions
+	PATH_COUNT,
+};
+
+static const char *path_names[PATH_COUNT] = {"generic", "sse4", "avx2", "shani"};
+
+// Fastest first
+static const int path_preference[PATH_COUNT] = {PATH_SHANI, PATH_AVX2, PATH_SSE4, PATH_GENERIC};
+
+static int best_path = PATH_GENERIC;
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define MIDSTATE_X86
+#include <immintrin.h>
+#include <cpuid.h>
+
+static bool cpu_has_sha(void) {
+	unsigned int a, b, c, d;
+
+	if (!__get_cpuid_count(7, 0, &a, &b, &c, &d)) {
+		return false;
+	}
+	return (b >> 29) & 1;
+}
+
+#define SSE_ROR(x, n) _mm_or_si128(_mm_srli_epi32((x), (n)), _mm_slli_epi32((x), 32 - (n)))
+#define SSE_XOR3(x, y, z) _mm_xor_si128(_mm_xor_si128((x), (y)), (z))
+#define SSE_ADD3(x, y, z) _mm_add_epi32(_mm_add_epi32((x), (y)), (z))
+
+__attribute__((target("sse4.1")))
+static void midstate_4way_sse4(const unsigned char *in, unsigned char *out) {
+	__m128i w[64];
+	__m128i t[8];
+
+	for (size_t i = 0; i < 16; i++) {
+		w[i] = _mm_set_epi32(read_le32(in + 192 + 4 * i), read_le32(in + 128 + 4 * i),
+		                     read_le32(in + 64 + 4 * i), read_le32(in + 4 * i));
+	}
+
+	for (size_t i = 16; i < 64; i++) {
+		__m128i s0 = SSE_XOR3(SSE_ROR(w[i - 15], 7), SSE_ROR(w[i - 15], 18), _mm_srli_epi32(w[i - 15], 3));
+		__m128i s1 = SSE_XOR3(SSE_ROR(w[i - 2], 17), SSE_ROR(w[i - 2], 19), _mm_srli_epi32(w[i - 2], 10));
+		w[i] = _mm_add_epi32(SSE_ADD3(w[i - 16], s0, w[i - 7]), s1);
+	}
+
+	for (size_t i = 0; i < 8; i++) {
+		t[i] = _mm_set1_epi32(h[i]);
+	}
+
+	for (size_t i = 0; i < 64; i++) {
+		__m128i s0  = SSE_XOR3(SSE_ROR(t[0], 2), SSE_ROR(t[0], 13), SSE_ROR(t[0], 22));
+		__m128i maj = SSE_XOR3(_mm_and_si128(t[0], t[1]), _mm_and_si128(t[0], t[2]), _mm_and_si128(t[1], t[2]));
+		__m128i t2  = _mm_add_epi32(s0, maj);
+		__m128i s1  = SSE_XOR3(SSE_ROR(t[4], 6), SSE_ROR(t[4], 11), SSE_ROR(t[4], 25));
+		__m128i ch  = _mm_xor_si128(_mm_and_si128(t[4], t[5]), _mm_andnot_si128(t[4], t[6]));
+		__m128i t1  = _mm_add_epi32(SSE_ADD3(t[7], s1, ch), _mm_add_epi32(_mm_set1_epi32(k[i]), w[i]));
+
+		t[7] = t[6];
+		t[6] = t[5];
+		t[5] = t[4];
+		t[4] = _mm_add_epi32(t[3], t1);
+		t[3] = t[2];
+		t[2] = t[1];
+		t[1] = t[0];
+		t[0] = _mm_add_epi32(t1, t2);
+	}
+
+	for (size_t i = 0; i < 8; i++) {
+		__m128i v = _mm_add_epi32(t[i], _mm_set1_epi32(h[i]));
+		write_le32(out + 4 * i, _mm_extract_epi32(v, 0));
+		write_le32(out + 32 + 4 * i, _mm_extract_epi32(v, 1));
+		write_le32(out + 64 + 4 * i, _mm_extract_epi32(v, 2));
+		write_le32(out + 96 + 4 * i, _mm_extract_epi32(v, 3));
+	}
+}
+
+#define AVX_ROR(x, n) _mm256_or_si256(_mm256_srli_epi32((x), (n)), _mm256_slli_epi32((x), 32 - (n)))
+#define AVX_XOR3(x, y, z) _mm256_xor_si256(_mm256_xor_si256((x), (y)), (z))
+#define AVX_ADD3(x, y, z) _mm256_add_epi32(_mm256_add_epi32((x), (y)), (z))
+
+__attribute__((target("avx2")))
+static void midstate_8way_avx2(const unsigned char *in, unsigned char *out) {
+	__m256i w[64];
+	__m256i t[8];
+	uint32_t lanes[8];
+
+	for (size_t i = 0; i < 16; i++) {
+		w[i] = _mm256_set_epi32(read_le32(in + 448 + 4 * i), read_le32(in + 384 + 4 * i),
+		                        read_le32(in + 320 + 4 * i), read_le32(in + 256 + 4 * i),
+		                        read_le32(in + 192 + 4 * i), read_le32(in + 128 + 4 * i),
+		                        read_le32(in + 64 + 4 * i), read_le32(in + 4 * i));
+	}
+
+	for (size_t i = 16; i < 64; i++) {
+		__m256i s0 = AVX_XOR3(AVX_ROR(w[i - 15], 7), AVX_ROR(w[i - 15], 18), _mm256_srli_epi32(w[i - 15], 3));
+		__m256i s1 = AVX_XOR3(AVX_ROR(w[i - 2], 17), AVX_ROR(w[i - 2], 19), _mm256_srli_epi32(w[i - 2], 10));
+		w[i] = _mm256_add_epi32(AVX_ADD3(w[i - 16], s0, w[i - 7]), s1);
+	}
+
+	for (size_t i = 0; i < 8; i++) {
+		t[i] = _mm256_set1_epi32(h[i]);
+	}
+
+	for (size_t i = 0; i < 64; i++) {
+		__m256i s0  = AVX_XOR3(AVX_ROR(t[0], 2), AVX_ROR(t[0], 13), AVX_ROR(t[0], 22));
+		__m256i maj = AVX_XOR3(_mm256_and_si256(t[0], t[1]), _mm256_and_si256(t[0], t[2]), _mm256_and_si256(t[1], t[2]));
+		__m256i t2  = _mm256_add_epi32(s0, maj);
+		__m256i s1  = AVX_XOR3(AVX_ROR(t[4], 6), AVX_ROR(t[4], 11), AVX_ROR(t[4], 25));
+		__m256i ch  = _mm256_xor_si256(_mm256_and_si256(t[4], t[5]), _mm256_andnot_si256(t[4], t[6]));
+		__m256i t1  = _mm256_add_epi32(AVX_ADD3(t[7], s1, ch), _mm256_add_epi32(_mm256_set1_epi32(k[i]), w[i]));
+
+		t[7] = t[6];
+		t[6] = t[5];
+		t[5] = t[4];
+		t[4] = _mm256_add_epi32(t[3], t1);
+		t[3] = t[2];
+		t[2] = t[1];
+		t[1] = t[0];
+		t[0] = _mm256_add_epi32(t1, t2);
+	}
+
+	for (size_t i = 0; i < 8; i++) {
+		_mm256_storeu_si256((__m256i *) lanes, _mm256_add_epi32(t[i], _mm256_set1_epi32(h[i])));
+		for (size_t lane = 0; lane < 8; lane++) {
+			write_le32(out + 32 * lane + 4 * i, lanes[lane]);
+		}
+	}
+}
+
+// Same as update_state_words(), only first 16 words of w are used
+__attribute__((target("sha,sse4.1")))
+static void update_state_shani(sha256_state_t *state, const uint32_t w[16]) {
+	__m128i state0, state1, msg, tmp, abef, cdgh;
+	__m128i msgs[4];
+
+	tmp    = _mm_loadu_si128((const __m128i *) &state->h[0]);
+	state1 = _mm_loadu_si128((const __m128i *) &state->h[4]);
+	tmp    = _mm_shuffle_epi32(tmp, 0xB1);          // CDAB
+	state1 = _mm_shuffle_epi32(state1, 0x1B);       // EFGH
+	state0 = _mm_alignr_epi8(tmp, state1, 8);       // ABEF
+	state1 = _mm_blend_epi16(state1, tmp, 0xF0);    // CDGH
+	abef = state0;
+	cdgh = state1;
+
+	for (size_t i = 0; i < 4; i++) {
+		msgs[i] = _mm_loadu_si128((const __m128i *) &w[4 * i]);
+	}
+
+	// Four rounds per iteration, message schedule is extended
+	// in msgs[] ring two and three iterations ahead
+	for (size_t i = 0; i < 16; i++) {
+		__m128i cur = msgs[i & 3];
+
+		msg = _mm_add_epi32(cur, _mm_loadu_si128((const __m128i *) &k[4 * i]));
+		state1 = _mm_sha256rnds2_epu32(state1, state0, msg);
+		if (i >= 3 && i < 15) {
+			tmp = _mm_alignr_epi8(cur, msgs[(i - 1) & 3], 4);
+			msgs[(i + 1) & 3] = _mm_sha256msg2_epu32(_mm_add_epi32(msgs[(i + 1) & 3], tmp), cur);
+		}
+		msg = _mm_shuffle_epi32(msg, 0x0E);
+		state0 = _mm_sha256rnds2_epu32(state0, state1, msg);
+		if (i >= 1 && i < 13) {
+			msgs[(i - 1) & 3] = _mm_sha256msg1_epu32(msgs[(i - 1) & 3], cur);
+		}
+	}
+
+	state0 = _mm_add_epi32(state0, abef);
+	state1 = _mm_add_epi32(state1, cdgh);
+
+	tmp    = _mm_shuffle_epi32(state0, 0x1B);       // FEBA
+	state1 = _mm_shuffle_epi32(state1, 0xB1);       // DCHG
+	state0 = _mm_blend_epi16(tmp, state1, 0xF0);    // DCBA
+	state1 = _mm_alignr_epi8(state1, tmp, 8);       // HGFE
+	_mm_storeu_si128((__m128i *) &state->h[0], state0);
+	_mm_storeu_si128((__m128i *) &state->h[4], state1);
+}
+#endif
+
+static bool path_supported(int path) {
+	switch (path) {
+	case PATH_GENERIC:
+		return true;
+#ifdef MIDSTATE_X86
+	case PATH_SSE4:
+		return __builtin_cpu_supports("sse4.1");
+	case PATH_AVX2:
+		return __builtin_cpu_supports("avx2");
+	case PATH_SHANI:
+		return cpu_has_sha() && __builtin_cpu_supports("sse4.1");
+#endif
+	}
+	return false;
+}
+
+static void detect_paths(void) {
+#ifdef MIDSTATE_X86
+	__builtin_cpu_init();
+#endif
+	for (size_t i = 0; i < PATH_COUNT; i++) {
+		if (path_supported(path_preference[i])) {
+			best_path = path_preference[i];
+			return;
+		}
+	}
+}
+
+static inline void update_state_path(sha256_state_t *state, uint32_t w[64], int path) {
+#ifdef MIDSTATE_X86
+	if (path == PATH_SHANI) {
+		update_state_shani(state, w);
+		return;
+	}
+#endif
+	update_state_words(state, w);
+}
+
 static sha256_state_t midstate(const unsigned char data[64]) {
 	sha256_state_t state;
 
+	uint32_t w[64];
+	const uint32_t *words = (const uint32_t *) data;
+
+	for (size_t i = 0 ; i < 16; i++) {
+		w[i] = htonl(words[i]);
+	}
 	init_state(&state);
-	update_state(&state, (const uint32_t const *) data);
+	update_state_path(&state, w, best_path == PATH_SHANI ? PATH_SHANI : PATH_GENERIC);
 
 	return state;
 }
 
+static void read_block(const unsigned char *in, uint32_t w[64]) {
+	for (size_t i = 0; i < 16; i++) {
+		w[i] = read_le32(in + 4 * i);
+	}
+}
+
+// Midstates of n blocks in getwork byte order (every word byteswapped),
+// written as little-endian words, so no reordering is needed on either side.
+// Lane paths hash as many blocks as they can, the rest goes one by one.
+static void midstate_batch(const unsigned char *in, unsigned char *out, size_t n, int path) {
+	uint32_t w[64];
+	sha256_state_t state;
+
+#ifdef MIDSTATE_X86
+	if (path == PATH_AVX2) {
+		for (; n >= 8; n -= 8, in += 8 * 64, out += 8 * 32) {
+			midstate_8way_avx2(in, out);
+		}
+	}
+	if (path == PATH_AVX2 || path == PATH_SSE4) {
+		for (; n >= 4; n -= 4, in += 4 * 64, out += 4 * 32) {
+			midstate_4way_sse4(in, out);
+		}
+	}
+#endif
+
+	for (; n > 0; n--, in += 64, out += 32) {
+		read_block(in, w);
+		init_state(&state);
+		update_state_path(&state, w, path);
+		for (size_t i = 0; i < 8; i++) {
+			write_le32(out + 4 * i, state.h[i]);
+		}
+	}
+}
+
+// Working variables after PREFIX_ROUNDS of block in getwork byte order,
+// only its first 36 bytes (version and prevhash) are used
+static void midstate_prefix(const unsigned char *in, unsigned char *out) {
+	uint32_t w[64];
+	sha256_state_t t;
+
+	for (size_t i = 0; i < PREFIX_ROUNDS; i++) {
+		w[i] = read_le32(in + 4 * i);
+	}
+	init_state(&t);
+	run_rounds(&t, w, 0, PREFIX_ROUNDS);
+	for (size_t i = 0; i < 8; i++) {
+		write_le32(out + 4 * i, t.h[i]);
+	}
+}
+
+// Midstate of block in getwork byte order, which starts by the prefix given
+// to midstate_prefix(). SHA-256 instructions are faster on the whole block
+// than the generic code on remaining rounds, so they don't use the prefix.
+static void midstate_finish(const unsigned char *prefix, const unsigned char *in, unsigned char *out, int path) {
+	uint32_t w[64];
+	sha256_state_t state, t;
+
+	read_block(in, w);
+	init_state(&state);
+	if (path == PATH_SHANI) {
+		update_state_path(&state, w, PATH_SHANI);
+	} else {
+		for (size_t i = 0; i < 8; i++) {
+			t.h[i] = read_le32(prefix + 4 * i);
+		}
+		expand_words(w);
+		run_rounds(&t, w, PREFIX_ROUNDS, 64);
+		for (size_t i = 0; i < 8; i++) {
+			state.h[i] += t.h[i];
+		}
+	}
+	for (size_t i = 0; i < 8; i++) {
+		write_le32(out + 4 * i, state.h[i]);
+	}
+}
+
 void print_hex(char unsigned *data, size_t s) {
 	for (size_t i = 0; i < s; i++) {
 		printf("%02hhx", data[i]);
@@ -135,8 +461,144 @@ error:
 	return NULL;
 }
 
+// Code path of given name, the best one for NULL, -1 with exception set when unavailable
+static int parse_path(const char *name) {
+	int path;
+
+	if (name == NULL) {
+		return best_path;
+	}
+	for (path = 0; path < PATH_COUNT && strcmp(name, path_names[path]) != 0; path++);
+	if (path == PATH_COUNT || !path_supported(path)) {
+		PyErr_Format(PyExc_ValueError, "Code path %s is not available.", name);
+		return -1;
+	}
+	return path;
+}
+
+PyObject *midstate_batch_helper(PyObject *self, PyObject *args) {
+	Py_ssize_t s;
+	char *t;
+	PyObject *arg;
+	PyObject *ret;
+	const char *name = NULL;
+	int path;
+
+	if (!PyArg_ParseTuple(args, "O|s", &arg, &name)) {
+		return NULL;
+	}
+	if ((path = parse_path(name)) < 0) {
+		return NULL;
+	}
+	if (PyBytes_Check(arg) != true) {
+		PyErr_SetString(PyExc_ValueError, "Need bytes object as argument.");
+		return NULL;
+	}
+	if (PyBytes_AsStringAndSize(arg, &t, &s) == -1) {
+		return NULL;
+	}
+	if (s % 64 != 0) {
+		PyErr_SetString(PyExc_ValueError, "Argument length must be a multiple of 64 bytes.");
+		return NULL;
+	}
+
+	ret = PyBytes_FromStringAndSize(NULL, s / 2);
+	if (ret == NULL) {
+		return NULL;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	midstate_batch((const unsigned char *) t, (unsigned char *) PyBytes_AS_STRING(ret), s / 64, path);
+	Py_END_ALLOW_THREADS
+
+	return ret;
+}
+
+PyObject *prefix_helper(PyObject *self, PyObject *arg) {
+	Py_ssize_t s;
+	char *t;
+	PyObject *ret;
+
+	if (PyBytes_Check(arg) != true) {
+		PyErr_SetString(PyExc_ValueError, "Need bytes object as argument.");
+		return NULL;
+	}
+	if (PyBytes_AsStringAndSize(arg, &t, &s) == -1) {
+		return NULL;
+	}
+	if (s < 4 * PREFIX_ROUNDS) {
+		PyErr_SetString(PyExc_ValueError, "Argument length must be at least 36 bytes.");
+		return NULL;
+	}
+
+	ret = PyBytes_FromStringAndSize(NULL, 32);
+	if (ret != NULL) {
+		midstate_prefix((const unsigned char *) t, (unsigned char *) PyBytes_AS_STRING(ret));
+	}
+	return ret;
+}
+
+PyObject *finish_helper(PyObject *self, PyObject *args) {
+	PyObject *prefix, *data, *ret;
+	const char *name = NULL;
+	int path;
+
+	if (!PyArg_ParseTuple(args, "OO|s", &prefix, &data, &name)) {
+		return NULL;
+	}
+	if ((path = parse_path(name)) < 0) {
+		return NULL;
+	}
+	if (PyBytes_Check(prefix) != true || PyBytes_Check(data) != true) {
+		PyErr_SetString(PyExc_ValueError, "Need bytes objects as arguments.");
+		return NULL;
+	}
+	if (PyBytes_GET_SIZE(prefix) != 32 || PyBytes_GET_SIZE(data) < 64) {
+		PyErr_SetString(PyExc_ValueError, "Prefix must be 32 bytes and data at least 64 bytes long.");
+		return NULL;
+	}
+
+	ret = PyBytes_FromStringAndSize(NULL, 32);
+	if (ret != NULL) {
+		midstate_finish((const unsigned char *) PyBytes_AS_STRING(prefix), (const unsigned char *) PyBytes_AS_STRING(data),
+		                (unsigned char *) PyBytes_AS_STRING(ret), path);
+	}
+	return ret;
+}
+
+// Names of code paths supported by this CPU, the default one first
+PyObject *paths_helper(PyObject *self, PyObject *unused) {
+	PyObject *ret = PyList_New(0);
+	PyObject *name;
+
+	if (ret == NULL) {
+		return NULL;
+	}
+	for (size_t i = 0; i < PATH_COUNT; i++) {
+		if (!path_supported(path_preference[i])) {
+			continue;
+		}
+#if PY_MAJOR_VERSION >= 3
+		name = PyUnicode_FromString(path_names[path_preference[i]]);
+#else
+		name = PyString_FromString(path_names[path_preference[i]]);
+#endif
+		if (name == NULL || PyList_Append(ret, name) != 0) {
+			Py_XDECREF(name);
+			Py_DECREF(ret);
+			return NULL;
+		}
+		Py_DECREF(name);
+	}
+	return ret;
+}
+
 static struct PyMethodDef midstate_functions[] = {
 	{"SHA256", midstate_helper, METH_O, NULL},
+	{"SHA256_batch", midstate_batch_helper, METH_VARARGS, NULL},
+	{"SHA256_paths", paths_helper, METH_NOARGS, NULL},
+	{"SHA256_prefix", prefix_helper, METH_O, NULL},
+	{"SHA256_finish", finish_helper, METH_VARARGS, NULL},
 	{NULL, NULL, 0, NULL},
 };
 
@@ -158,10 +620,12 @@ PyMODINIT_FUNC
 #if PY_MAJOR_VERSION >= 3
 PyInit_midstate(void)
 {
-	return PyModule_Create(&midstatemodule);
+	detect_paths();
+	return PyModule_Create(&moduledef);
 }
 #else
 initmidstate(void) {
+        detect_paths();
         Py_InitModule3("midstate", midstate_functions, NULL);
 }
 #endif
@@ -169,12 +633,34 @@ initmidstate(void) {
 int main(int argc, char *argv[]) {
 	const unsigned char data[] = "\1\0\0\0\xe4\xe8\x9d\xf8H\x1b\xc5v\xb9\x9f" "fWb\xcb\x82" "f\xf8U\xc6h" "@\x16\xb8\xb4\xd1iv\xf2\0\0\0\0\xe1\xd1O\x08\x98\xe6\x1d\x02O\x0e\1r\xfc" "cFi\xf5\xfc\xd5mN\1\xca\x10\xe9" "7{\x05hc\xd1U\xc8" "f O\xf8\xff\x07\x1d\0\0\0";
 
+	unsigned char in[9 * 64], out[9 * 32];
 	sha256_state_t state; 
 	
+	detect_paths();
 	//for (size_t i = 0; i < 1000000; i++)
 	state = midstate(data);
 
 	printf("b8101f7c4a8e294ecbccb941dde17fd461dc39ff102bc37bb7ac7d5b95290166 <-- want\n");
 	print_hex(state.byte, 32);
+
+	// Every lane of every supported path, blocks in getwork byte order
+	for (size_t b = 0; b < 9; b++) {
+		for (size_t i = 0; i < 64; i += 4) {
+			write_le32(in + b * 64 + i, htonl(*(const uint32_t *) (data + i)));
+		}
+	}
+	for (int path = 0; path < PATH_COUNT; path++) {
+		if (!path_supported(path)) {
+			continue;
+		}
+		midstate_batch(in, out, 9, path);
+		for (size_t b = 0; b < 9; b++) {
+			for (size_t i = 0; i < 8; i++) {
+				state.h[i] = read_le32(out + b * 32 + 4 * i);
+			}
+			printf("%-7s lane %zu: ", path_names[path], b);
+			print_hex(state.byte, 32);
+		}
+	}
 	return 0;
 }
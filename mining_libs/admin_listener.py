@@ -0,0 +1,47 @@
+from twisted.web.resource import Resource
+
+import jsoncodec
+
+import stratum.logger
+log = stratum.logger.get_logger('proxy')
+
+class Root(Resource):
+    '''Admin HTTP interface for instrumentation of the proxy.
+        GET /stats               reactor lag, admission control and upstream session statistics
+        GET /profile?seconds=N   run profiler for N seconds'''
+    isLeaf = True
+
+    def __init__(self, detector, profiler, profile_seconds, upstream=None, admission=None):
+        Resource.__init__(self)
+        self.detector = detector
+        self.profiler = profiler
+        self.profile_seconds = profile_seconds
+        self.upstream = upstream # UpstreamPool
+        self.admission = admission # AdmissionControlFactory of Stratum listener
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+
+        if request.path == '/stats':
+            stats = self.detector.get_stats() if self.detector != None else {}
+            if self.upstream != None:
+                stats['upstream'] = self.upstream.get_stats()
+            if self.admission != None:
+                # Including requests waiting in the backlog and shed ones
+                stats['stratum'] = self.admission.get_stats()
+            return jsoncodec.dumps(stats)
+
+        if request.path == '/profile':
+            try:
+                seconds = int(request.args.get('seconds', [self.profile_seconds])[0])
+            except ValueError:
+                request.setResponseCode(400)
+                return jsoncodec.dumps({'error': 'Invalid seconds'})
+
+            if not self.profiler.start(seconds):
+                request.setResponseCode(409)
+                return jsoncodec.dumps({'error': 'Profiler is already running'})
+            return jsoncodec.dumps({'file': self.profiler.filename, 'seconds': seconds})
+
+        request.setResponseCode(404)
+        return jsoncodec.dumps({'error': 'Unknown path'})
@@ -0,0 +1,80 @@
+import os
+import time
+
+from twisted.internet import reactor, protocol
+
+import stratum.logger
+log = stratum.logger.get_logger('proxy')
+
+class BlockNotifyProtocol(protocol.ProcessProtocol):
+    def __init__(self, notifier, prevhash):
+        self.notifier = notifier
+        self.prevhash = prevhash
+        self.start = time.time()
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+
+    def errReceived(self, data):
+        log.debug("blocknotify: %s" % data.strip())
+
+    def processEnded(self, reason):
+        run_time = (time.time() - self.start) * 1000
+        exit_code = reason.value.exitCode
+        if exit_code == 0:
+            log.info("[%dms] blocknotify for %s finished" % (run_time, self.prevhash[:8]))
+        else:
+            log.warning("[%dms] blocknotify for %s failed with exit code %s (signal %s)" % \
+                        (run_time, self.prevhash[:8], exit_code, reason.value.signal))
+        self.notifier.on_finished()
+
+class BlockNotifier(object):
+    '''Runs blocknotify command asynchronously. Command is started in the next
+    reactor iteration, so miners receive new jobs first. When blocks arrive
+    faster than commands finish, only the latest block is notified.'''
+
+    def __init__(self, cmd, max_running=1):
+        self.cmd = cmd
+        self.max_running = max_running
+        self.running = 0
+        self.pending = None # Prevhash waiting for the command
+        self.scheduled = False
+        self.coalesced = 0 # Notifications superseded by newer block
+
+    def notify(self, prevhash):
+        if self.pending != None:
+            self.coalesced += 1
+            log.info("blocknotify for %s skipped, newer block arrived" % self.pending[:8])
+        self.pending = prevhash
+
+        if not self.scheduled:
+            self.scheduled = True
+            reactor.callLater(0, self._run)
+
+    def _run(self):
+        self.scheduled = False
+        if self.pending == None or self.running >= self.max_running:
+            # Running command calls us again once it finishes
+            return
+
+        prevhash = self.pending
+        self.pending = None
+
+        cmd = self.cmd.replace('%s', prevhash)
+        if os.name == 'nt':
+            args = ['cmd.exe', '/c', cmd]
+        else:
+            args = ['/bin/sh', '-c', cmd]
+
+        try:
+            reactor.spawnProcess(BlockNotifyProtocol(self, prevhash), args[0], args, env=os.environ)
+        except Exception:
+            log.exception("Cannot execute blocknotify command")
+            return
+        self.running += 1
+
+    def on_finished(self):
+        self.running -= 1
+        if self.pending != None and not self.scheduled:
+            self.scheduled = True
+            reactor.callLater(0, self._run)
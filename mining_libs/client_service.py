@@ -1,8 +1,7 @@
-from twisted.internet import reactor
-
 from stratum.event_handler import GenericEventHandler
 from jobs import Job
 import utils
+import recorder
 import version as _version
 
 import stratum_listener
@@ -11,39 +10,22 @@ import stratum.logger
 log = stratum.logger.get_logger('proxy')
 
 class ClientMiningService(GenericEventHandler):
-    job_registry = None # Reference to JobRegistry instance
-    timeout = None # Reference to IReactorTime object
-    
-    @classmethod
-    def reset_timeout(cls):
-        if cls.timeout != None:
-            if not cls.timeout.called:
-                cls.timeout.cancel()
-            cls.timeout = None
-            
-        cls.timeout = reactor.callLater(2*60, cls.on_timeout)
-
-    @classmethod
-    def on_timeout(cls):
-        '''
-            Try to reconnect to the pool after two minutes of no activity on the connection.
-            It will also drop all Stratum connections to sub-miners
-            to indicate connection issues.
-        '''
-        log.error("Connection to upstream pool timed out")
-        cls.reset_timeout()
-        cls.job_registry.f.reconnect()
+    job_registry = None # Reference to JobRegistry instance, getwork is served by the primary upstream session
                 
     def handle_event(self, method, params, connection_ref):
         '''Handle RPC calls and notifications from the pool'''
 
+        # Every upstream session has its own connection
+        upstream = connection_ref.factory.upstream
+
         # Yay, we received something from the pool,
         # let's restart the timeout.
-        self.reset_timeout()
+        upstream.reset_timeout()
         
         if method == 'mining.notify':
             '''Proxy just received information about new mining job'''
             
+            recorder.record('upstream', method, params)
             (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs) = params[:9]
             #print len(str(params)), len(merkle_branch)
             
@@ -59,34 +41,40 @@ class ClientMiningService(GenericEventHandler):
             log.debug("merkle_branch = %s" % merkle_branch)
             '''
         
+            # Decode the job just once, it's shared by both interfaces
+            job = Job.build_from_broadcast(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime)
+            
             # Broadcast to Stratum clients
-            stratum_listener.MiningSubscription.on_template(
-                            job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)
+            stratum_listener.MiningSubscription.on_template(upstream, job, clean_jobs)
             
-            # Broadcast to getwork clients
-            job = Job.build_from_broadcast(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime)
-            log.info("New job %s for prevhash %s, clean_jobs=%s" % \
-                 (job.job_id, utils.format_hash(job.prevhash), clean_jobs))
-
-            self.job_registry.add_template(job, clean_jobs)
+            if upstream.index == 0:
+                # Broadcast to getwork clients
+                log.info("New job %s for prevhash %s, clean_jobs=%s" % \
+                     (job.job_id, utils.format_hash(job.prevhash), clean_jobs))
+                self.job_registry.add_template(job, clean_jobs)
+            else:
+                job.target = upstream.target
+                upstream.job_store.add(job, clean_jobs)
             
             
             
         elif method == 'mining.set_difficulty':
+            recorder.record('upstream', method, params)
             difficulty = params[0]
-            log.info("Setting new difficulty: %s" % difficulty)
+            log.info("Setting new difficulty: %s (upstream session %d)" % (difficulty, upstream.index))
             
-            stratum_listener.DifficultySubscription.on_new_difficulty(difficulty)
-            self.job_registry.set_difficulty(difficulty)
+            stratum_listener.DifficultySubscription.on_new_difficulty(upstream, difficulty)
+            if upstream.index == 0:
+                self.job_registry.set_difficulty(difficulty)
                     
         elif method == 'client.reconnect':
             (hostname, port, wait) = params[:3]
-            new = list(self.job_registry.f.main_host[::])
+            new = list(upstream.f.main_host[::])
             if hostname: new[0] = hostname
             if port: new[1] = port
 
             log.info("Server asked us to reconnect to %s:%d" % tuple(new))
-            self.job_registry.f.reconnect(new[0], new[1], wait)
+            upstream.f.reconnect(new[0], new[1], wait)
             
         elif method == 'client.add_peers':
             '''New peers which can be used on connection failure'''
@@ -94,7 +82,7 @@ class ClientMiningService(GenericEventHandler):
             '''
             peerlist = params[0] # TODO
             for peer in peerlist:
-                self.job_registry.f.add_peer(peer)
+                upstream.f.add_peer(peer)
             return True
             '''
         elif method == 'client.get_version':
@@ -0,0 +1,174 @@
+import time
+
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet import reactor, defer
+
+import jsoncodec
+
+import stratum.logger
+log = stratum.logger.get_logger('proxy')
+
+MULTICAST_GROUP = '239.3.3.3'
+MULTICAST_PORT = 3333
+
+# Seconds to collect replies of single discovery
+DISCOVERY_WINDOW = 1.0
+
+# Discovered proxies are reused for this many seconds
+CACHE_TTL = 60
+
+# Single proxy serves at most 65535 Stratum miners (two bytes of extranonce tail)
+DEFAULT_CAPACITY = 65535
+
+class ProxyInfo(object):
+    '''Mining proxy found on local network'''
+    __slots__ = ('host', 'stratum_port', 'getwork_port', 'pool', 'miners', 'capacity', 'rtt')
+
+    def __init__(self, host, stratum_port, getwork_port, pool, miners=None, capacity=None, rtt=None):
+        self.host = host
+        self.stratum_port = stratum_port
+        self.getwork_port = getwork_port
+        self.pool = pool # (host, port) of upstream pool
+        self.miners = miners # None when proxy doesn't advertise its load
+        self.capacity = capacity
+        self.rtt = rtt # Seconds, None when proxy has been advertised by another proxy
+
+    @property
+    def key(self):
+        return (self.host, self.stratum_port, self.getwork_port)
+
+    def get_load(self):
+        '''Utilization of the proxy between 0 and 1, unknown load counts as full'''
+        if self.miners == None:
+            return 1.0
+        return min(1.0, self.miners / float(self.capacity or DEFAULT_CAPACITY))
+
+    def is_full(self):
+        return self.capacity != None and self.miners != None and self.miners >= self.capacity
+
+    def __repr__(self):
+        return "<ProxyInfo %s:%s (stratum), %s (getwork), %s/%s miners, rtt %s>" % \
+            (self.host, self.stratum_port, self.getwork_port, self.miners, self.capacity,
+             "%.1fms" % (self.rtt * 1000) if self.rtt != None else "?")
+
+def rank(proxies):
+    '''Least loaded proxies first, faster one wins when the load is equal'''
+    return sorted([ p for p in proxies if not p.is_full() ],
+                  key=lambda p: (round(p.get_load(), 2), p.rtt if p.rtt != None else DISCOVERY_WINDOW))
+
+class DiscoveryClient(DatagramProtocol):
+    '''Finds mining proxies on local network by mining.get_upstream request.
+
+       Replies are collected for a time window and proxies are ranked by their
+       advertised load and measured round trip time. Result is cached, proxy
+       which doesn't work for the caller can be reported by mark_failed(), next
+       get_proxies() call then discovers the network again if needed.
+
+       Requests go to the multicast group by default; any list of (host, port)
+       addresses can be given instead, e.g. for networks without multicast.'''
+
+    def __init__(self, addresses=None, window=DISCOVERY_WINDOW, cache_ttl=CACHE_TTL):
+        self.addresses = addresses or [(MULTICAST_GROUP, MULTICAST_PORT)]
+        self.window = window
+        self.cache_ttl = cache_ttl
+
+        self.proxies = [] # Ranked result of the last discovery
+        self.discovered = 0 # When the last discovery finished
+        self.failed = set() # Keys of proxies reported by mark_failed()
+
+        self.msg_id = 0
+        self.sent = None # When the running discovery sent its requests
+        self.found = None # Proxies found by the running discovery
+        self.waiting = [] # Deferreds waiting for the running discovery
+
+    def startProtocol(self):
+        self.transport.setTTL(5)
+
+    def get_proxies(self):
+        '''Returns Deferred with ranked list of ProxyInfo'''
+        if self.proxies and time.time() - self.discovered < self.cache_ttl:
+            return defer.succeed(self.proxies)
+        return self.discover()
+
+    def get_best(self):
+        '''Returns Deferred with the best ProxyInfo or None when no proxy is available'''
+        return self.get_proxies().addCallback(lambda proxies: proxies[0] if proxies else None)
+
+    def mark_failed(self, proxy):
+        '''Given proxy is dropped from the cache and skipped by the next discovery'''
+        self.failed.add(proxy.key)
+        self.proxies = [ p for p in self.proxies if p.key != proxy.key ]
+
+    def discover(self):
+        d = defer.Deferred()
+        self.waiting.append(d)
+
+        if self.found == None:
+            # Start new discovery, running one is shared otherwise
+            self.msg_id += 1
+            self.found = {}
+            self.sent = time.time()
+            payload = jsoncodec.dumps({"id": self.msg_id, "method": "mining.get_upstream", "params": []})
+            for address in self.addresses:
+                try:
+                    self.transport.write(payload, address)
+                except Exception as exc:
+                    log.warning("Cannot send discovery request to %s:%d: %s" % (address[0], address[1], str(exc)))
+            reactor.callLater(self.window, self._finish)
+        return d
+
+    def _finish(self):
+        self.failed.clear()
+        self.proxies = rank(self.found.values())
+        self.discovered = time.time()
+        self.found = None
+
+        log.info("Discovered %d proxies on local network" % len(self.proxies))
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(self.proxies)
+
+    def _add(self, proxy):
+        if proxy.key in self.failed:
+            return
+
+        known = self.found.get(proxy.key)
+        if known == None or (known.rtt == None and proxy.rtt != None):
+            # Direct reply of the proxy is better than its advertisement by another proxy
+            self.found[proxy.key] = proxy
+
+    def datagramReceived(self, datagram, address):
+        if self.found == None:
+            # Reply came too late
+            return
+
+        try:
+            data = jsoncodec.loads(datagram)
+            if data.get('id') != self.msg_id or data.get('result') == None:
+                return
+            result = data['result']
+            pool = tuple(result[0])
+            (stratum_port, getwork_port) = result[1:3]
+            advertised = result[3] if len(result) > 3 else None
+        except (ValueError, TypeError, AttributeError, IndexError, KeyError):
+            log.debug("Invalid discovery reply from %s:%d" % address)
+            return
+
+        rtt = time.time() - self.sent
+
+        if advertised == None:
+            # Old proxy, which doesn't advertise the load
+            self._add(ProxyInfo(address[0], stratum_port, getwork_port, pool, rtt=rtt))
+            return
+
+        for p in advertised:
+            try:
+                if p['host'] == None:
+                    # Entry of the responding proxy itself
+                    self._add(ProxyInfo(address[0], p['stratum_port'], p['getwork_port'], pool,
+                                        p['miners'], p['capacity'], rtt))
+                else:
+                    self._add(ProxyInfo(p['host'], p['stratum_port'], p['getwork_port'], pool,
+                                        p['miners'], p['capacity']))
+            except (TypeError, KeyError):
+                log.debug("Invalid proxy entry from %s:%d" % address)
@@ -0,0 +1,286 @@
+import collections
+import time
+
+from twisted.internet import defer, reactor
+
+from stratum.protocol import Protocol
+from stratum.socket_transport import SocketTransportFactory
+from stratum.custom_exceptions import ServiceException
+
+import jsoncodec
+
+import stratum.logger
+log = stratum.logger.get_logger('proxy')
+
+# Default size of outgoing buffer which pauses a slow client
+WRITE_BUFFER_HIGH = 64 * 1024
+
+# Maximum of subscribe/authorize requests waiting for admission
+MAX_BACKLOG = 10000
+
+# Output of a connection is flushed right away when more than this is buffered
+COALESCE_LIMIT = 16 * 1024
+
+class OverloadedException(ServiceException):
+    code = -3
+
+class TokenBucket(object):
+    '''Allows rate events per second on average, with bursts up to burst events'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self):
+        '''Take one token, returns False when bucket is empty'''
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        '''Seconds until next token is available'''
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+class RateLimiter(object):
+    '''Token bucket with bounded backlog. Requests over the rate wait
+    in the backlog, requests over the backlog are shed.'''
+
+    def __init__(self, rate, max_backlog=MAX_BACKLOG):
+        self.bucket = TokenBucket(rate)
+        self.max_backlog = max_backlog
+        self.backlog = collections.deque()
+        self.shed = 0
+        self._timer = None
+
+    def acquire(self):
+        '''Returns Deferred fired once the request is admitted'''
+        if not self.backlog and self.bucket.consume():
+            return defer.succeed(True)
+
+        if len(self.backlog) >= self.max_backlog:
+            self.shed += 1
+            return defer.fail(OverloadedException("Proxy is overloaded, try again later"))
+
+        d = defer.Deferred()
+        self.backlog.append(d)
+        self._schedule()
+        return d
+
+    def _schedule(self):
+        if self._timer == None:
+            self._timer = reactor.callLater(self.bucket.delay(), self._drain)
+
+    def _drain(self):
+        self._timer = None
+        while self.backlog and self.bucket.consume():
+            self.backlog.popleft().callback(True)
+
+        if self.backlog:
+            self._schedule()
+
+class WriteCoalescer(object):
+    '''Flushes output of all connections written in the current reactor turn
+    by single delayed call, instead of one per connection.'''
+
+    def __init__(self):
+        self.pending = []
+        self._call = None
+
+    def schedule(self, conn):
+        self.pending.append(conn)
+        if self._call == None:
+            self._call = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self._call = None
+        pending, self.pending = self.pending, []
+        for conn in pending:
+            conn.flush()
+
+class DownstreamProtocol(Protocol):
+    '''Stratum protocol for connections from miners. Connection registers
+    itself as a producer of its own transport, so Twisted tells us when
+    the client doesn't read its data. Reading from such client is paused
+    and broadcasts are skipped; the latest job is sent once client catches up.
+    
+    With coalesce_writes, messages written in the same reactor turn (e.g. set_difficulty,
+    notify and submit responses) are joined and handed to the transport by single write().
+    Responses are serialized by the proxy's JSON codec.'''
+
+    def connectionMade(self):
+        Protocol.connectionMade(self)
+        self.paused = False
+        self.missed_broadcast = False
+        self.out_buffer = None # Messages waiting for the end of reactor turn
+        self.out_size = 0
+
+        # Twisted calls pauseProducing() once more than bufferSize bytes wait in the transport
+        self.transport.bufferSize = self.factory.write_buffer
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        self.factory.connection_lost(self)
+        Protocol.connectionLost(self, reason)
+
+    def pauseProducing(self):
+        if self.paused:
+            return
+
+        self.paused = True
+        self.factory.paused += 1
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        if not self.paused:
+            return
+
+        self.paused = False
+        self.factory.paused -= 1
+        self.transport.resumeProducing()
+
+        if self.missed_broadcast:
+            self.missed_broadcast = False
+            if self.factory.on_resume != None:
+                self.factory.on_resume(self)
+
+    def stopProducing(self):
+        pass
+
+    def writeJsonResponse(self, data, message_id, use_signature=False, sign_method='', sign_params=[]):
+        if use_signature:
+            return Protocol.writeJsonResponse(self, data, message_id, use_signature, sign_method, sign_params)
+        
+        serialized = jsoncodec.dumps({'id': message_id, 'result': data, 'error': None})
+        if self.factory.debug:
+            log.debug("< %s" % serialized)
+        self.transport_write("%s\n" % serialized)
+    
+    def writeJsonError(self, code, message, traceback, message_id, use_signature=False, sign_method='', sign_params=[]):
+        if use_signature:
+            return Protocol.writeJsonError(self, code, message, traceback, message_id, use_signature, sign_method, sign_params)
+        
+        serialized = jsoncodec.dumps({'id': message_id, 'result': None, 'error': (code, message, traceback)})
+        self.transport_write("%s\n" % serialized)
+    
+    def transport_write(self, data):
+        if not self.factory.coalesce_writes:
+            Protocol.transport_write(self, data)
+            return
+        
+        if self.out_buffer == None:
+            self.out_buffer = [data]
+            self.out_size = len(data)
+            self.factory.coalescer.schedule(self)
+        else:
+            self.out_buffer.append(data)
+            self.out_size += len(data)
+        
+        if self.out_size >= COALESCE_LIMIT:
+            self.flush()
+    
+    def flush(self):
+        if self.out_buffer == None:
+            return
+        
+        data = ''.join(self.out_buffer)
+        self.out_buffer = None
+        self.out_size = 0
+        
+        # Protocol.transport_write() handles connection closed in the meantime
+        Protocol.transport_write(self, data)
+
+    def write_broadcast(self, data):
+        '''Write message which is superseded by the next broadcast anyway'''
+        if self.paused:
+            self.missed_broadcast = True
+            return
+        self.transport_write(data)
+
+class AdmissionControlFactory(SocketTransportFactory):
+    '''Listener factory limiting number of connections (in total and per IP)
+    and rate of new connections. When the rate is exceeded, listening
+    is suspended for a while and clients wait in kernel's backlog.'''
+
+    def __init__(self, max_connections=0, max_per_ip=0, connection_rate=0, request_rate=0, on_resume=None,
+                 coalesce_writes=False, write_buffer=WRITE_BUFFER_HIGH, **kwargs):
+        SocketTransportFactory.__init__(self, **kwargs)
+        self.protocol = DownstreamProtocol
+        self.coalesce_writes = coalesce_writes # Join messages written in the same reactor turn
+        self.coalescer = WriteCoalescer()
+        self.write_buffer = write_buffer # Bytes waiting for slow client which pause it
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.bucket = TokenBucket(connection_rate) if connection_rate else None
+        self.limiter = RateLimiter(request_rate) if request_rate else None # For subscribe/authorize
+        self.on_resume = on_resume # Called with connection which missed some broadcast
+        self.port = None # Listening port, set by caller
+
+        self.connections = 0
+        self.per_ip = {}
+        self.paused = 0 # Connections with full write buffer
+        self.refused = 0 # Refused connections
+        self._last_log = 0
+
+    def _refuse(self, reason):
+        self.refused += 1
+        if time.time() - self._last_log > 10:
+            # Don't flood the log during reconnect storms
+            self._last_log = time.time()
+            log.warning("Refusing connection (%s), %d connections refused so far" % (reason, self.refused))
+        return None
+
+    def _resume_listening(self):
+        if self.port != None:
+            self.port.startReading()
+
+    def buildProtocol(self, addr):
+        if self.max_connections and self.connections >= self.max_connections:
+            return self._refuse("too many connections")
+
+        if self.max_per_ip and self.per_ip.get(addr.host, 0) >= self.max_per_ip:
+            return self._refuse("too many connections from %s" % addr.host)
+
+        if self.bucket != None and not self.bucket.consume():
+            if self.port != None:
+                # Stop accepting for a while, other clients wait in kernel's backlog
+                self.port.stopReading()
+                reactor.callLater(self.bucket.delay(), self._resume_listening)
+            return self._refuse("connection rate exceeded")
+
+        p = SocketTransportFactory.buildProtocol(self, addr)
+        p.admission_ip = addr.host
+        self.connections += 1
+        self.per_ip[addr.host] = self.per_ip.get(addr.host, 0) + 1
+        return p
+
+    def connection_lost(self, conn):
+        self.connections -= 1
+        if conn.paused:
+            self.paused -= 1
+
+        count = self.per_ip.get(conn.admission_ip, 0) - 1
+        if count > 0:
+            self.per_ip[conn.admission_ip] = count
+        else:
+            self.per_ip.pop(conn.admission_ip, None)
+
+    def get_load(self):
+        '''Returns (connected miners, capacity), capacity is None when unlimited'''
+        return (self.connections, self.max_connections or None)
+
+    def get_stats(self):
+        stats = {'connections': self.connections, 'paused': self.paused, 'refused': self.refused,
+                 'backlog': 0, 'shed': 0}
+        if self.limiter != None:
+            stats.update({'backlog': len(self.limiter.backlog), 'shed': self.limiter.shed})
+        return stats
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+'''
+    Fake Stratum mining pool for load and regression testing of the proxy.
+
+    Sends generated jobs and difficulty changes, validates submitted shares
+    the same way as real pool does and can simulate bad network
+    (latency, lost responses, disconnects) and client.reconnect requests.
+
+    In-process usage:
+        pool = FakePool(job_interval=5, difficulty=[1, 2])
+        port = reactor.listenTCP(0, pool).getHost().port
+        pool.start()
+
+    Standalone: python mining_libs/fake_pool.py --port 3333 --help
+'''
+
+import binascii
+import json
+import random
+import time
+
+from twisted.internet import reactor, protocol, task, defer
+from twisted.protocols.basic import LineReceiver
+
+from jobs import Job
+from target import difficulty_to_target
+import utils
+
+import stratum.logger
+log = stratum.logger.get_logger('proxy')
+
+# Jobs older than this count are forgotten, shares for them are stale
+MAX_JOBS = 50
+
+class FakePoolError(Exception):
+    '''Error codes used by real Stratum pools'''
+    OTHER = 20
+    JOB_NOT_FOUND = 21
+    DUPLICATE_SHARE = 22
+    LOW_DIFFICULTY = 23
+    UNAUTHORIZED = 24
+    NOT_SUBSCRIBED = 25
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+class FakePoolProtocol(LineReceiver):
+    delimiter = '\n'
+    MAX_LENGTH = 64 * 1024
+
+    def connectionMade(self):
+        self.extranonce1 = self.factory.next_extranonce1()
+        self.subscribed = False
+        self.workers = set()
+        self.difficulty = None
+        self.previous_difficulty = None
+        self.send_after = 0 # Delayed messages must keep their order
+        self.factory.conns.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.conns.remove(self)
+
+    def send(self, payload):
+        if self.transport != None and self.connected:
+            self.transport.write(payload + '\n')
+
+    def notify(self, method, params):
+        self.factory.deliver(self, json.dumps({'id': None, 'method': method, 'params': params}), response=False)
+
+    def set_difficulty(self, difficulty):
+        if difficulty != self.difficulty:
+            self.previous_difficulty = self.difficulty
+            self.difficulty = difficulty
+            self.notify('mining.set_difficulty', [difficulty])
+
+    def lineReceived(self, line):
+        if not line.strip():
+            return
+
+        try:
+            msg = json.loads(line)
+            (msg_id, method, params) = (msg['id'], msg['method'], msg.get('params') or [])
+        except (ValueError, KeyError, TypeError):
+            # Real Stratum servers close the connection on unknown payload,
+            # proxy's Stratum autodetection relies on that
+            self.transport.loseConnection()
+            return
+
+        try:
+            handler = getattr(self, 'rpc_' + method.replace('.', '_'), None)
+            if handler == None:
+                raise FakePoolError(FakePoolError.OTHER, "Method '%s' not found" % method)
+            result = handler(*params)
+        except FakePoolError as exc:
+            response = {'id': msg_id, 'result': None, 'error': [exc.code, str(exc), None]}
+        except TypeError:
+            response = {'id': msg_id, 'result': None, 'error': [FakePoolError.OTHER, "Invalid params", None]}
+        else:
+            response = {'id': msg_id, 'result': result, 'error': None}
+
+        self.factory.deliver(self, json.dumps(response), response=True)
+
+        if method == 'mining.subscribe' and response['error'] == None:
+            self.factory.on_subscribed(self)
+
+    def rpc_mining_subscribe(self, *args):
+        self.subscribed = True
+        return [[['mining.set_difficulty', '%x' % id(self)], ['mining.notify', '%x' % id(self)]],
+                self.extranonce1, self.factory.extranonce2_size]
+
+    def rpc_mining_authorize(self, worker_name, password=None, *args):
+        if self.factory.authorize != None and not self.factory.authorize(worker_name, password):
+            return False
+        self.workers.add(worker_name)
+        return True
+
+    def rpc_mining_submit(self, worker_name, job_id, extranonce2, ntime, nonce, *args):
+        try:
+            self.factory.validate_share(self, worker_name, job_id, extranonce2, ntime, nonce)
+        except FakePoolError as exc:
+            self.factory.rejected[str(exc)] = self.factory.rejected.get(str(exc), 0) + 1
+            raise
+
+        self.factory.accepted += 1
+        return True
+
+    def rpc_mining_extranonce_subscribe(self, *args):
+        return False
+
+class FakePool(protocol.ServerFactory):
+    '''Fake Stratum pool, ServerFactory to be used with reactor.listenTCP()
+
+    job_interval         seconds between jobs (0 = jobs are added by add_job() only)
+    block_interval       seconds between new blocks (clean_jobs=True)
+    merkle_depth         length of merkle branch of every job
+    coinbase_size        length of coinb1 + coinb2 in bytes
+    extranonce2_size     extranonce2 size for clients
+    difficulty           list of share difficulties, cycled every difficulty_interval seconds
+    latency, jitter      delay of every message sent to clients (seconds)
+    loss                 probability that a response is never sent
+    disconnect_interval  every this many seconds a random client is disconnected (0 = never)
+    reconnect_interval   every this many seconds clients are asked to client.reconnect (0 = never)
+    reconnect_to         (host, port, wait) sent in client.reconnect, empty host/port means the same
+    authorize            callable(worker_name, password) deciding about authorization, all workers pass by default
+    seed                 seed of random generator, for reproducible jobs and faults'''
+
+    protocol = FakePoolProtocol
+
+    def __init__(self, job_interval=30, block_interval=600, merkle_depth=12, coinbase_size=100,
+                 extranonce2_size=4, difficulty=(1,), difficulty_interval=0,
+                 latency=0, jitter=0, loss=0, disconnect_interval=0, reconnect_interval=0,
+                 reconnect_to=('', 0, 0), authorize=None, seed=None):
+        self.job_interval = job_interval
+        self.block_interval = block_interval
+        self.merkle_depth = merkle_depth
+        self.coinbase_size = coinbase_size
+        self.extranonce2_size = extranonce2_size
+        self.difficulties = list(difficulty)
+        self.difficulty_interval = difficulty_interval
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.disconnect_interval = disconnect_interval
+        self.reconnect_interval = reconnect_interval
+        self.reconnect_to = reconnect_to
+        self.authorize = authorize
+        self.rnd = random.Random(seed)
+
+        self.conns = []
+        self.extranonce1_counter = 0
+        self.difficulty = self.difficulties[0]
+        self.difficulty_index = 0
+
+        self.jobs = {} # job_id -> Job, valid (not stale) jobs only
+        self.job_order = [] # job_ids from the oldest
+        self.last_notify = None
+        self.job_counter = 0
+        self.prevhash = None
+        self.last_block = 0
+        self.shares = set() # Submitted shares of valid jobs, for duplicates detection
+
+        self.accepted = 0
+        self.rejected = {} # Reason -> count
+        self.lost = 0 # Responses dropped on purpose
+        self.first_subscribe = defer.Deferred()
+        self.timers = []
+
+    def start(self):
+        '''Start generating jobs and scheduled network faults'''
+        if not self.job_order and self.job_interval:
+            self.new_job()
+
+        for (interval, func) in ((self.job_interval, self.new_job),
+                                 (self.difficulty_interval, self.next_difficulty),
+                                 (self.disconnect_interval, self.disconnect_random),
+                                 (self.reconnect_interval, self.send_reconnect)):
+            if interval:
+                timer = task.LoopingCall(func)
+                timer.start(interval, now=False)
+                self.timers.append(timer)
+
+    def stop(self):
+        for timer in self.timers:
+            timer.stop()
+        self.timers = []
+
+    def next_extranonce1(self):
+        self.extranonce1_counter += 1
+        return '%08x' % self.extranonce1_counter
+
+    def deliver(self, conn, payload, response):
+        '''Send the payload to client, with simulated network faults'''
+        if response and self.loss and self.rnd.random() < self.loss:
+            self.lost += 1
+            return
+
+        delay = self.latency + (self.rnd.uniform(0, self.jitter) if self.jitter else 0)
+        if not delay and conn.send_after <= time.time():
+            conn.send(payload)
+            return
+
+        now = time.time()
+        conn.send_after = max(now + delay, conn.send_after)
+        reactor.callLater(conn.send_after - now, conn.send, payload)
+
+    def on_subscribed(self, conn):
+        conn.set_difficulty(self.difficulty)
+        if self.last_notify != None:
+            conn.notify('mining.notify', self.last_notify[:-1] + [True])
+
+        if not self.first_subscribe.called:
+            self.first_subscribe.callback(conn)
+
+    def _randhex(self, size):
+        return ''.join( chr(self.rnd.randint(0, 255)) for _ in range(size) ).encode('hex')
+
+    def new_job(self, clean_jobs=None):
+        '''Generate new job and send it to clients'''
+        if clean_jobs == None:
+            clean_jobs = self.prevhash == None or \
+                (self.block_interval and time.time() - self.last_block >= self.block_interval)
+
+        if clean_jobs:
+            self.prevhash = self._randhex(32)
+            self.last_block = time.time()
+
+        self.job_counter += 1
+        coinb1_size = self.coinbase_size / 2
+        params = ['%x' % self.job_counter, self.prevhash, self._randhex(coinb1_size),
+                  self._randhex(self.coinbase_size - coinb1_size),
+                  [ self._randhex(32) for _ in range(self.merkle_depth) ],
+                  '00000002', '1a0abbcc', '%08x' % int(time.time()), clean_jobs]
+        self.add_job(params)
+
+    def add_job(self, params):
+        '''Send job given by mining.notify params to clients'''
+        (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs) = params[:9]
+        job = Job.build_from_broadcast(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime)
+
+        if clean_jobs:
+            self.jobs.clear()
+            self.job_order = []
+            self.shares.clear()
+
+        self.jobs[job_id] = job
+        self.job_order.append(job_id)
+        while len(self.job_order) > MAX_JOBS:
+            del self.jobs[self.job_order.pop(0)]
+
+        self.last_notify = list(params[:9])
+        for conn in self.conns:
+            if conn.subscribed:
+                conn.notify('mining.notify', self.last_notify)
+
+    def set_difficulty(self, difficulty):
+        '''Change difficulty of all clients'''
+        self.difficulty = difficulty
+        for conn in self.conns:
+            if conn.subscribed:
+                conn.set_difficulty(difficulty)
+
+    def next_difficulty(self):
+        self.difficulty_index = (self.difficulty_index + 1) % len(self.difficulties)
+        self.set_difficulty(self.difficulties[self.difficulty_index])
+
+    def disconnect_random(self):
+        if self.conns:
+            conn = self.rnd.choice(self.conns)
+            log.info("Fake pool disconnects client with extranonce1 %s" % conn.extranonce1)
+            conn.transport.loseConnection()
+
+    def send_reconnect(self):
+        for conn in self.conns:
+            conn.notify('client.reconnect', list(self.reconnect_to))
+
+    def validate_share(self, conn, worker_name, job_id, extranonce2, ntime, nonce):
+        if not conn.subscribed:
+            raise FakePoolError(FakePoolError.NOT_SUBSCRIBED, "Not subscribed")
+
+        if worker_name not in conn.workers:
+            raise FakePoolError(FakePoolError.UNAUTHORIZED, "Unauthorized worker")
+
+        job = self.jobs.get(job_id)
+        if job == None:
+            raise FakePoolError(FakePoolError.JOB_NOT_FOUND, "Job not found")
+
+        if len(extranonce2) != self.extranonce2_size * 2:
+            raise FakePoolError(FakePoolError.OTHER, "Incorrect size of extranonce2")
+
+        if len(ntime) != 8 or len(nonce) != 8:
+            raise FakePoolError(FakePoolError.OTHER, "Incorrect size of ntime or nonce")
+
+        share = (job_id, conn.extranonce1, extranonce2, ntime, nonce)
+        if share in self.shares:
+            raise FakePoolError(FakePoolError.DUPLICATE_SHARE, "Duplicate share")
+
+        try:
+            extranonce = binascii.unhexlify(conn.extranonce1 + extranonce2)
+            header_bin = binascii.unhexlify(job.build_header(extranonce, ntime, nonce))
+        except TypeError:
+            raise FakePoolError(FakePoolError.OTHER, "Malformed share")
+
+        # Share for previous difficulty is fine until the client receives the new one
+        target = difficulty_to_target(conn.difficulty)
+        if conn.previous_difficulty != None:
+            target = max(target, difficulty_to_target(conn.previous_difficulty))
+
+        if utils.uint256_from_str(utils.header_hash(header_bin)) > target:
+            raise FakePoolError(FakePoolError.LOW_DIFFICULTY, "Low difficulty share")
+
+        self.shares.add(share)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Fake Stratum mining pool for testing the proxy')
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1', help='Listen on this interface')
+    parser.add_argument('--port', dest='port', type=int, default=3333, help='Listen on this port')
+    parser.add_argument('--job-interval', dest='job_interval', type=float, default=30, help='Seconds between jobs')
+    parser.add_argument('--block-interval', dest='block_interval', type=float, default=600, help='Seconds between blocks')
+    parser.add_argument('--merkle-depth', dest='merkle_depth', type=int, default=12, help='Length of merkle branch')
+    parser.add_argument('--coinbase-size', dest='coinbase_size', type=int, default=100, help='Bytes of coinbase without extranonce')
+    parser.add_argument('--extranonce2-size', dest='extranonce2_size', type=int, default=4, help='Bytes of extranonce2')
+    parser.add_argument('--difficulty', dest='difficulty', type=float, nargs='+', default=[1], help='Share difficulties, cycled every --difficulty-interval')
+    parser.add_argument('--difficulty-interval', dest='difficulty_interval', type=float, default=0, help='Seconds between difficulty changes')
+    parser.add_argument('--latency', dest='latency', type=float, default=0, help='Delay of every message in seconds')
+    parser.add_argument('--jitter', dest='jitter', type=float, default=0, help='Random extra delay of every message in seconds')
+    parser.add_argument('--loss', dest='loss', type=float, default=0, help='Probability of lost response')
+    parser.add_argument('--disconnect-interval', dest='disconnect_interval', type=float, default=0, help='Disconnect random client every this many seconds')
+    parser.add_argument('--reconnect-interval', dest='reconnect_interval', type=float, default=0, help='Send client.reconnect every this many seconds')
+    parser.add_argument('--seed', dest='seed', type=int, help='Seed of random generator')
+    args = parser.parse_args()
+
+    pool = FakePool(job_interval=args.job_interval, block_interval=args.block_interval, merkle_depth=args.merkle_depth,
+                    coinbase_size=args.coinbase_size, extranonce2_size=args.extranonce2_size, difficulty=args.difficulty,
+                    difficulty_interval=args.difficulty_interval, latency=args.latency, jitter=args.jitter, loss=args.loss,
+                    disconnect_interval=args.disconnect_interval, reconnect_interval=args.reconnect_interval, seed=args.seed)
+    reactor.listenTCP(args.port, pool, interface=args.host)
+    pool.start()
+
+    def print_stats():
+        log.info("Fake pool: %d clients, %d shares accepted, rejected %s, %d responses lost" % \
+                 (len(pool.conns), pool.accepted, pool.rejected, pool.lost))
+    task.LoopingCall(print_stats).start(60, now=False)
+
+    log.warning("Fake Stratum pool listening on %s:%d" % (args.host, args.port))
+    reactor.run()
@@ -1,18 +1,36 @@
-import json
 import time
 
 from twisted.internet import defer
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
+from jobs import ExtranonceExhausted
+import recorder
+import jsoncodec
+
 import stratum.logger
 log = stratum.logger.get_logger('proxy')
 
+# Templates of getwork responses, hash1 and target are the same for many responses
+MAX_TEMPLATES = 100
+
+def build_getwork_template(hash1, target, midstate):
+    '''Response with %s placeholders for id, data and (optionally) midstate'''
+    fields = ['"data": "%s"', '"hash1": %s' % jsoncodec.dumps(hash1), '"target": %s' % jsoncodec.dumps(target)]
+    if midstate:
+        fields.append('"midstate": "%s"')
+    return '{"id": %%s, "result": {%s}, "error": null}' % ', '.join(fields)
+
+def encode_id(msg_id):
+    if type(msg_id) is int:
+        return str(msg_id)
+    return jsoncodec.dumps(msg_id)
+
 class Root(Resource):
     isLeaf = True
     
     def __init__(self, job_registry, workers, stratum_host, stratum_port,
-                 custom_stratum=None, custom_lp=None, custom_user=None, custom_password=''):
+                 custom_stratum=None, custom_lp=None, custom_user=None, custom_password='', roll_ntime=0):
         Resource.__init__(self)
         self.job_registry = job_registry
         self.workers = workers
@@ -22,14 +40,34 @@ class Root(Resource):
         self.custom_lp = custom_lp
         self.custom_user = custom_user
         self.custom_password = custom_password
+        self.roll_ntime = roll_ntime
+        self.templates = {} # (hash1, target, midstate) -> getwork response template
         
     def json_response(self, msg_id, result):
-        resp = json.dumps({'id': msg_id, 'result': result, 'error': None})
+        resp = jsoncodec.dumps({'id': msg_id, 'result': result, 'error': None})
         #print "RESPONSE", resp
         return resp
     
+    def getwork_response(self, msg_id, no_midstate):
+        '''Serialized getwork, only fields changing with every work
+        are formatted into the template'''
+        result = self.job_registry.getwork(no_midstate=no_midstate)
+        midstate = result.get('midstate')
+        
+        key = (result['hash1'], result['target'], midstate != None)
+        template = self.templates.get(key)
+        if template == None:
+            if len(self.templates) >= MAX_TEMPLATES:
+                self.templates.clear()
+            template = self.templates[key] = build_getwork_template(*key)
+        
+        # Hex strings don't need escaping
+        if midstate != None:
+            return template % (encode_id(msg_id), str(result['data']), midstate)
+        return template % (encode_id(msg_id), str(result['data']))
+        
     def json_error(self, msg_id, code, message):
-        resp = json.dumps({'id': msg_id, 'result': None, 'error': {'code': code, 'message': message}})
+        resp = jsoncodec.dumps({'id': msg_id, 'result': None, 'error': {'code': code, 'message': message}})
         #print "ERROR", resp
         return resp         
     
@@ -64,7 +102,7 @@ class Root(Resource):
                  (response_time, worker_name, failure.getErrorMessage()))
         
     def _on_authorized(self, is_authorized, request, worker_name):
-        data = json.loads(request.content.read())
+        data = jsoncodec.loads(request.content.read())
         
         if not is_authorized:
             request.write(self.json_error(data.get('id', 0), -1, "Bad worker credentials"))
@@ -82,15 +120,20 @@ class Root(Resource):
                                 
                 # getwork request
                 log.info("Worker '%s' asks for new work" % worker_name)
+                recorder.record('getwork', 'getwork', [worker_name])
                 extensions = request.getHeader('x-mining-extensions')
                 no_midstate =  extensions and 'midstate' in extensions
-                request.write(self.json_response(data.get('id', 0), self.job_registry.getwork(no_midstate=no_midstate)))
+                try:
+                    request.write(self.getwork_response(data.get('id', 0), no_midstate))
+                except ExtranonceExhausted as exc:
+                    request.write(self.json_error(data.get('id', 0), -1, str(exc)))
                 request.finish()
                 return
             
             else:
                 
                 # submit
+                recorder.record('getwork', 'getwork.submit', [worker_name])
                 d = defer.maybeDeferred(self.job_registry.submit, data['params'][0], worker_name)
 
                 start_time = time.time()
@@ -98,6 +141,31 @@ class Root(Resource):
                 d.addErrback(self._on_submit_failure, request, data.get('id', 0), data['params'][0][:160], worker_name, start_time)
                 return
             
+        if data['method'] == 'mining.lease':
+            # Lease of extranonce2 range, miner generates work by itself
+            try:
+                count = int((data.get('params') or [self.job_registry.MAX_LEASE])[0])
+                result = self.job_registry.lease(count, worker_name)
+            except Exception as exc:
+                request.write(self.json_error(data.get('id', 0), -1, str(exc)))
+                request.finish()
+                return
+            
+            log.info("Worker '%s' leased %d extranonce2 values" % (worker_name, result['extranonce2_count']))
+            request.write(self.json_response(data.get('id', 0), result))
+            request.finish()
+            return
+        
+        if data['method'] == 'mining.submit_lease':
+            # params: job_id, extranonce2, ntime, nonce
+            params = data.get('params', [])[:4]
+            d = defer.maybeDeferred(self.job_registry.submit_lease, *(params + [worker_name]))
+            
+            start_time = time.time()
+            d.addCallback(self._on_submit, request, data.get('id', 0), params, worker_name, start_time)
+            d.addErrback(self._on_submit_failure, request, data.get('id', 0), params, worker_name, start_time)
+            return
+            
         request.write(self.json_error(data.get('id'), -1, "Unsupported method '%s'" % data['method']))
         request.finish()
         
@@ -119,7 +187,8 @@ class Root(Resource):
         else:
             request.setHeader('x-long-polling', '/lp')
             
-        request.setHeader('x-roll-ntime', 1)
+        if self.roll_ntime:
+            request.setHeader('x-roll-ntime', 'expire=%d' % self.roll_ntime)
         
     def _on_lp_broadcast(self, _, request):        
         try:
@@ -130,7 +199,10 @@ class Root(Resource):
         log.info("LP broadcast for worker '%s'" % worker_name)
         extensions = request.getHeader('x-mining-extensions')
         no_midstate =  extensions and 'midstate' in extensions
-        payload = self.json_response(0, self.job_registry.getwork(no_midstate=no_midstate))
+        try:
+            payload = self.getwork_response(0, no_midstate)
+        except ExtranonceExhausted as exc:
+            payload = self.json_error(0, -1, str(exc))
         
         try:
             request.write(payload)
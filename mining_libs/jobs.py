@@ -1,46 +1,75 @@
 import binascii
+import bisect
+import collections
 import time
 import struct
-import subprocess
 import weakref
 
 from twisted.internet import defer
 
 import utils
+import blocknotify
+from target import get_target
 
 import stratum.logger
 log = stratum.logger.get_logger('proxy')
 
-# This fix py2exe issue with packaging the midstate module
-from midstate import calculateMidstate as __unusedimport
-
 try:
-    from midstatec import test as midstateTest, midstate as calculateMidstate
+    from midstatec import test as midstateTest, midstate as calculateMidstate, paths as midstatePaths, \
+        midstate_prefix as calculatePrefixState, midstate_finish as finishMidstate
     if not midstateTest():
         log.warning("midstate library didn't passed self test!")
         raise ImportError("midstatec not usable")
-    log.info("Using C extension for midstate speedup. Good!")
+    log.info("Using C extension for midstate speedup (%s code path). Good!" % midstatePaths()[0])
 except ImportError:
-    log.info("C extension for midstate not available. Using default implementation instead.")
-    try:    
-        from midstate import calculateMidstate
+    try:
+        from midstate_openssl import calculateMidstate
+        # SHA256_Transform() always runs all rounds, there's no use of prefix state
+        calculatePrefixState = finishMidstate = None
+        log.info("C extension for midstate not available. Using OpenSSL implementation instead.")
     except ImportError:
-        calculateMidstate = None
-        log.exception("No midstate generator available. Some old miners won't work properly.")
+        log.info("C extension for midstate not available. Using default implementation instead.")
+        try:
+            # Pure-Python fallback is imported only when it's really needed
+            from midstate import calculateMidstate, calculatePrefixState, finishMidstate
+        except ImportError:
+            calculateMidstate = calculatePrefixState = finishMidstate = None
+            log.exception("No midstate generator available. Some old miners won't work properly.")
+
+class ExtranonceExhausted(Exception):
+    '''No unique work left in the job until the pool sends the next one'''
+    pass
 
 class Job(object):
+    '''Job received from the pool, decoded just once and shared by getwork
+    and Stratum interfaces. Broadcast data aren't modified after the job is built,
+    only getwork bookkeeping (extranonce2 counter, merkle lookup) changes.'''
+    
+    __slots__ = ('job_id', 'prevhash', 'coinb1_bin', 'coinb2_bin', 'merkle_branch', 'version',
+                 'nbits', 'ntime_delta', 'ntime_min', 'ntime_max', 'broadcast_params', 'target', 'generation', 'received',
+                 'extranonce2', 'merkle_to_extranonce2', 'leases', 'midstate_prefix', 'exhausted', '__weakref__')
+    
     def __init__(self):
         self.job_id = None
         self.prevhash = ''
         self.coinb1_bin = ''
         self.coinb2_bin = ''
-        self.merkle_branch = []
+        self.merkle_branch = ()
         self.version = 1
         self.nbits = 0
         self.ntime_delta = 0
+        self.ntime_min = 0 # ntime provided by the pool
+        self.ntime_max = 0 # Highest ntime which getwork miners may roll to
+        self.broadcast_params = None # Original (hex) params of mining.notify, without clean_jobs
+        self.target = None # Target of shares valid when the job has been received
+        self.generation = None # JobStore generation (prevhash counter) of the job
+        self.received = None # Timestamp of job arrival
         
         self.extranonce2 = 0
         self.merkle_to_extranonce2 = {} # Relation between merkle_hash and extranonce2
+        self.leases = [] # Extranonce2 ranges leased to miners, (first, last, owner) sorted by first
+        self.midstate_prefix = None # SHA-256 state over version and prevhash, computed by first getwork
+        self.exhausted = False # Exhaustion of extranonce2 space has been logged
 
     @classmethod
     def build_from_broadcast(cls, job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime):
@@ -50,16 +79,55 @@ class Job(object):
         job.prevhash = prevhash
         job.coinb1_bin = binascii.unhexlify(coinb1)
         job.coinb2_bin = binascii.unhexlify(coinb2)
-        job.merkle_branch = [ binascii.unhexlify(tx) for tx in merkle_branch ]
+        job.merkle_branch = tuple([ binascii.unhexlify(tx) for tx in merkle_branch ])
         job.version = version
         job.nbits = nbits
         job.ntime_delta = int(ntime, 16) - int(time.time()) 
+        job.ntime_min = job.ntime_max = int(ntime, 16)
+        job.broadcast_params = (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime)
         return job
 
-    def increase_extranonce2(self):
+    def extend_ntime_range(self, ntime):
+        '''Allow miners to roll ntime up to given value'''
+        if ntime > self.ntime_max:
+            self.ntime_max = ntime
+            
+    def is_ntime_valid(self, ntime):
+        return self.ntime_min <= ntime <= self.ntime_max
+    
+    def increase_extranonce2(self, max_extranonce2):
+        '''Returns next extranonce2 or None when the extranonce2 space of the job is exhausted'''
+        if self.extranonce2 >= max_extranonce2:
+            return None
         self.extranonce2 += 1
         return self.extranonce2
 
+    def lease_extranonce2(self, count, owner, max_extranonce2):
+        '''Reserve next count of extranonce2 values for the owner.
+        Returns the first one.'''
+        first = self.extranonce2 + 1
+        last = first + count - 1
+        if last > max_extranonce2:
+            raise ExtranonceExhausted("Extranonce2 space of the job is exhausted")
+        
+        self.extranonce2 = last
+        self.leases.append((first, last, owner))
+        return first
+    
+    def get_lease_owner(self, extranonce2):
+        '''Return owner of the lease containing given extranonce2 or None'''
+        i = bisect.bisect_right(self.leases, (extranonce2, float('inf'))) - 1
+        if i >= 0 and extranonce2 <= self.leases[i][1]:
+            return self.leases[i][2]
+        return None
+    
+    def drop_work(self):
+        '''Forget getwork and lease bookkeeping once the job is stale,
+        shares of stale jobs are rejected without looking at it'''
+        self.merkle_to_extranonce2 = {}
+        self.leases = []
+        self.midstate_prefix = None
+        
     def build_coinbase(self, extranonce):
         return self.coinb1_bin + extranonce + self.coinb2_bin
     
@@ -78,50 +146,127 @@ class Job(object):
         r += binascii.hexlify(struct.pack(">I", nonce))
         r += '000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000' # padding    
         return r            
+
+    def get_midstate(self, header_bin):
+        '''Midstate of the first 64 bytes of header (getwork byte order).
+        Version and prevhash are the same for all headers of the job,
+        so rounds over them are computed just once.'''
+        if finishMidstate == None:
+            return calculateMidstate(header_bin)
+        if self.midstate_prefix == None:
+            self.midstate_prefix = calculatePrefixState(header_bin)
+        return finishMidstate(self.midstate_prefix, header_bin)
+
+    def build_header(self, extranonce, ntime, nonce):
+        '''Build blockheader (hex, getwork byte order, without padding)
+        from full extranonce and ntime/nonce in hex, as submitted by Stratum miners.'''
+        coinbase_hash = utils.doublesha(self.build_coinbase(extranonce))
+        merkle_root = binascii.hexlify(utils.reverse_hash(self.build_merkle_root(coinbase_hash)))
+        return self.version + self.prevhash + merkle_root + ntime + self.nbits + nonce
+        
+class JobStore(object):
+    '''Recent jobs indexed by job_id, shared by getwork and Stratum interfaces.
+    
+    Jobs of previous blocks are invalidated by increasing the generation
+    counter, which drops their getwork bookkeeping too. Old entries are dropped
+    lazily once there's more than max_jobs of them or they're older than max_age seconds.'''
+    
+    def __init__(self, max_jobs=100, max_age=3600):
+        self.max_jobs = max_jobs
+        self.max_age = max_age
+        self.generation = 0 # Increased on every new block
+        self.jobs = collections.OrderedDict() # job_id -> Job, oldest first
+        self.last_job = None
         
+    def add(self, job, clean_jobs):
+        if clean_jobs:
+            self.generation += 1
+            for stale in self.jobs.itervalues():
+                stale.drop_work()
+            
+        job.generation = self.generation
+        job.received = time.time()
+        
+        self.jobs.pop(job.job_id, None) # Keep insertion order when pool reuses job_id
+        self.jobs[job.job_id] = job
+        self.last_job = job
+        self._expire(job.received - self.max_age)
+        
+    def _expire(self, min_received):
+        while self.jobs:
+            oldest = next(self.jobs.itervalues())
+            if oldest is self.last_job:
+                break
+            if len(self.jobs) <= self.max_jobs and oldest.received >= min_received:
+                break
+            self.jobs.popitem(last=False)
+            
+    def get(self, job_id):
+        '''Return job for given job_id or None when the job is unknown'''
+        return self.jobs.get(job_id)
+    
+    def is_stale(self, job):
+        '''Job belongs to some previous block'''
+        return job.generation != self.generation
+    
 class JobRegistry(object):   
-    def __init__(self, f, cmd, no_midstate, real_target, use_old_target=False, scrypt_target=False):
+    MAX_LEASE = 0x10000 # Maximum count of extranonce2 values leased at once
+    
+    def __init__(self, f, cmd, no_midstate, real_target, use_old_target=False, scrypt_target=False, roll_ntime=0):
         self.f = f
         self.cmd = cmd # execute this command on new block
+        self.notifier = blocknotify.BlockNotifier(cmd) if cmd else None
         self.scrypt_target = scrypt_target # calculate target for scrypt algorithm instead of sha256
         self.no_midstate = no_midstate # Indicates if calculate midstate for getwork
         self.real_target = real_target # Indicates if real stratum target will be propagated to miners
         self.use_old_target = use_old_target # Use 00000000fffffff...f instead of correct 00000000ffffffff...0 target for really old miners
-        self.jobs = []        
+        self.roll_ntime = roll_ntime # For how many seconds getwork miners can roll ntime of given work
+        self.job_store = JobStore()
         self.last_job = None
         self.extranonce1 = None
         self.extranonce1_bin = None
         self.extranonce2_size = None
+        self.reserved_size = 0 # Leading bytes of extranonce2 used by Stratum tails
         
-        self.target = 0
-        self.target_hex = ''
+        self.target = None # Target of current difficulty
+        self.target1 = get_target(1, scrypt_target)
+        self.getwork_target = None # Target field of getwork responses
         self.difficulty = 1
         self.set_difficulty(1)
-        self.target1_hex = self.target_hex
         
         # Relation between merkle and job
         self.merkle_to_job= weakref.WeakValueDictionary()
         
         # Hook for LP broadcasts
         self.on_block = defer.Deferred()
+        
+        # Deferreds waiting for the first job
+        self.job_waiters = []
 
     def execute_cmd(self, prevhash):
-        if self.cmd:
-            return subprocess.Popen(self.cmd.replace('%s', prevhash), shell=True)
+        if self.notifier != None:
+            self.notifier.notify(prevhash)
 
-    def set_extranonce(self, extranonce1, extranonce2_size):
+    def set_extranonce(self, extranonce1, extranonce2_size, reserved_size=0):
+        '''Getwork uses zero tail, so reserved_size leading bytes of extranonce2
+        have to stay zero to not collide with Stratum miners.'''
         self.extranonce2_size = extranonce2_size
+        self.reserved_size = reserved_size
+        self.extranonce1 = extranonce1
         self.extranonce1_bin = binascii.unhexlify(extranonce1)
         
     def set_difficulty(self, new_difficulty):
-        if self.scrypt_target:
-            dif1 = 0x0000ffff00000000000000000000000000000000000000000000000000000000
-        else:
-            dif1 = 0x00000000ffff0000000000000000000000000000000000000000000000000000
-        self.target = int(dif1 / new_difficulty)
-        self.target_hex = binascii.hexlify(utils.uint256_to_str(self.target))
+        self.target = get_target(new_difficulty, self.scrypt_target)
         self.difficulty = new_difficulty
         
+        # Target mode doesn't change, so getwork just picks the field
+        if self.use_old_target:
+            self.getwork_target = 'ffffffffffffffffffffffffffffffffffffffffffffffffffffffff00000000'
+        elif self.real_target:
+            self.getwork_target = self.target.getwork_hex
+        else:
+            self.getwork_target = self.target1.getwork_hex
+        
     def build_full_extranonce(self, extranonce2):
         '''Join extranonce1 and extranonce2 together while padding
         extranonce2 length to extranonce2_size (provided by server).'''        
@@ -146,13 +291,34 @@ class JobRegistry(object):
         # safe to add whitespaces
         return '\x00' * missing_len + extranonce2_bin 
     
+    def get_max_extranonce2(self):
+        '''Highest extranonce2 which fits into extranonce2_size without
+        reserved bytes (and into 32 bits used by extranonce2_padding)'''
+        return min(256 ** (self.extranonce2_size - self.reserved_size), 2 ** 32) - 1
+        
+    def wait_for_job(self):
+        '''Returns Deferred fired once there's a job for miners'''
+        if self.last_job != None:
+            return defer.succeed(self.last_job)
+        
+        d = defer.Deferred()
+        self.job_waiters.append(d)
+        return d
+        
     def add_template(self, template, clean_jobs):
+        # On clean_jobs, pool asked us to stop submitting shares from previous jobs,
+        # job store marks them as stale.
         if clean_jobs:
-            # Pool asked us to stop submitting shares from previous jobs
-            self.jobs = []
+            # Getworks of stale jobs aren't looked up anymore
+            self.merkle_to_job = weakref.WeakValueDictionary()
             
-        self.jobs.append(template)
+        template.target = self.target
+        self.job_store.add(template, clean_jobs)
         self.last_job = template
+        
+        waiters, self.job_waiters = self.job_waiters, []
+        for d in waiters:
+            d.callback(template)
                 
         if clean_jobs:
             # Force miners to reload jobs
@@ -165,7 +331,7 @@ class JobRegistry(object):
           
     def register_merkle(self, job, merkle_hash, extranonce2):
         # merkle_to_job is weak-ref, so it is cleaned up automatically
-        # when job is dropped
+        # when job is dropped from the job store
         self.merkle_to_job[merkle_hash] = job
         job.merkle_to_extranonce2[merkle_hash] = extranonce2
         
@@ -181,8 +347,15 @@ class JobRegistry(object):
         
         job = self.last_job # Pick the latest job from pool
 
-        # 1. Increase extranonce2
-        extranonce2 = job.increase_extranonce2()
+        # 1. Increase extranonce2, it must never carry into bytes of Stratum tails
+        max_extranonce2 = self.get_max_extranonce2()
+        extranonce2 = job.increase_extranonce2(max_extranonce2)
+        if extranonce2 == None:
+            # Repeated work would produce only duplicate shares
+            if not job.exhausted:
+                job.exhausted = True
+                log.warning("Extranonce2 space of job %s is exhausted, no getwork until the next job" % job.job_id)
+            raise ExtranonceExhausted("Extranonce2 space of the job is exhausted, wait for the next job")
         
         # 2. Build final extranonce
         extranonce = self.build_full_extranonce(extranonce2)
@@ -199,8 +372,9 @@ class JobRegistry(object):
         # 6. Generate current ntime
         ntime = int(time.time()) + job.ntime_delta
         
-        # 7. Serialize header
+        # 7. Serialize header and let miners roll ntime for a while
         block_header = job.serialize_header(merkle_root, ntime, 0)
+        job.extend_ntime_range(ntime + self.roll_ntime)
 
         # 8. Register job params
         self.register_merkle(job, merkle_root, extranonce2)
@@ -210,18 +384,12 @@ class JobRegistry(object):
         hash1 = "00000000000000000000000000000000000000000000000000000000000000000000008000000000000000000000000000000000000000000000000000010000"
 
         result = {'data': block_header,
-                'hash1': hash1}
-        
-        if self.use_old_target:
-            result['target'] = 'ffffffffffffffffffffffffffffffffffffffffffffffffffffffff00000000'
-        elif self.real_target:
-            result['target'] = self.target_hex
-        else:
-            result['target'] = self.target1_hex
+                'hash1': hash1,
+                'target': self.getwork_target}
     
         if calculateMidstate and not (no_midstate or self.no_midstate):
             # Midstate module not found or disabled
-            result['midstate'] = binascii.hexlify(calculateMidstate(header_bin))
+            result['midstate'] = binascii.hexlify(job.get_midstate(header_bin))
             
         return result            
         
@@ -231,14 +399,13 @@ class JobRegistry(object):
 
         # 1. Check if blockheader meets requested difficulty
         header_bin = binascii.unhexlify(header[:160])
-        rev = ''.join([ header_bin[i*4:i*4+4][::-1] for i in range(0, 20) ])
-        hash_bin = utils.doublesha(rev)
+        hash_bin = utils.header_hash(header_bin)
         block_hash = ''.join([ hash_bin[i*4:i*4+4][::-1] for i in range(0, 8) ])
         
         #log.info('!!! %s' % header[:160])
         log.info("Submitting %s" % utils.format_hash(binascii.hexlify(block_hash)))
         
-        if utils.uint256_from_str(hash_bin) > self.target:
+        if not self.target.is_met(hash_bin):
             log.debug("Share is below expected target")
             return True
         
@@ -248,6 +415,10 @@ class JobRegistry(object):
         except KeyError:
             log.info("Job not found")
             return False
+        
+        if self.job_store.is_stale(job):
+            log.info("Stale share")
+            return False
 
         # 3. Format extranonce2 to hex string
         extranonce2_hex = binascii.hexlify(self.extranonce2_padding(extranonce2))
@@ -257,6 +428,85 @@ class JobRegistry(object):
         noncepos = 19*8 # 19th integer in datastring       
         ntime = header[ntimepos:ntimepos+8] 
         nonce = header[noncepos:noncepos+8]
+        
+        try:
+            ntime_valid = job.is_ntime_valid(int(ntime, 16))
+        except ValueError:
+            ntime_valid = False
+            
+        if not ntime_valid:
+            log.info("ntime out of range")
+            return False
             
         # 5. Submit share to the pool
         return self.f.rpc('mining.submit', [worker_name, job.job_id, extranonce2_hex, ntime, nonce])
+
+    def lease(self, count, worker_name):
+        '''Lease block of extranonce2 values of the latest job to the miner,
+        which builds coinbases and blockheaders by itself then.
+        Extranonce2 is big-endian number padded to extranonce2_size bytes,
+        target is big-endian hex (not in getwork byte order).'''
+        
+        job = self.last_job
+        count = max(1, min(count, self.MAX_LEASE))
+        first = job.lease_extranonce2(count, worker_name, self.get_max_extranonce2())
+        
+        ntime = int(time.time()) + job.ntime_delta
+        job.extend_ntime_range(ntime + self.roll_ntime)
+        
+        (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, _) = job.broadcast_params
+        return {'job_id': job_id,
+                'prevhash': prevhash,
+                'coinb1': coinb1,
+                'extranonce1': self.extranonce1,
+                'coinb2': coinb2,
+                'merkle_branch': merkle_branch,
+                'version': version,
+                'nbits': nbits,
+                'ntime': '%08x' % ntime,
+                'expire': self.roll_ntime,
+                'extranonce2_first': first,
+                'extranonce2_count': count,
+                'extranonce2_size': self.extranonce2_size,
+                'target': self.target.hex}
+        
+    def submit_lease(self, job_id, extranonce2, ntime, nonce, worker_name):
+        '''Submit share found by the miner on leased extranonce2 range'''
+        
+        # 1. Lookup for the job
+        job = self.job_store.get(job_id)
+        if job == None:
+            log.info("Job not found")
+            return False
+        
+        if self.job_store.is_stale(job):
+            log.info("Stale share")
+            return False
+        
+        # 2. Check lease owner, ntime and build blockheader
+        try:
+            if len(extranonce2) != self.extranonce2_size * 2 or len(ntime) != 8 or len(nonce) != 8:
+                raise ValueError("Incorrect size of share parameters")
+            owner = job.get_lease_owner(int(extranonce2, 16))
+            ntime_valid = job.is_ntime_valid(int(ntime, 16))
+            extranonce = self.extranonce1_bin + binascii.unhexlify(extranonce2)
+            header_bin = binascii.unhexlify(job.build_header(extranonce, ntime, nonce))
+        except (ValueError, TypeError):
+            log.info("Malformed share")
+            return False
+        
+        if owner != worker_name:
+            log.info("Extranonce2 %s isn't leased to '%s'" % (extranonce2, worker_name))
+            return False
+        
+        if not ntime_valid:
+            log.info("ntime out of range")
+            return False
+        
+        # 3. Check if blockheader meets requested difficulty
+        if not self.target.is_met(utils.header_hash(header_bin)):
+            log.debug("Share is below expected target")
+            return True
+        
+        # 4. Submit share to the pool
+        return self.f.rpc('mining.submit', [worker_name, job.job_id, extranonce2, ntime, nonce])
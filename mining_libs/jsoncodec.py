@@ -0,0 +1,58 @@
+'''
+    JSON codec of the proxy, the fastest installed library is used:
+
+      ujson      -- the fastest one, but only with exact floats (fractional difficulty)
+      simplejson -- with C speedups
+      json       -- standard library
+
+    Every library has to pass test() with its settings, otherwise the next
+    one is used. The codec is used by proxy code only, the stratum library
+    keeps its own json module.
+'''
+
+import json as _stdlib
+
+def _use_ujson():
+    import ujson
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return ('ujson', dumps, ujson.loads)
+
+def _use_simplejson():
+    import simplejson
+    if not simplejson._speedups:
+        raise ImportError("simplejson without C speedups is slower than json")
+    return ('simplejson', simplejson.dumps, simplejson.loads)
+
+def _use_stdlib():
+    return ('json', _stdlib.dumps, _stdlib.loads)
+
+def test(dumps, loads):
+    '''Round trip of values seen in the proxy traffic, compared to standard library'''
+    samples = [{'id': 1, 'method': 'mining.set_difficulty', 'params': [2 ** -32]},
+               {'id': None, 'method': 'mining.notify', 'params': ['1f', '00' * 32, [ 'ab' * 32 ] * 3, True]},
+               {'id': 'a/b', 'result': [[u'mining.notify', u'\u017elu\u0165ou\u010dk\xfd k\u016f\u0148'], 2 ** 53 + 1, 0.1, 1e300],
+                'error': None},
+               [-1, False, None, '"quoted" \\ \n\t\x01']]
+    for sample in samples:
+        encoded = dumps(sample)
+        if not isinstance(encoded, str) or loads(encoded) != _stdlib.loads(_stdlib.dumps(sample)):
+            return False
+        if loads(_stdlib.dumps(sample)) != _stdlib.loads(_stdlib.dumps(sample)):
+            return False
+    return True
+
+def _select():
+    for use in (_use_ujson, _use_simplejson):
+        try:
+            (name, dumps, loads) = use()
+        except (ImportError, AttributeError):
+            continue
+        try:
+            if test(dumps, loads):
+                return (name, dumps, loads)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return _use_stdlib()
+
+(NAME, dumps, loads) = _select()
@@ -53,56 +53,75 @@ def rotateright(i,p):
 def addu32(*i):
     return sum(list(i))&0xFFFFFFFF
 
-def calculateMidstate(data, state=None, rounds=None):
+# Precompiled, so every call doesn't parse the format
+_unpack_block = struct.Struct('<16I').unpack
+_unpack_state = struct.Struct('<8I').unpack
+_pack_state = struct.Struct('<8I').pack
+
+MASK = 0xFFFFFFFF
+
+# Rounds depending on the first nine words only (version and prevhash of
+# block header), their result is the same for all headers of a job
+PREFIX_ROUNDS = 9
+
+def calculateMidstate(data, state=None, rounds=None, start=0):
     """Given a 512-bit (64-byte) block of (little-endian byteswapped) data,
     calculate a Bitcoin-style midstate. (That is, if SHA-256 were little-endian
     and only hashed the first block of input.)
+
+    Rounds from start to rounds are computed on given state, state after
+    the first rounds is returned when rounds are given.
     """
     if len(data) != 64:
         raise ValueError('data must be 64 bytes long')
 
-    w = list(struct.unpack('<IIIIIIIIIIIIIIII', data))
+    # Whole message schedule first, rotations are inlined and
+    # the words are masked once per expression
+    w = list(_unpack_block(data))
+    for i in range(16, 64):
+        x = w[i-15]
+        y = w[i-2]
+        w.append((w[i-16] + w[i-7] + ((x >> 7 | x << 25) ^ (x >> 18 | x << 14) ^ (x >> 3)) +
+                  ((y >> 17 | y << 15) ^ (y >> 19 | y << 13) ^ (y >> 10))) & MASK)
 
     if state is not None:
         if len(state) != 32:
             raise ValueError('state must be 32 bytes long')
-        a,b,c,d,e,f,g,h = struct.unpack('<IIIIIIII', state)
+        a,b,c,d,e,f,g,h = _unpack_state(state)
     else:
-        a = A0
-        b = B0
-        c = C0
-        d = D0
-        e = E0
-        f = F0
-        g = G0
-        h = H0
-
-    consts = K if rounds is None else K[:rounds]
-    for k in consts:
-        s0 = rotateright(a,2) ^ rotateright(a,13) ^ rotateright(a,22)
-        s1 = rotateright(e,6) ^ rotateright(e,11) ^ rotateright(e,25)
-        ma = (a&b) ^ (a&c) ^ (b&c)
-        ch = (e&f) ^ ((~e)&g)
-
-        h = addu32(h,w[0],k,ch,s1)
-        d = addu32(d,h)
-        h = addu32(h,ma,s0)
-
-        a,b,c,d,e,f,g,h = h,a,b,c,d,e,f,g
-
-        s0 = rotateright(w[1],7) ^ rotateright(w[1],18) ^ (w[1] >> 3)
-        s1 = rotateright(w[14],17) ^ rotateright(w[14],19) ^ (w[14] >> 10)
-        w.append(addu32(w[0], s0, w[9], s1))
-        w.pop(0)
+        a,b,c,d,e,f,g,h = A0,B0,C0,D0,E0,F0,G0,H0
+
+    for i in range(start, 64 if rounds is None else rounds):
+        t1 = h + (((e >> 6 | e << 26) ^ (e >> 11 | e << 21) ^ (e >> 25 | e << 7)) & MASK) + \
+                ((e & f) ^ (~e & g)) + K[i] + w[i]
+        t2 = (((a >> 2 | a << 30) ^ (a >> 13 | a << 19) ^ (a >> 22 | a << 10)) & MASK) + \
+                ((a & b) ^ (a & c) ^ (b & c))
+        h = g
+        g = f
+        f = e
+        e = (d + t1) & MASK
+        d = c
+        c = b
+        b = a
+        a = (t1 + t2) & MASK
 
     if rounds is None:
-        a = addu32(a, A0)
-        b = addu32(b, B0)
-        c = addu32(c, C0)
-        d = addu32(d, D0)
-        e = addu32(e, E0)
-        f = addu32(f, F0)
-        g = addu32(g, G0)
-        h = addu32(h, H0)
-
-    return struct.pack('<IIIIIIII', a, b, c, d, e, f, g, h)
\ No newline at end of file
+        a = (a + A0) & MASK
+        b = (b + B0) & MASK
+        c = (c + C0) & MASK
+        d = (d + D0) & MASK
+        e = (e + E0) & MASK
+        f = (f + F0) & MASK
+        g = (g + G0) & MASK
+        h = (h + H0) & MASK
+
+    return _pack_state(a, b, c, d, e, f, g, h)
+
+def calculatePrefixState(data):
+    """State after PREFIX_ROUNDS over the first 36 bytes of data, see finishMidstate()"""
+    return calculateMidstate(data[:36].ljust(64, '\0'), rounds=PREFIX_ROUNDS)
+
+def finishMidstate(state, data):
+    """The same as calculateMidstate(data) for data starting by the prefix
+    of calculatePrefixState(), which saves the rounds over the prefix"""
+    return calculateMidstate(data, state, start=PREFIX_ROUNDS)
@@ -0,0 +1,97 @@
+'''
+    Midstates of many 64-byte blocks at once.
+
+    Blocks are in the same (little-endian byteswapped) byte order as for
+    calculateMidstate() and every midstate is returned as 32-byte string.
+    Best available implementation is used:
+
+      c       -- midstatec extension, the whole batch hashed by single call
+      openssl -- libcrypto's SHA-256 called for every block
+      numpy   -- vectorized SHA-256, every round processes all blocks at once
+      python  -- calculateMidstate() called for every block
+'''
+
+from midstate import K, A0, B0, C0, D0, E0, F0, G0, H0, calculateMidstate
+
+try:
+    from midstatec import test as midstateTest, midstate_batch as _c_batch
+    if not midstateTest():
+        raise ImportError("midstatec not usable")
+except ImportError:
+    _c_batch = None
+
+try:
+    from midstate_openssl import calculateMidstate as _openssl_midstate
+except ImportError:
+    _openssl_midstate = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _join(blocks):
+    if isinstance(blocks, bytes):
+        data = blocks
+    else:
+        data = b''.join(blocks)
+    if len(data) % 64:
+        raise ValueError('blocks must be 64 bytes long')
+    return data
+
+def _split(data):
+    return [ data[i:i+32] for i in range(0, len(data), 32) ]
+
+def calculateMidstatesNumpy(blocks):
+    '''Every SHA-256 word is uint32 array with one lane per block'''
+    data = _join(blocks)
+    n = len(data) // 64
+    if n == 0:
+        return []
+
+    u32 = numpy.uint32
+    def rotr(x, r):
+        return (x >> u32(r)) | (x << u32(32 - r))
+
+    # Message schedule, w[i] is array of i-th word of all blocks
+    w = list(numpy.frombuffer(data, dtype='<u4').reshape(n, 16).T.astype(u32))
+    for i in range(16, 64):
+        s0 = rotr(w[i-15], 7) ^ rotr(w[i-15], 18) ^ (w[i-15] >> u32(3))
+        s1 = rotr(w[i-2], 17) ^ rotr(w[i-2], 19) ^ (w[i-2] >> u32(10))
+        w.append(w[i-16] + s0 + w[i-7] + s1)
+
+    init = (A0, B0, C0, D0, E0, F0, G0, H0)
+    a, b, c, d, e, f, g, h = [ numpy.full(n, x, dtype=u32) for x in init ]
+    for i in range(64):
+        s1 = rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)
+        ch = (e & f) ^ (~e & g)
+        t1 = h + s1 + ch + u32(K[i]) + w[i]
+        s0 = rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)
+        ma = (a & b) ^ (a & c) ^ (b & c)
+        a, b, c, d, e, f, g, h = t1 + s0 + ma, a, b, c, d + t1, e, f, g
+
+    state = numpy.array([a, b, c, d, e, f, g, h]) + numpy.array(init, dtype=u32).reshape(8, 1)
+    return _split(state.T.astype('<u4').tobytes())
+
+def _per_block(func, blocks):
+    data = _join(blocks)
+    return [ func(data[i:i+64]) for i in range(0, len(data), 64) ]
+
+def calculateMidstatesOpenssl(blocks):
+    return _per_block(_openssl_midstate, blocks)
+
+def calculateMidstatesPython(blocks):
+    return _per_block(calculateMidstate, blocks)
+
+if _c_batch != None:
+    BACKEND = 'c'
+    calculateMidstates = _c_batch
+elif _openssl_midstate != None:
+    BACKEND = 'openssl'
+    calculateMidstates = calculateMidstatesOpenssl
+elif numpy != None:
+    BACKEND = 'numpy'
+    calculateMidstates = calculateMidstatesNumpy
+else:
+    BACKEND = 'python'
+    calculateMidstates = calculateMidstatesPython
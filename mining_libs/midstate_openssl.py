@@ -0,0 +1,58 @@
+'''
+    Midstate by SHA-256 of OpenSSL's libcrypto, loaded by ctypes.
+
+    SHA256_Transform() compresses single block without padding, the midstate
+    is then read from the first eight words of SHA256_CTX. Used when midstatec
+    extension isn't built; libcrypto is present almost everywhere.
+
+    Raises ImportError when libcrypto can't be loaded or gives wrong result.
+'''
+
+import ctypes
+import ctypes.util
+import struct
+
+# Names of libcrypto on Unix and on Windows builds of OpenSSL
+LIBRARY_NAMES = ['crypto', 'libcrypto', 'libcrypto-3', 'libcrypto-3-x64', 'libcrypto-1_1', 'libcrypto-1_1-x64', 'libeay32']
+
+# SHA256_CTX is 28 words, rounded up for safety
+CTX_WORDS = 32
+
+_byteswap = struct.Struct('>16I').pack
+_unpack_block = struct.Struct('<16I').unpack
+_pack_state = struct.Struct('<8I').pack
+
+def _load():
+    for name in LIBRARY_NAMES:
+        path = ctypes.util.find_library(name)
+        if path == None:
+            continue
+        try:
+            lib = ctypes.CDLL(path)
+            (lib.SHA256_Init, lib.SHA256_Transform)
+        except (OSError, AttributeError):
+            continue
+        return lib
+    raise ImportError("libcrypto with SHA256_Transform not found")
+
+_lib = _load()
+_ctx_type = ctypes.c_uint32 * CTX_WORDS
+
+def calculateMidstate(data):
+    '''The same as mining_libs.midstate.calculateMidstate(data)'''
+    if len(data) != 64:
+        raise ValueError('data must be 64 bytes long')
+
+    # Context per call, ctypes releases GIL during the call
+    ctx = _ctx_type()
+    _lib.SHA256_Init(ctx)
+    _lib.SHA256_Transform(ctx, _byteswap(*_unpack_block(data)))
+    return _pack_state(*ctx[:8])
+
+def test():
+    from midstate import calculateMidstate as reference
+    block = struct.pack('<16I', *[ (i * 0x9e3779b9) & 0xffffffff for i in range(16) ])
+    return calculateMidstate(block) == reference(block)
+
+if not test():
+    raise ImportError("libcrypto gives wrong midstate")
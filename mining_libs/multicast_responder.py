@@ -1,42 +1,154 @@
-import json
+import os
+import binascii
+import time
+
 from twisted.internet.protocol import DatagramProtocol
+from twisted.internet import task
+
+from downstream import TokenBucket
+import jsoncodec
 
 import stratum.logger
 log = stratum.logger.get_logger('proxy')
 
+MULTICAST_GROUP = '239.3.3.3'
+MULTICAST_PORT = 3333
+
+# Requests per second (and burst) answered for single source address
+SOURCE_RATE = 2
+SOURCE_BURST = 10
+MAX_SOURCES = 10000 # Rate limit state is dropped when there's more sources
+
+# Proxies announce their load this often (seconds)
+ANNOUNCE_INTERVAL = 10
+
+# Cached response is rebuilt at most once per this many seconds
+RESPONSE_TTL = 1
+
 class MulticastResponder(DatagramProtocol):
-    def __init__(self, pool_host, stratum_port, getwork_port):
+    '''Answers mining.get_upstream requests of miners on local network.
+
+       Result of the request is
+           [[pool_host, pool_port], stratum_port, getwork_port, proxies]
+       where proxies is a list of proxies mining for the same pool, each of them
+           {"host": host, "stratum_port": port, "getwork_port": port, "miners": N, "capacity": N}
+       host is null for the responding proxy itself, capacity is null when unlimited.
+       Old clients read the first three items only.
+
+       Proxies periodically announce their load to the group by
+       mining.announce notification, so every proxy knows its peers.'''
+
+    def __init__(self, pool_host, stratum_port, getwork_port, get_load=None):
         # Upstream Stratum host/port
         # Used for identifying the pool which we're connected to.
         # Some load balancing strategies can change the host/port
         # during the mining session (by mining.reconnect()), but this points
-        # to initial host/port provided by user on cmdline or by X-Stratum 
+        # to initial host/port provided by user on cmdline or by X-Stratum
         self.pool_host = pool_host
-        
+
         self.stratum_port = stratum_port
         self.getwork_port = getwork_port
-        
-    def startProtocol(self):        
+        self.get_load = get_load # Returns (miners, capacity) of this proxy
+        self.instance_id = binascii.hexlify(os.urandom(8)) # Recognizes our own announcements
+
+        self.peers = {} # (host, stratum_port, getwork_port) -> (miners, capacity, last_seen)
+        self.sources = {} # Source host -> TokenBucket
+        self.ignored = 0 # Requests over the rate limit
+
+        self._result = None # Serialized result of mining.get_upstream
+        self._result_time = 0
+        self.announcer = task.LoopingCall(self.announce)
+
+    def startProtocol(self):
         # 239.0.0.0/8 are for private use within an organization
-        self.transport.joinGroup("239.3.3.3")
+        self.transport.joinGroup(MULTICAST_GROUP)
         self.transport.setTTL(5)
+        self.announcer.start(ANNOUNCE_INTERVAL, now=True)
+
+    def stopProtocol(self):
+        if self.announcer.running:
+            self.announcer.stop()
+
+    def _get_load(self):
+        if self.get_load == None:
+            return (None, None)
+        return self.get_load()
+
+    def _get_result(self):
+        '''Serialized result is shared by all requests for a while'''
+        if self._result == None or time.time() - self._result_time > RESPONSE_TTL:
+            (miners, capacity) = self._get_load()
+            proxies = [{'host': None, 'stratum_port': self.stratum_port, 'getwork_port': self.getwork_port,
+                        'miners': miners, 'capacity': capacity}]
+
+            expire = time.time() - 3 * ANNOUNCE_INTERVAL
+            for ((host, stratum_port, getwork_port), (miners, capacity, last_seen)) in self.peers.items():
+                if last_seen < expire:
+                    del self.peers[(host, stratum_port, getwork_port)]
+                    continue
+                proxies.append({'host': host, 'stratum_port': stratum_port, 'getwork_port': getwork_port,
+                                'miners': miners, 'capacity': capacity})
+
+            self._result = jsoncodec.dumps((self.pool_host, self.stratum_port, self.getwork_port, proxies))
+            self._result_time = time.time()
+        return self._result
 
     def writeResponse(self, address, msg_id, result, error=None):
-        self.transport.write(json.dumps({"id": msg_id, "result": result, "error": error}), address)
-        
+        self.transport.write(jsoncodec.dumps({"id": msg_id, "result": result, "error": error}), address)
+
+    def writeSerializedResponse(self, address, msg_id, result):
+        self.transport.write('{"id": %s, "result": %s, "error": null}' % (jsoncodec.dumps(msg_id), result), address)
+
+    def announce(self):
+        (miners, capacity) = self._get_load()
+        msg = {"id": None, "method": "mining.announce",
+               "params": [self.instance_id, self.pool_host, self.stratum_port, self.getwork_port, miners, capacity]}
+        try:
+            self.transport.write(jsoncodec.dumps(msg), (MULTICAST_GROUP, MULTICAST_PORT))
+        except Exception as exc:
+            log.debug("Cannot announce load: %s" % str(exc))
+
+    def _is_allowed(self, host):
+        bucket = self.sources.get(host)
+        if bucket == None:
+            if len(self.sources) >= MAX_SOURCES:
+                self.sources.clear()
+            bucket = self.sources[host] = TokenBucket(SOURCE_RATE, SOURCE_BURST)
+        return bucket.consume()
+
+    def _on_announce(self, params, address):
+        (instance_id, pool_host, stratum_port, getwork_port, miners, capacity) = params[:6]
+        if instance_id == self.instance_id or list(pool_host) != list(self.pool_host):
+            # Our own announcement or proxy mining for another pool
+            return
+        self.peers[(address[0], stratum_port, getwork_port)] = (miners, capacity, time.time())
+
     def datagramReceived(self, datagram, address):
-        log.info("Received local discovery request from %s:%d" % address)
-        
+        if not self._is_allowed(address[0]):
+            self.ignored += 1
+            return
+
+        log.debug("Received local discovery datagram from %s:%d" % address)
+
         try:
-            data = json.loads(datagram)
+            data = jsoncodec.loads(datagram)
         except:
             # Skip response if datagram is not parsable
-            log.error("Unparsable datagram")
+            log.debug("Unparsable datagram")
+            return
+
+        if not isinstance(data, dict):
             return
-        
+
         msg_id = data.get('id')
         msg_method = data.get('method')
-        #msg_params = data.get('params')
-        
+        msg_params = data.get('params')
+
         if msg_method == 'mining.get_upstream':
-            self.writeResponse(address, msg_id, (self.pool_host, self.stratum_port, self.getwork_port))
\ No newline at end of file
+            self.writeSerializedResponse(address, msg_id, self._get_result())
+
+        elif msg_method == 'mining.announce':
+            try:
+                self._on_announce(msg_params, address)
+            except (TypeError, ValueError):
+                log.debug("Invalid announcement from %s:%d" % address)
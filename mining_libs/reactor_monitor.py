@@ -0,0 +1,138 @@
+import cProfile
+import sys
+import thread
+import threading
+import time
+import traceback
+
+from twisted.internet import reactor, task
+
+import stratum.logger
+log = stratum.logger.get_logger('proxy')
+
+# Period of the reactor heartbeat in seconds
+HEARTBEAT_INTERVAL = 0.1
+
+class StallDetector(object):
+    '''Logs callbacks which block the reactor for longer than threshold (in seconds)
+    by a heartbeat which is late after every stall. With time_io, I/O handlers
+    are timed one by one too, so the log tells which connection was slow.
+    That wraps private method of the reactor, so it's turned on only on request.'''
+
+    def __init__(self, threshold, time_io=False):
+        self.threshold = threshold
+        self.time_io = time_io
+        self.stalls = 0 # Count of detected stalls
+        self.max_stall = 0.0 # Longest stall in seconds
+        self.max_lag = 0.0 # Longest heartbeat delay in seconds, stalls or not
+        self.last_beat = None
+        self.reported = 0.0 # Stall time already reported since the last heartbeat
+        self.heartbeat = task.LoopingCall(self._beat)
+
+    def start(self):
+        self.last_beat = time.time()
+        self.heartbeat.start(HEARTBEAT_INTERVAL, now=False)
+
+        if not self.time_io:
+            return
+
+        # Private API of select-like reactors, not available on every platform
+        if hasattr(reactor, '_doReadOrWrite'):
+            self._wrap_io()
+        else:
+            log.warning("Timing of I/O handlers isn't supported by %s, stalls are detected by the heartbeat only" % \
+                    reactor.__class__.__name__)
+
+    def _wrap_io(self):
+        do_read_or_write = reactor._doReadOrWrite
+
+        def timed_read_or_write(selectable, *args):
+            start = time.time()
+            try:
+                return do_read_or_write(selectable, *args)
+            finally:
+                elapsed = time.time() - start
+                if elapsed > self.threshold:
+                    self._report(elapsed, getattr(selectable, 'logstr', None) or repr(selectable))
+                    self.reported += elapsed
+
+        reactor._doReadOrWrite = timed_read_or_write
+
+    def _beat(self):
+        now = time.time()
+        lag = now - self.last_beat - HEARTBEAT_INTERVAL - self.reported
+        self.last_beat = now
+        self.reported = 0.0
+        self.max_lag = max(self.max_lag, lag)
+
+        if lag > self.threshold:
+            self._report(lag, "timed calls")
+
+    def _report(self, elapsed, source):
+        self.stalls += 1
+        self.max_stall = max(self.max_stall, elapsed)
+        log.warning("Reactor blocked for %dms by %s" % (elapsed * 1000, source))
+
+    def get_stats(self):
+        return {'stalls': self.stalls, 'max_stall': round(self.max_stall * 1000),
+                'max_lag': round(self.max_lag * 1000)}
+
+class StallSampler(threading.Thread):
+    '''Watchdog thread logging the stack of reactor thread when the heartbeat
+    of given StallDetector is late, so the log shows what is blocking
+    the reactor while it's still blocking. Must be created in the reactor thread.'''
+
+    def __init__(self, detector):
+        threading.Thread.__init__(self, name='StallSampler')
+        self.daemon = True
+        self.detector = detector
+        self.reactor_thread = thread.get_ident()
+
+    def run(self):
+        sampled_beat = None
+        while True:
+            time.sleep(self.detector.threshold / 2)
+
+            beat = self.detector.last_beat
+            if beat == sampled_beat or time.time() - beat < HEARTBEAT_INTERVAL + self.detector.threshold:
+                continue
+
+            # Single sample per stall is enough
+            sampled_beat = beat
+            frame = sys._current_frames().get(self.reactor_thread)
+            if frame != None:
+                log.warning("Reactor blocked for %dms so far, stack:\n%s" % \
+                        ((time.time() - beat) * 1000, ''.join(traceback.format_stack(frame))))
+
+class Profiler(object):
+    '''Runs cProfile over the reactor thread for given time
+    window and dumps collected stats to the file.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.profile = None
+
+    def start(self, seconds):
+        if self.profile != None:
+            return False
+
+        log.warning("Profiling the proxy for %d seconds" % seconds)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        reactor.callLater(seconds, self.stop)
+        return True
+
+    def stop(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.filename)
+        self.profile = None
+        log.warning("Profile stored to %s, use pstats module for reading it" % self.filename)
+
+    def start_on_signal(self, signum, seconds):
+        '''Start profiling when the process receives given signal'''
+        import signal
+
+        def on_signal(*args):
+            # Signal interrupts whatever is running, let reactor start it cleanly
+            reactor.callFromThread(self.start, seconds)
+        signal.signal(signum, on_signal)
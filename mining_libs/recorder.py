@@ -0,0 +1,43 @@
+import time
+
+import jsoncodec
+
+import stratum.logger
+log = stratum.logger.get_logger('proxy')
+
+class Recorder(object):
+    '''Writes traffic of the proxy to the file, one JSON object per line:
+        {"time": seconds since start, "source": "upstream"|"stratum"|"getwork",
+         "method": method name, "params": params}
+    Recording is used as an input of benchmarks/replay.py.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, 'w')
+        self.start = time.time()
+
+    def record(self, source, method, params):
+        self.fp.write(jsoncodec.dumps({'time': round(time.time() - self.start, 3), 'source': source,
+                                       'method': method, 'params': params}) + '\n')
+
+    def close(self):
+        self.fp.close()
+        log.info("Traffic recorded to %s" % self.filename)
+
+_recorder = None
+
+def start(filename):
+    global _recorder
+    _recorder = Recorder(filename)
+    log.warning("Recording traffic to %s" % filename)
+    return _recorder
+
+def stop():
+    global _recorder
+    if _recorder != None:
+        _recorder.close()
+        _recorder = None
+
+def record(source, method, params):
+    if _recorder != None:
+        _recorder.record(source, method, params)
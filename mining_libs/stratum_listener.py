@@ -1,6 +1,5 @@
 import time
 import binascii
-import struct
 
 from twisted.internet import defer
 
@@ -8,65 +7,103 @@ from stratum.services import GenericService
 from stratum.pubsub import Pubsub, Subscription
 from stratum.custom_exceptions import ServiceException, RemoteServiceException
 
-from jobs import JobRegistry
+from target import get_target, easier
+import utils
+import recorder
+import jsoncodec
 
 import stratum.logger
 log = stratum.logger.get_logger('proxy')
 
-def var_int(i):
-    if i <= 0xff:
-        return struct.pack('>B', i)
-    elif i <= 0xffff:
-        return struct.pack('>H', i)
-    raise Exception("number is too big")
-
 class UpstreamServiceException(ServiceException):
     code = -2
 
 class SubmitException(ServiceException):
     code = -2
 
+def iterate_subscribers(event, upstream):
+    '''Subscribers of the event served by given upstream session'''
+    for subs in Pubsub.iterate_subscribers(event):
+        if subs.params.get('upstream', 0) == upstream.index:
+            yield subs
+
 class DifficultySubscription(Subscription):
     event = 'mining.set_difficulty'
-    difficulty = 1
     
     @classmethod
-    def on_new_difficulty(cls, new_difficulty):
-        cls.difficulty = new_difficulty
-        cls.emit(new_difficulty)
+    def on_new_difficulty(cls, upstream, new_difficulty):
+        upstream.difficulty = new_difficulty
+        upstream.target = get_target(new_difficulty)
+        for subs in iterate_subscribers(cls.event, upstream):
+            subs.emit_single(new_difficulty)
     
     def after_subscribe(self, *args):
-        self.emit_single(self.difficulty)
+        self.emit_single(StratumProxyService.upstream.get(self.params['upstream']).difficulty)
         
 class MiningSubscription(Subscription):
     '''This subscription object implements
-    logic for broadcasting new jobs to the clients.'''
+    logic for broadcasting new jobs to the clients.
+    Every upstream session broadcasts its jobs to its own miners.'''
     
     event = 'mining.notify'
     
-    last_broadcast = None
-    
     @classmethod
-    def disconnect_all(cls):
-        for subs in Pubsub.iterate_subscribers(cls.event):
+    def disconnect_all(cls, upstream):
+        for subs in iterate_subscribers(cls.event, upstream):
             if subs.connection_ref().transport != None:
                 subs.connection_ref().transport.loseConnection()
         
     @classmethod
-    def on_template(cls, job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs):
+    def _serialize(cls, params):
+        return "%s\n" % jsoncodec.dumps({'id': None, 'method': cls.event, 'params': params})
+    
+    @classmethod
+    def emit_serialized(cls, upstream, params):
+        '''Same as emit(), but the message is serialized
+        just once for all subscribers.'''
+        payload = cls._serialize(params)
+        for subs in iterate_subscribers(cls.event, upstream):
+            conn = subs.connection_ref()
+            if conn != None:
+                conn.write_broadcast(payload)
+        
+    @classmethod
+    def on_template(cls, upstream, job, clean_jobs):
         '''Push new job to subscribed clients'''
-        cls.last_broadcast = (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)
-        cls.emit(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)
+        upstream.last_job = job
+        upstream.subscribe_notify = None
+        cls.emit_serialized(upstream, job.broadcast_params + (clean_jobs,))
+        
+    @classmethod
+    def _get_subscribe_notify(cls, upstream):
+        if upstream.subscribe_notify == None:
+            upstream.subscribe_notify = cls._serialize(upstream.last_job.broadcast_params + (True,))
+        return upstream.subscribe_notify
+        
+    @classmethod
+    def resend_last_job(cls, conn):
+        '''Send the latest job to the connection which missed some broadcasts'''
+        index = conn.get_session().get('upstream')
+        if index == None:
+            return
+        
+        upstream = StratumProxyService.upstream.get(index)
+        if upstream.last_job != None:
+            conn.transport_write(cls._get_subscribe_notify(upstream))
         
     def _finish_after_subscribe(self, result):
         '''Send new job to newly subscribed client'''
-        try:        
-            (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, _) = self.last_broadcast
-        except Exception:
+        upstream = StratumProxyService.upstream.get(self.params['upstream'])
+        if upstream.last_job == None:
             log.error("Template not ready yet")
             return result
         
-        self.emit_single(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, True)
+        conn = self.connection_ref()
+        if conn == None:
+            # Connection is closed
+            return result
+        
+        conn.transport_write(self._get_subscribe_notify(upstream))
         return result
              
     def after_subscribe(self, *args):
@@ -80,17 +117,18 @@ class StratumProxyService(GenericService):
     service_vendor = 'mining_proxy'
     is_default = True
     
-    _f = None # Factory of upstream Stratum connection
+    upstream = None # UpstreamPool, sessions to the pool
+    admission = None # RateLimiter for subscribe and authorize requests
     custom_user = None
     custom_password = None
-    extranonce1 = None
-    extranonce2_size = None
-    tail_iterator = 0
-    registered_tails= []
+    validate_shares = False
+    rejected_locally = 0 # Count of invalid shares which haven't been sent to the pool
+    local_latency = 0.0 # Moving average of time spent by submit in the proxy (ms)
+    upstream_latency = 0.0 # Moving average of submit round trip to upstream (ms)
     
     @classmethod
-    def _set_upstream_factory(cls, f):
-        cls._f = f
+    def _set_upstream(cls, upstream):
+        cls.upstream = upstream
 
     @classmethod
     def _set_custom_user(cls, custom_user, custom_password):
@@ -98,104 +136,169 @@ class StratumProxyService(GenericService):
         cls.custom_password = custom_password
         
     @classmethod
-    def _set_extranonce(cls, extranonce1, extranonce2_size):
-        cls.extranonce1 = extranonce1
-        cls.extranonce2_size = extranonce2_size
+    def _set_admission(cls, admission):
+        cls.admission = admission
         
     @classmethod
-    def _get_unused_tail(cls):
-        '''Currently adds up to two bytes to extranonce1,
-        limiting proxy for up to 65535 connected clients.'''
+    def _set_share_validation(cls, validate_shares):
+        cls.validate_shares = validate_shares
         
-        for _ in range(0, 0xffff):  # 0-65535
-            cls.tail_iterator += 1
-            cls.tail_iterator %= 0xffff
-
-            # Zero extranonce is reserved for getwork connections
-            if cls.tail_iterator == 0:
-                cls.tail_iterator += 1
-
-            # var_int throws an exception when input is >= 0xffff
-            tail = var_int(cls.tail_iterator)
-            tail_len = len(tail)
-
-            if tail not in cls.registered_tails:
-                cls.registered_tails.append(tail)
-                return (binascii.hexlify(tail), cls.extranonce2_size - tail_len)
-            
-        raise Exception("Extranonce slots are full, please disconnect some miners!")
+    @classmethod
+    def _validate_share(cls, upstream, job_id, extranonce2, ntime, nonce):
+        '''Check the share locally before it's sent to the pool.
+        Raises SubmitException for shares which pool would reject anyway.
+        extranonce2 must already include connection's tail.'''
+        
+        job = upstream.job_store.get(job_id)
+        if job == None:
+            # Job isn't known to the proxy (e.g. it has been received
+            # before the proxy started), so let the pool decide.
+            return True
+        
+        if upstream.job_store.is_stale(job):
+            raise SubmitException("Stale share")
+        
+        if len(extranonce2) != upstream.extranonce2_size * 2:
+            raise SubmitException("Incorrect size of extranonce2")
+        
+        if len(ntime) != 8 or len(nonce) != 8:
+            raise SubmitException("Incorrect size of ntime or nonce")
+        
+        try:
+            extranonce = binascii.unhexlify(upstream.extranonce1 + extranonce2)
+            header_bin = binascii.unhexlify(job.build_header(extranonce, ntime, nonce))
+        except TypeError:
+            raise SubmitException("Malformed share")
+        
+        # When difficulty changed in the meantime, accept shares for the easier one.
+        # It's up to the pool which target is valid for given job.
+        target = easier(job.target, upstream.target)
+        if not target.is_met(utils.header_hash(header_bin)):
+            raise SubmitException("Low difficulty share")
+        
+        return True
+    
+    def _get_upstream(self):
+        '''Upstream session serving this connection. It's picked by the load
+        on the first request of the connection and kept until disconnect.'''
+        conn_session = self.connection_ref().get_session()
+        index = conn_session.get('upstream')
+        if index == None:
+            upstream = self.upstream.pick()
+            conn_session['upstream'] = upstream.index
+            return upstream
+        return self.upstream.get(index)
     
-    def _drop_tail(self, result, tail):
-        tail = binascii.unhexlify(tail)
-        if tail in self.registered_tails:
-            self.registered_tails.remove(tail)
-        else:
-            log.error("Given extranonce is not registered1")
+    def _drop_tail(self, result, upstream, tail):
+        upstream.drop_tail(tail)
         return result
             
     @defer.inlineCallbacks
     def authorize(self, worker_name, worker_password, *args):
-        if self._f.client == None or not self._f.client.connected:
-            yield self._f.on_connect
+        recorder.record('stratum', 'mining.authorize', [worker_name])
+        if self.admission != None:
+            yield self.admission.acquire()
+            
+        upstream = self._get_upstream()
+        if not upstream.is_connected():
+            yield upstream.f.on_connect
 
         if self.custom_user != None:
             # Already subscribed by main()
             defer.returnValue(True)
-                        
-        result = (yield self._f.rpc('mining.authorize', [worker_name, worker_password]))
+        
+        # Worker registry authorizes every worker and password just once, no matter
+        # how many connections (e.g. chained proxies) use the same credentials.
+        result = (yield upstream.workers.authorize(worker_name, worker_password))
         defer.returnValue(result)
     
     @defer.inlineCallbacks
     def subscribe(self, *args):    
-        if self._f.client == None or not self._f.client.connected:
-            yield self._f.on_connect
+        recorder.record('stratum', 'mining.subscribe', [])
+        if self.admission != None:
+            yield self.admission.acquire()
             
-        if self._f.client == None or not self._f.client.connected:
+        upstream = self._get_upstream()
+        if not upstream.is_connected():
+            yield upstream.f.on_connect
+            
+        if not upstream.is_connected():
             raise UpstreamServiceException("Upstream not connected")
          
-        if self.extranonce1 == None:
-            # This should never happen, because _f.on_connect is fired *after*
+        if upstream.extranonce1 == None:
+            # This should never happen, because f.on_connect is fired *after*
             # connection receive mining.subscribe response
             raise UpstreamServiceException("Not subscribed on upstream yet")
         
-        (tail, extranonce2_size) = self._get_unused_tail()
+        (tail, extranonce2_size) = upstream.get_unused_tail()
         
         session = self.connection_ref().get_session()
         session['tail'] = tail
                 
         # Remove extranonce from registry when client disconnect
-        self.connection_ref().on_disconnect.addCallback(self._drop_tail, tail)
+        self.connection_ref().on_disconnect.addCallback(self._drop_tail, upstream, tail)
 
-        subs1 = Pubsub.subscribe(self.connection_ref(), DifficultySubscription())[0]
-        subs2 = Pubsub.subscribe(self.connection_ref(), MiningSubscription())[0]            
-        defer.returnValue(((subs1, subs2),) + (self.extranonce1+tail, extranonce2_size))
+        subs1 = Pubsub.subscribe(self.connection_ref(), DifficultySubscription(upstream=upstream.index))[0]
+        subs2 = Pubsub.subscribe(self.connection_ref(), MiningSubscription(upstream=upstream.index))[0]
+        defer.returnValue(((subs1, subs2),) + (upstream.extranonce1+tail, extranonce2_size))
             
     @defer.inlineCallbacks
     def submit(self, worker_name, job_id, extranonce2, ntime, nonce, *args):
-        if self._f.client == None or not self._f.client.connected:
-            raise SubmitException("Upstream not connected")
-
+        received = time.time()
+        recorder.record('stratum', 'mining.submit', [worker_name, job_id, extranonce2, ntime, nonce])
+        
         session = self.connection_ref().get_session()
         tail = session.get('tail')
         if tail == None:
             raise SubmitException("Connection is not subscribed")
 
+        upstream = self._get_upstream()
+        if not upstream.is_connected():
+            raise SubmitException("Upstream not connected")
+
         if self.custom_user:
             worker_name = self.custom_user
 
+        if self.validate_shares:
+            try:
+                self._validate_share(upstream, job_id, tail+extranonce2, ntime, nonce)
+            except SubmitException as exc:
+                StratumProxyService.rejected_locally += 1
+                log.info("Share from '%s' REJECTED locally: %s (%d shares filtered so far)" % \
+                         (worker_name, str(exc), self.rejected_locally))
+                raise
+
         start = time.time()
+        local_time = (start - received) * 1000
         
+        upstream.pending += 1
         try:
-            result = (yield self._f.rpc('mining.submit', [worker_name, job_id, tail+extranonce2, ntime, nonce]))
+            result = (yield upstream.f.rpc('mining.submit', [worker_name, job_id, tail+extranonce2, ntime, nonce]))
         except RemoteServiceException as exc:
             response_time = (time.time() - start) * 1000
-            log.info("[%dms] Share from '%s' REJECTED: %s" % (response_time, worker_name, str(exc)))
+            self._update_latency(local_time, response_time)
+            upstream.on_submit_finished(response_time, False)
+            log.info("[%dms, %.1fms local] Share from '%s' REJECTED: %s" % (response_time, local_time, worker_name, str(exc)))
             raise SubmitException(*exc.args)
+        finally:
+            upstream.pending -= 1
 
         response_time = (time.time() - start) * 1000
-        log.info("[%dms] Share from '%s' accepted, diff %d" % (response_time, worker_name, DifficultySubscription.difficulty))
+        self._update_latency(local_time, response_time)
+        upstream.on_submit_finished(response_time, True)
+        log.info("[%dms, %.1fms local] Share from '%s' accepted, diff %d" % (response_time, local_time, worker_name, upstream.difficulty))
         defer.returnValue(result)
 
+    @classmethod
+    def _update_latency(cls, local_time, upstream_time):
+        cls.local_latency += (local_time - cls.local_latency) * 0.1
+        cls.upstream_latency += (upstream_time - cls.upstream_latency) * 0.1
+        
+    def get_hop_latency(self, *args):
+        '''Average latency (ms) added by this proxy and round trip to its upstream.
+        Asking every proxy in the chain shows where the time is spent.'''
+        return {'local': round(self.local_latency, 3), 'upstream': round(self.upstream_latency, 3)}
+    
     def get_transactions(self, *args):
         log.warn("mining.get_transactions isn't supported by proxy")
         return []
@@ -0,0 +1,116 @@
+'''
+    Share targets precomputed per difficulty.
+
+    Target of every difficulty is calculated just once and kept with all
+    its representations, so getwork responses and share checks only pick
+    cached fields. Difficulty can be fractional (e.g. 2**-32 for testing)
+    or very large, target is calculated exactly and clamped to 256 bits.
+'''
+
+import binascii
+import struct
+from fractions import Fraction
+
+import utils
+
+# Targets of difficulty 1
+DIFF1_TARGET = 0x00000000ffff0000000000000000000000000000000000000000000000000000
+SCRYPT_DIFF1_TARGET = 0x0000ffff00000000000000000000000000000000000000000000000000000000
+
+MAX_TARGET = 2 ** 256 - 1
+
+# Cached targets, pools usually use a few difficulties only
+MAX_CACHED = 1000
+
+_top_word = struct.Struct('<I').unpack_from
+
+def difficulty_to_target(difficulty, scrypt_target=False):
+    '''Convert share difficulty to 256-bit target'''
+    difficulty = Fraction(difficulty)
+    if difficulty <= 0:
+        raise ValueError("Difficulty must be positive")
+
+    dif1 = SCRYPT_DIFF1_TARGET if scrypt_target else DIFF1_TARGET
+    return min(dif1 * difficulty.denominator // difficulty.numerator, MAX_TARGET)
+
+class Target(object):
+    '''Target of single difficulty. Hashes are in the byte order
+    of utils.header_hash(), the last 32-bit word is the most significant one.'''
+
+    __slots__ = ['difficulty', 'value', 'hex', 'bin', 'getwork_hex', 'top']
+
+    def __init__(self, difficulty, scrypt_target=False):
+        self.difficulty = difficulty
+        self.value = difficulty_to_target(difficulty, scrypt_target)
+        self.hex = '%064x' % self.value # Big-endian, e.g. for leases
+        self.bin = binascii.unhexlify(self.hex) # Big-endian, compares as a number
+        self.getwork_hex = binascii.hexlify(utils.uint256_to_str(self.value))
+        self.top = self.value >> 224 # The most significant word
+
+    def is_met(self, hash_bin):
+        '''True when hash is lower than or equal to the target'''
+        top = _top_word(hash_bin, 28)[0]
+        if top != self.top:
+            return top < self.top
+
+        # Top words are equal, which almost never happens
+        return hash_bin[::-1] <= self.bin
+
+    def __repr__(self):
+        return "<Target difficulty=%s %s>" % (self.difficulty, self.hex)
+
+_cache = {}
+
+def get_target(difficulty, scrypt_target=False):
+    '''Returns cached Target for given difficulty'''
+    key = (difficulty, scrypt_target)
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+
+    if len(_cache) >= MAX_CACHED:
+        _cache.clear()
+    target = _cache[key] = Target(difficulty, scrypt_target)
+    return target
+
+def easier(target1, target2):
+    '''The easier of two targets'''
+    return target1 if target1.value >= target2.value else target2
+
+def test():
+    '''Checks targets against known values and share checks against big-int comparison'''
+    import random
+
+    known = [(1, False, DIFF1_TARGET),
+             (1, True, SCRYPT_DIFF1_TARGET),
+             (2, False, DIFF1_TARGET // 2),
+             (0.5, False, DIFF1_TARGET * 2),
+             (0.25, True, SCRYPT_DIFF1_TARGET * 4),
+             (Fraction(1, 3), True, SCRYPT_DIFF1_TARGET * 3),
+             (2 ** -32, False, DIFF1_TARGET << 32),
+             (2 ** -32, True, MAX_TARGET), # Clamped
+             (10 ** 80, False, 0),
+             (12345678901234567890, False, DIFF1_TARGET // 12345678901234567890),
+             (12345678901234567890, True, SCRYPT_DIFF1_TARGET // 12345678901234567890)]
+
+    for (difficulty, scrypt_target, value) in known:
+        target = get_target(difficulty, scrypt_target)
+        if target.value != value or int(target.hex, 16) != value or \
+                utils.uint256_from_str(binascii.unhexlify(target.getwork_hex)) != value:
+            return False
+
+    rnd = random.Random(1)
+    for (difficulty, scrypt_target, value) in known:
+        target = get_target(difficulty, scrypt_target)
+        hashes = [ utils.uint256_to_str(rnd.getrandbits(256) >> rnd.randint(0, 256)) for _ in range(200) ]
+
+        # Hashes around the target, with the same top word
+        for delta in (-2 ** 200, -1, 0, 1, 2 ** 200):
+            if 0 <= value + delta <= MAX_TARGET:
+                hashes.append(utils.uint256_to_str(value + delta))
+
+        for hash_bin in hashes:
+            if target.is_met(hash_bin) != (utils.uint256_from_str(hash_bin) <= value):
+                return False
+    return True
@@ -0,0 +1,164 @@
+import binascii
+import struct
+
+from twisted.internet import reactor
+
+from target import get_target
+
+import stratum.logger
+log = stratum.logger.get_logger('proxy')
+
+# Extranonce2 bytes we'd like to leave for downstream miners at least
+MIN_EXTRANONCE2_SIZE = 2
+
+# Seconds of silence on upstream connection before reconnecting
+UPSTREAM_TIMEOUT = 2 * 60
+
+class UpstreamSession(object):
+    '''Single subscription to the pool. Every session has its own connection,
+    extranonce1, difficulty and jobs, so it serves its own set of Stratum miners.
+    Miners are distinguished within the session by extranonce1 tails.'''
+
+    def __init__(self, index, f, workers, job_store):
+        self.index = index
+        self.f = f # Factory of Stratum client
+        self.workers = workers # WorkerRegistry authorizing on this connection
+        self.job_store = job_store
+        f.upstream = self # For finding the session of incoming upstream messages
+
+        self.extranonce1 = None
+        self.extranonce2_size = None
+        self.tail_size = 0 # Length of extranonce1 tail in bytes
+        self.tail_iterator = 0
+        self.registered_tails = set() # Binary tails of connected clients
+
+        self.difficulty = 1
+        self.target = get_target(1) # Used for local share validation only
+        self.last_job = None
+        self.subscribe_notify = None # Serialized last job for newly subscribed clients
+        self.timeout = None
+
+        self.pending = 0 # Submits waiting for response of the pool
+        self.submits = 0
+        self.rejected = 0
+        self.latency = 0.0 # Moving average of submit round trip (ms)
+
+    def is_connected(self):
+        return self.f.client != None and bool(self.f.client.connected)
+
+    def reset_timeout(self):
+        if self.timeout != None and not self.timeout.called:
+            self.timeout.cancel()
+        self.timeout = reactor.callLater(UPSTREAM_TIMEOUT, self.on_timeout)
+
+    def on_timeout(self):
+        '''Try to reconnect to the pool after two minutes of no activity on the connection.'''
+        log.error("Connection of upstream session %d timed out" % self.index)
+        self.reset_timeout()
+        self.f.reconnect()
+
+    def set_extranonce(self, extranonce1, extranonce2_size, chain_mode=False):
+        self.extranonce1 = extranonce1
+        self.extranonce2_size = extranonce2_size
+        self.tail_size = self._negotiate_tail_size(extranonce2_size, chain_mode)
+
+    def _negotiate_tail_size(self, extranonce2_size, chain_mode):
+        '''Two bytes of tail serve up to 65535 miners. In chain mode, one byte
+        (255 downstream proxies) leaves more extranonce2 space for miners below them.
+        Tail is shortened when upstream itself doesn't provide enough space.'''
+
+        tail_size = 1 if chain_mode else 2
+        while tail_size > 1 and extranonce2_size - tail_size < MIN_EXTRANONCE2_SIZE:
+            tail_size -= 1
+
+        if extranonce2_size - tail_size < 1:
+            log.error("Upstream extranonce2_size %d is too small for serving Stratum miners" % extranonce2_size)
+            return 0
+
+        log.info("Using %d byte(s) of extranonce2 for tails, %d byte(s) left for miners" % \
+                 (tail_size, extranonce2_size - tail_size))
+        return tail_size
+
+    def get_capacity(self):
+        '''Zero tail is reserved for getwork'''
+        return 256 ** self.tail_size - 1 if self.tail_size else 0
+
+    def get_load(self):
+        capacity = self.get_capacity()
+        if not capacity:
+            return 1.0
+        return len(self.registered_tails) / float(capacity)
+
+    def get_unused_tail(self):
+        '''Adds tail_size bytes to extranonce1, limiting the session
+        for up to 255 (one byte) or 65535 (two bytes) connected clients.
+        Every tail has the same length, so extranonces of two clients never overlap.'''
+
+        max_tail = 256 ** self.tail_size
+        for _ in xrange(max_tail):
+            self.tail_iterator += 1
+            self.tail_iterator %= max_tail
+
+            # Zero extranonce is reserved for getwork connections
+            if self.tail_iterator == 0:
+                continue
+
+            tail = struct.pack('>I', self.tail_iterator)[-self.tail_size:]
+            if tail not in self.registered_tails:
+                self.registered_tails.add(tail)
+                return (binascii.hexlify(tail), self.extranonce2_size - self.tail_size)
+
+        raise Exception("Extranonce slots are full, please disconnect some miners!")
+
+    def drop_tail(self, tail):
+        tail = binascii.unhexlify(tail)
+        if tail in self.registered_tails:
+            self.registered_tails.remove(tail)
+        else:
+            log.error("Given extranonce is not registered1")
+
+    def on_submit_finished(self, response_time, accepted):
+        self.submits += 1
+        if not accepted:
+            self.rejected += 1
+        self.latency += (response_time - self.latency) * 0.1
+
+    def get_stats(self):
+        return {'session': self.index, 'connected': self.is_connected(), 'extranonce1': self.extranonce1,
+                'difficulty': self.difficulty, 'miners': len(self.registered_tails), 'capacity': self.get_capacity(),
+                'pending_submits': self.pending, 'submits': self.submits, 'rejected': self.rejected,
+                'latency': round(self.latency, 3)}
+
+class UpstreamPool(object):
+    '''Sessions to the same pool. The first one serves getwork miners too,
+    Stratum miners are spread over connected sessions by their load.'''
+
+    def __init__(self):
+        self.sessions = []
+
+    def add(self, f, workers, job_store):
+        session = UpstreamSession(len(self.sessions), f, workers, job_store)
+        self.sessions.append(session)
+        return session
+
+    @property
+    def primary(self):
+        return self.sessions[0]
+
+    def get(self, index):
+        return self.sessions[index]
+
+    def pick(self):
+        '''Least loaded connected session, the primary one when none is connected'''
+        connected = [ s for s in self.sessions if s.is_connected() and s.extranonce1 != None ]
+        if not connected:
+            return self.primary
+        return min(connected, key=lambda s: (s.get_load(), s.index))
+
+    def get_load(self):
+        '''Returns (connected miners, capacity) of all sessions'''
+        return (sum([ len(s.registered_tails) for s in self.sessions ]),
+                sum([ s.get_capacity() for s in self.sessions ]))
+
+    def get_stats(self):
+        return [ s.get_stats() for s in self.sessions ]
@@ -2,7 +2,6 @@ import hashlib
 import struct
 
 from twisted.internet import defer, reactor
-from twisted.web import client
 
 import stratum.logger
 log = stratum.logger.get_logger('proxy')
@@ -38,14 +37,22 @@ def reverse_hash(h):
 def doublesha(b):
     return hashlib.sha256(hashlib.sha256(b).digest()).digest()
 
+def header_hash(header_bin):
+    '''Double-SHA256 of 80 bytes long blockheader in getwork byte order
+    (every 32-bit word is byte-swapped before hashing)'''
+    return doublesha(struct.pack('<20I', *struct.unpack('>20I', header_bin[:80])))
+
 @defer.inlineCallbacks
-def detect_stratum(host, port):
+def detect_stratum(host, port, timeout=10):
     '''Perform getwork request to given
     host/port. If server respond, it will
     try to parse X-Stratum header.
     Not the most elegant code, but it works,
     because Stratum server should close the connection
     when client uses unknown payload.'''
+    
+    # Twisted web is loaded only when autodetection is needed
+    from twisted.web import client
         
     def get_raw_page(url, *args, **kwargs):
         # In Twisted 13.1.0 _parse() function replaced by _URI class.
@@ -69,7 +76,7 @@ def detect_stratum(host, port):
 
     def _on_callback(_, d):d.callback(True)
     def _on_errback(_, d): d.callback(True)
-    f = get_raw_page('http://%s:%d' % (host, port))
+    f = get_raw_page('http://%s:%d' % (host, port), timeout=timeout)
     
     d = defer.Deferred()
     f.deferred.addCallback(_on_callback, d)
@@ -1,46 +1,75 @@
 import time
 
+from twisted.internet import defer
+
 import stratum.logger
 log = stratum.logger.get_logger('proxy')
 
+class WorkerRecord(object):
+    '''Authorization state of single worker'''
+    __slots__ = ('authorized', 'last_failure')
+    
+    def __init__(self, authorized, last_failure=0):
+        self.authorized = authorized
+        self.last_failure = last_failure
+        
 class WorkerRegistry(object):
     def __init__(self, f):
         self.f = f # Factory of Stratum client
         self.clear_authorizations()
         
     def clear_authorizations(self):
-        self.authorized = []
-        self.unauthorized = []
-        self.last_failure = 0
+        self.workers = {} # (worker_name, password) -> WorkerRecord
+        self.pending = {} # (worker_name, password) -> Deferreds waiting for running authorization
     
-    def _on_authorized(self, result, worker_name):
+    def _on_authorized(self, result, key):
         if result == True:
-            self.authorized.append(worker_name)
+            self.workers[key] = WorkerRecord(True)
         else:
-            self.unauthorized.append(worker_name)
+            self.workers[key] = WorkerRecord(False, time.time())
         return result
     
-    def _on_failure(self, failure, worker_name):
-        log.exception("Cannot authorize worker '%s'" % worker_name)
-        self.last_failure = time.time()
+    def _on_failure(self, failure, key):
+        # Upstream error isn't a verdict on credentials, so nothing is cached
+        # and the error goes to the caller and all waiting requests
+        log.error("Cannot authorize worker '%s': %s" % (key[0], failure.getErrorMessage()))
+        return failure
                         
+    def _on_finished(self, result, key):
+        for d in self.pending.pop(key, []):
+            d.callback(result)
+        return result
+    
     def authorize(self, worker_name, password):
-        if worker_name in self.authorized:
+        key = (worker_name, password)
+        record = self.workers.get(key)
+        if record != None and record.authorized:
             return True
             
-        if worker_name in self.unauthorized and time.time() - self.last_failure < 60:
-            # Prevent flooding of mining.authorize() requests 
+        if record != None and time.time() - record.last_failure < 60:
+            # Prevent flooding of mining.authorize() requests, rejected
+            # credentials aren't sent upstream again for 60 seconds
             log.warning("Authentication of worker '%s' with password '%s' failed, next attempt in few seconds..." % \
                     (worker_name, password))
             return False
         
+        if key in self.pending:
+            # Authorization with these credentials is already running, just wait for the result
+            d = defer.Deferred()
+            self.pending[key].append(d)
+            return d
+        
+        self.pending[key] = []
         d = self.f.rpc('mining.authorize', [worker_name, password])
-        d.addCallback(self._on_authorized, worker_name)
-        d.addErrback(self._on_failure, worker_name)
+        d.addCallback(self._on_authorized, key)
+        d.addErrback(self._on_failure, key)
+        d.addBoth(self._on_finished, key)
         return d
          
-    def is_authorized(self, worker_name):
-        return (worker_name in self.authorized)
+    def is_authorized(self, worker_name, password):
+        record = self.workers.get((worker_name, password))
+        return record != None and record.authorized
     
-    def is_unauthorized(self, worker_name):
-        return (worker_name in self.unauthorized)  
+    def is_unauthorized(self, worker_name, password):
+        record = self.workers.get((worker_name, password))
+        return record != None and not record.authorized
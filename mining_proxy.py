@@ -17,9 +17,13 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import argparse
 import time
+START_TIME = time.time() # For measuring startup time
+
+import argparse
+import binascii
 import os
+import signal
 import socket
 
 def parse_args():
@@ -36,10 +40,28 @@ def parse_args():
     parser.add_argument('-cs', '--custom-stratum', dest='custom_stratum', type=str, help='Override URL provided in X-Stratum header')
     parser.add_argument('-cu', '--custom-user', dest='custom_user', type=str, help='Use this username for submitting shares')
     parser.add_argument('-cp', '--custom-password', dest='custom_password', type=str, help='Use this password for submitting shares')
+    parser.add_argument('-rn', '--roll-ntime', dest='roll_ntime', type=int, default=120, help='For how many seconds getwork miners can roll ntime of given work (X-Roll-NTime: expire=N). Use 0 for disabling ntime rolling.')
     parser.add_argument('--old-target', dest='old_target', action='store_true', help='Provides backward compatible targets for some deprecated getwork miners.')    
+    parser.add_argument('--chain', dest='chain', action='store_true', help='Another proxies are connected to this proxy. Uses smaller extranonce tails to leave more extranonce2 space for them.')
+    parser.add_argument('--upstream-sessions', dest='upstream_sessions', type=int, default=1, help='Number of sessions to the pool. Every session has its own extranonce1 and serves up to 65535 Stratum miners.')
+    parser.add_argument('--max-connections', dest='max_connections', type=int, default=0, help='Maximum of connected Stratum miners (0 = unlimited)')
+    parser.add_argument('--max-connections-per-ip', dest='max_connections_per_ip', type=int, default=0, help='Maximum of Stratum connections from single IP address (0 = unlimited)')
+    parser.add_argument('--connection-rate', dest='connection_rate', type=float, default=0, help='Maximum of new Stratum connections per second (0 = unlimited)')
+    parser.add_argument('--request-rate', dest='request_rate', type=float, default=0, help='Maximum of mining.subscribe and mining.authorize requests per second, others wait in a queue (0 = unlimited)')
+    parser.add_argument('--write-buffer-size', dest='write_buffer_size', type=int, default=64, help='Pause reading from Stratum miner and skip job broadcasts to it when this many kB wait for sending to it')
+    parser.add_argument('--write-coalescing', dest='write_coalescing', action='store_true', help="Join messages to Stratum miners written in the same reactor turn into single write (delays them until the end of the turn)")
     parser.add_argument('--blocknotify', dest='blocknotify_cmd', type=str, default='', help='Execute command when the best block changes (%%s in BLOCKNOTIFY_CMD is replaced by block hash)')
     parser.add_argument('--socks', dest='proxy', type=str, default='', help='Use socks5 proxy for upstream Stratum connection, specify as host:port')
     parser.add_argument('--tor', dest='tor', action='store_true', help='Configure proxy to mine over Tor (requires Tor running on local machine)')
+    parser.add_argument('--no-share-validation', dest='no_share_validation', action='store_true', help="Don't check shares from Stratum miners before they're sent to the pool. Validation is always turned off with --scrypt-target.")
+    parser.add_argument('--no-update-check', dest='no_update_check', action='store_true', help="Don't check for new versions of the proxy")
+    parser.add_argument('--stall-threshold', dest='stall_threshold', type=int, default=200, help='Log callbacks blocking the proxy for longer than this many milliseconds (0 = disabled)')
+    parser.add_argument('--stall-io', dest='stall_io', action='store_true', help='Time every I/O handler too, so the log of a stall names the slow connection (hooks into private API of the reactor)')
+    parser.add_argument('--stall-stacks', dest='stall_stacks', action='store_true', help='Log stack of the code which blocks the proxy for longer than --stall-threshold (runs a watchdog thread)')
+    parser.add_argument('--profile-file', dest='profile_file', type=str, default='mining_proxy.prof', help='Where to store profile collected after SIGUSR1 or admin request')
+    parser.add_argument('--profile-seconds', dest='profile_seconds', type=int, default=30, help='Length of profiling window in seconds')
+    parser.add_argument('--admin-port', dest='admin_port', type=int, default=0, help='Port of admin HTTP interface on localhost for proxy instrumentation (0 = disabled)')
+    parser.add_argument('--record', dest='record', type=str, help='Record upstream jobs and shares of miners to the file, for benchmarks/replay.py')
     parser.add_argument('-t', '--test', dest='test', action='store_true', help='Run performance test on startup')    
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Enable low-level debugging messages')
     parser.add_argument('-q', '--quiet', dest='quiet', action='store_true', help='Make output more quiet')
@@ -65,60 +87,73 @@ if __name__ == '__main__':
         settings.LOGFILE = args.log_file
             
 from twisted.internet import reactor, defer
-from stratum.socket_transport import SocketTransportFactory, SocketTransportClientFactory
+from stratum.socket_transport import SocketTransportClientFactory
 from stratum.services import ServiceEventHandler
-from twisted.web.server import Site
 
 from mining_libs import stratum_listener
-from mining_libs import getwork_listener
+from mining_libs import target
 from mining_libs import client_service
+from mining_libs import downstream
+from mining_libs import reactor_monitor
+from mining_libs import recorder
 from mining_libs import jobs
+from mining_libs import jsoncodec
+from mining_libs import upstream
 from mining_libs import worker_registry
-from mining_libs import multicast_responder
 from mining_libs import version
 from mining_libs import utils
 
 import stratum.logger
 log = stratum.logger.get_logger('proxy')
 
+# Miners connecting during startup wait in kernel's queue of this length
+LISTEN_BACKLOG = 1024
+
+# Seconds to wait for response of the update check
+UPDATE_CHECK_TIMEOUT = 30
+
 def on_shutdown(f):
     '''Clean environment properly'''
     log.info("Shutting down proxy...")
     f.is_reconnecting = False # Don't let stratum factory to reconnect again
     
 @defer.inlineCallbacks
-def on_connect(f, workers, job_registry):
+def on_connect(f, session, job_registry):
     '''Callback when proxy get connected to the pool'''
-    log.info("Connected to Stratum pool at %s:%d" % f.main_host)
+    log.info("Connected to Stratum pool at %s:%d (upstream session %d)" % (f.main_host + (session.index,)))
     #reactor.callLater(30, f.client.transport.loseConnection)
     
     # Hook to on_connect again
-    f.on_connect.addCallback(on_connect, workers, job_registry)
+    f.on_connect.addCallback(on_connect, session, job_registry)
     
     # Every worker have to re-autorize
-    workers.clear_authorizations() 
+    session.workers.clear_authorizations() 
        
     # Subscribe for receiving jobs
     log.info("Subscribing for mining jobs")
     (_, extranonce1, extranonce2_size) = (yield f.rpc('mining.subscribe', []))[:3]
-    job_registry.set_extranonce(extranonce1, extranonce2_size)
-    stratum_listener.StratumProxyService._set_extranonce(extranonce1, extranonce2_size)
+    session.set_extranonce(extranonce1, extranonce2_size, args.chain)
+    
+    if session.index == 0:
+        # Getwork is served by the primary session only
+        reserved_size = session.tail_size if args.stratum_port > 0 else 0
+        job_registry.set_extranonce(extranonce1, extranonce2_size, reserved_size)
     
     if args.custom_user:
         log.warning("Authorizing custom user %s, password %s" % (args.custom_user, args.custom_password))
-        workers.authorize(args.custom_user, args.custom_password)
+        session.workers.authorize(args.custom_user, args.custom_password)
 
     defer.returnValue(f)
      
-def on_disconnect(f, workers, job_registry):
+def on_disconnect(f, session, job_registry):
     '''Callback when proxy get disconnected from the pool'''
-    log.info("Disconnected from Stratum pool at %s:%d" % f.main_host)
-    f.on_disconnect.addCallback(on_disconnect, workers, job_registry)
+    log.info("Disconnected from Stratum pool at %s:%d (upstream session %d)" % (f.main_host + (session.index,)))
+    f.on_disconnect.addCallback(on_disconnect, session, job_registry)
     
-    stratum_listener.MiningSubscription.disconnect_all()
+    stratum_listener.MiningSubscription.disconnect_all(session)
     
     # Reject miners because we don't give a *job :-)
-    workers.clear_authorizations() 
+    session.workers.clear_authorizations() 
     
     return f              
 
@@ -138,11 +173,43 @@ def test_launcher(result, job_registry):
                 
             log.info("%d getworks generated in %.03f sec, %d gw/s" % \
                      (n, time.time() - start, n / (time.time()-start)))
-            
+
+        if jobs.calculateMidstate:
+            # Midstate of the whole header versus the rounds after per-job prefix state
+            job = job_registry.last_job
+            header_bin = binascii.unhexlify(job_registry.getwork(no_midstate=True)['data'])[:64]
+            for (name, midstate) in (('whole header', jobs.calculateMidstate), ('per-job prefix', job.get_midstate)):
+                start = time.time()
+                for x in range(n):
+                    midstate(header_bin)
+                log.info("%d midstates (%s) computed in %.03f sec, %d/s" % \
+                         (n, name, time.time() - start, n / (time.time()-start)))
+
+        if not target.test():
+            log.error("Share target self-test FAILED!")
+        else:
+            log.info("Share target self-test passed")
+
         log.info("Test done")
     reactor.callLater(1, run_test)
     return result
 
+def log_admission_stats(factory, last=None):
+    '''Periodically report connections refused or shed by admission control'''
+    stats = factory.get_stats()
+    if stats['refused'] or stats['shed'] or stats['backlog']:
+        if last == None or stats != last:
+            log.warning("Stratum connections: %(connections)d connected, %(paused)d paused, %(refused)d refused, "
+                        "%(backlog)d requests waiting, %(shed)d requests shed" % stats)
+    reactor.callLater(60, log_admission_stats, factory, stats)
+
+def log_upstream_stats(pool):
+    '''Periodically report load and submit latency of every upstream session'''
+    for stats in pool.get_stats():
+        log.info("Upstream session %(session)d: %(miners)d/%(capacity)d miners, %(pending_submits)d submits pending, "
+                 "%(latency).1fms latency, %(rejected)d/%(submits)d rejected" % stats)
+    reactor.callLater(60, log_upstream_stats, pool)
+
 def print_deprecation_warning():
     '''Once new version is detected, this method prints deprecation warning every 30 seconds.'''
 
@@ -155,16 +222,120 @@ def test_update():
  
     GIT_URL='https://raw.github.com/slush0/stratum-mining-proxy/master/mining_libs/version.py'
 
-    import urllib2
-    log.warning("Checking for updates...")
-    try:
-        if version.VERSION not in urllib2.urlopen(GIT_URL).read():
+    from twisted.python.reflect import requireModule
+    if requireModule('OpenSSL') == None:
+        # HTTPS in Twisted needs pyOpenSSL
+        log.warning("Update check unavailable: pyOpenSSL is not installed")
+        return
+    
+    def on_response(content):
+        if version.VERSION not in content:
             print_deprecation_warning()
             return # New version already detected, stop periodic checks
-    except:
-        log.warning("Check failed.")
+        reactor.callLater(3600*24, test_update)
+        
+    def on_failure(failure):
+        if failure.check(NotImplementedError):
+            # Twisted reports missing TLS support this way
+            log.warning("Update check unavailable: %s" % failure.getErrorMessage())
+            return
+        log.warning("Check failed: %s" % failure.getErrorMessage())
+        reactor.callLater(3600*24, test_update)
+        
+    from twisted.web.client import Agent, readBody
+    log.warning("Checking for updates...")
+    d = Agent(reactor, connectTimeout=UPDATE_CHECK_TIMEOUT).request('GET', GIT_URL)
+    d.addCallback(readBody)
+    d.addTimeout(UPDATE_CHECK_TIMEOUT, reactor)
+    d.addCallbacks(on_response, on_failure)
+
+def setup_instrumentation(args, pool, stratum_factory):
+    '''Reactor heartbeat is cheap, so it runs by default. Timing of I/O
+    handlers, stack sampling and profiling are turned on by cmdline options.'''
+    detector = None
+    if args.stall_threshold > 0:
+        detector = reactor_monitor.StallDetector(args.stall_threshold / 1000.0, time_io=args.stall_io)
+        detector.start()
+        
+        if args.stall_stacks:
+            reactor_monitor.StallSampler(detector).start()
+        
+    profiler = reactor_monitor.Profiler(args.profile_file)
+    if hasattr(signal, 'SIGUSR1'):
+        profiler.start_on_signal(signal.SIGUSR1, args.profile_seconds)
+        
+    if args.admin_port > 0:
+        from twisted.web.server import Site
+        from mining_libs import admin_listener
+        root = admin_listener.Root(detector, profiler, args.profile_seconds, pool, stratum_factory)
+        reactor.listenTCP(args.admin_port, Site(root), interface='127.0.0.1')
+        log.warning("Admin interface listening on http://127.0.0.1:%d" % args.admin_port)
+
+def start_listeners(args, job_registry, workers):
+    '''Bind listening ports for miners. Ports don't accept connections yet,
+    miners connecting before the first job wait in kernel's backlog.'''
+    ports = []
+    stratum_factory = None
+    
+    # Setup getwork listener
+    if args.getwork_port > 0:
+        from twisted.web.server import Site
+        from mining_libs import getwork_listener
         
-    reactor.callLater(3600*24, test_update)
+        conn = reactor.listenTCP(args.getwork_port, Site(getwork_listener.Root(job_registry, workers,
+                                                    stratum_host=args.stratum_host, stratum_port=args.stratum_port,
+                                                    custom_lp=args.custom_lp, custom_stratum=args.custom_stratum,
+                                                    custom_user=args.custom_user, custom_password=args.custom_password,
+                                                    roll_ntime=args.roll_ntime)),
+                                                    interface=args.getwork_host, backlog=LISTEN_BACKLOG)
+
+        try:
+            conn.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # Enable keepalive packets
+            conn.socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, 60) # Seconds before sending keepalive probes
+            conn.socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, 1) # Interval in seconds between keepalive probes
+            conn.socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, 5) # Failed keepalive probles before declaring other end dead
+        except:
+            pass # Some socket features are not available on all platforms (you can guess which one)
+        ports.append(conn)
+    
+    # Setup stratum listener
+    if args.stratum_port > 0:
+        stratum_listener.StratumProxyService._set_custom_user(args.custom_user, args.custom_password)
+        stratum_listener.StratumProxyService._set_share_validation(not (args.no_share_validation or args.scrypt_target))
+        
+        stratum_factory = downstream.AdmissionControlFactory(max_connections=args.max_connections,
+                                max_per_ip=args.max_connections_per_ip, connection_rate=args.connection_rate,
+                                request_rate=args.request_rate, write_buffer=args.write_buffer_size * 1024, on_resume=stratum_listener.MiningSubscription.resend_last_job,
+                                coalesce_writes=args.write_coalescing, debug=False, event_handler=ServiceEventHandler)
+        stratum_listener.StratumProxyService._set_admission(stratum_factory.limiter)
+        stratum_factory.port = reactor.listenTCP(args.stratum_port, stratum_factory,
+                                                 interface=args.stratum_host, backlog=LISTEN_BACKLOG)
+        log_admission_stats(stratum_factory)
+        ports.append(stratum_factory.port)
+
+    for port in ports:
+        port.stopReading()
+    
+    log.warning("-----------------------------------------------------------------------")
+    if args.getwork_host == '0.0.0.0' and args.stratum_host == '0.0.0.0':
+        log.warning("PROXY IS LISTENING ON ALL IPs ON PORT %d (stratum) AND %d (getwork)" % (args.stratum_port, args.getwork_port))
+    else:
+        log.warning("LISTENING FOR MINERS ON http://%s:%d (getwork) and stratum+tcp://%s:%d (stratum)" % \
+                 (args.getwork_host, args.getwork_port, args.stratum_host, args.stratum_port))
+    log.warning("-----------------------------------------------------------------------")
+    log.info("Listening %.3fs after start" % (time.time() - START_TIME))
+    return (ports, stratum_factory)
+
+def on_first_job(job, ports):
+    '''Start serving miners once there's something to mine on'''
+    log.info("First job received %.3fs after start" % (time.time() - START_TIME))
+    for port in ports:
+        port.startReading()
+        
+    # Setup periodic checks for a new version
+    if not args.no_update_check:
+        test_update()
+    return job
 
 @defer.inlineCallbacks
 def main(args):
@@ -173,13 +344,42 @@ def main(args):
         fp.write(str(os.getpid()))
         fp.close()
     
-    if args.port != 3333:
+    log.warning("Stratum proxy version: %s" % version.VERSION)
+    
+    log.info("JSON codec: %s" % jsoncodec.NAME)
+    
+    pool = upstream.UpstreamPool()
+    
+    if args.record:
+        recorder.start(args.record)
+        reactor.addSystemEventTrigger('before', 'shutdown', recorder.stop)
+    
+    # Upstream factory is attached once upstream host/port is known
+    job_registry = jobs.JobRegistry(None, cmd=args.blocknotify_cmd, scrypt_target=args.scrypt_target,
+                   no_midstate=args.no_midstate, real_target=args.real_target, use_old_target=args.old_target,
+                   roll_ntime=args.roll_ntime)
+    client_service.ClientMiningService.job_registry = job_registry
+    workers = worker_registry.WorkerRegistry(None)
+    stratum_listener.StratumProxyService._set_upstream(pool)
+    
+    if args.port != 3333 and not args.tor:
         '''User most likely provided host/port
         for getwork interface. Let's try to detect
         Stratum host/port of given getwork pool.'''
-        
+        detection = utils.detect_stratum(args.host, args.port)
+    else:
+        detection = None
+    
+    # Bind listeners before talking to the pool, so restarted proxy
+    # doesn't refuse its miners. Autodetection runs meanwhile.
+    (ports, stratum_factory) = start_listeners(args, job_registry, workers)
+    job_registry.wait_for_job().addCallback(on_first_job, ports)
+    setup_instrumentation(args, pool, stratum_factory)
+    
+    if detection != None:
+        # Upstream connection needs the detected host/port
         try:
-            new_host = (yield utils.detect_stratum(args.host, args.port))
+            new_host = (yield detection)
         except:
             log.exception("Stratum host/port autodetection failed")
             new_host = None
@@ -188,10 +388,6 @@ def main(args):
             args.host = new_host[0]
             args.port = new_host[1]
 
-    log.warning("Stratum proxy version: %s" % version.VERSION)
-    # Setup periodic checks for a new version
-    test_update()
-    
     if args.tor:
         log.warning("Configuring Tor connection")
         args.proxy = '127.0.0.1:9050'
@@ -210,62 +406,39 @@ def main(args):
 
     log.warning("Trying to connect to Stratum pool at %s:%d" % (args.host, args.port))        
         
-    # Connect to Stratum pool
-    f = SocketTransportClientFactory(args.host, args.port,
-                debug=args.verbose, proxy=proxy,
-                event_handler=client_service.ClientMiningService)
-    
-    
-    job_registry = jobs.JobRegistry(f, cmd=args.blocknotify_cmd, scrypt_target=args.scrypt_target,
-                   no_midstate=args.no_midstate, real_target=args.real_target, use_old_target=args.old_target)
-    client_service.ClientMiningService.job_registry = job_registry
-    client_service.ClientMiningService.reset_timeout()
+    # Connect to Stratum pool, the first session serves getwork miners too
+    for i in range(max(args.upstream_sessions, 1)):
+        f = SocketTransportClientFactory(args.host, args.port,
+                    debug=args.verbose, proxy=proxy,
+                    event_handler=client_service.ClientMiningService)
+        
+        if i == 0:
+            session = pool.add(f, workers, job_registry.job_store)
+            job_registry.f = f
+            workers.f = f
+        else:
+            session = pool.add(f, worker_registry.WorkerRegistry(f), jobs.JobStore())
+        session.reset_timeout()
+        
+        # Tail size is negotiated in on_connect already
+        f.on_connect.addCallback(on_connect, session, job_registry)
+        f.on_disconnect.addCallback(on_disconnect, session, job_registry)
+        
+        # Cleanup properly on shutdown
+        reactor.addSystemEventTrigger('before', 'shutdown', on_shutdown, f)
     
-    workers = worker_registry.WorkerRegistry(f)
-    f.on_connect.addCallback(on_connect, workers, job_registry)
-    f.on_disconnect.addCallback(on_disconnect, workers, job_registry)
+    if len(pool.sessions) > 1:
+        log.warning("Using %d upstream sessions" % len(pool.sessions))
+        reactor.callLater(60, log_upstream_stats, pool)
 
     if args.test:
-        f.on_connect.addCallback(test_launcher, job_registry)
-    
-    # Cleanup properly on shutdown
-    reactor.addSystemEventTrigger('before', 'shutdown', on_shutdown, f)
-
-    # Block until proxy connect to the pool
-    yield f.on_connect
-    
-    # Setup getwork listener
-    if args.getwork_port > 0:
-        conn = reactor.listenTCP(args.getwork_port, Site(getwork_listener.Root(job_registry, workers,
-                                                    stratum_host=args.stratum_host, stratum_port=args.stratum_port,
-                                                    custom_lp=args.custom_lp, custom_stratum=args.custom_stratum,
-                                                    custom_user=args.custom_user, custom_password=args.custom_password)),
-                                                    interface=args.getwork_host)
-
-        try:
-            conn.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # Enable keepalive packets
-            conn.socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, 60) # Seconds before sending keepalive probes
-            conn.socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, 1) # Interval in seconds between keepalive probes
-            conn.socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, 5) # Failed keepalive probles before declaring other end dead
-        except:
-            pass # Some socket features are not available on all platforms (you can guess which one)
-    
-    # Setup stratum listener
-    if args.stratum_port > 0:
-        stratum_listener.StratumProxyService._set_upstream_factory(f)
-        stratum_listener.StratumProxyService._set_custom_user(args.custom_user, args.custom_password)
-        reactor.listenTCP(args.stratum_port, SocketTransportFactory(debug=False, event_handler=ServiceEventHandler), interface=args.stratum_host)
+        job_registry.wait_for_job().addCallback(test_launcher, job_registry)
 
     # Setup multicast responder
-    reactor.listenMulticast(3333, multicast_responder.MulticastResponder((args.host, args.port), args.stratum_port, args.getwork_port), listenMultiple=True)
-    
-    log.warning("-----------------------------------------------------------------------")
-    if args.getwork_host == '0.0.0.0' and args.stratum_host == '0.0.0.0':
-        log.warning("PROXY IS LISTENING ON ALL IPs ON PORT %d (stratum) AND %d (getwork)" % (args.stratum_port, args.getwork_port))
-    else:
-        log.warning("LISTENING FOR MINERS ON http://%s:%d (getwork) and stratum+tcp://%s:%d (stratum)" % \
-                 (args.getwork_host, args.getwork_port, args.stratum_host, args.stratum_port))
-    log.warning("-----------------------------------------------------------------------")
+    from mining_libs import multicast_responder
+    get_load = stratum_factory.get_load if stratum_factory != None else None
+    reactor.listenMulticast(multicast_responder.MULTICAST_PORT, multicast_responder.MulticastResponder((args.host, args.port),
+                    args.stratum_port, args.getwork_port, get_load=get_load), listenMultiple=True)
 
 if __name__ == '__main__':
     main(args)
@@ -23,14 +23,14 @@ args = {
         'midstate', 
         ['midstatec/midstatemodule.c'],
         include_dirs=['/usr/include/python2.7'],
-        extra_compile_args=['-march=native', '-Wall', '-funroll-all-loops', '-O3', '-fstrict-aliasing', '-Wall', '-std=c99',  '-fPIC', '-shared'],
+        extra_compile_args=['-Wall', '-funroll-all-loops', '-O3', '-fstrict-aliasing', '-Wall', '-std=c99',  '-fPIC', '-shared'],
         libraries=['python2.7'],
         extra_link_args=['-Wl,-O1', '-Wl,--as-needed']
         )
       ],
-    'py_modules': ['mining_libs.client_service', 'mining_libs.getwork_listener',
-                   'mining_libs.jobs', 'mining_libs.midstate',
-                   'mining_libs.multicast_responder', 'mining_libs.stratum_listener',
+    'py_modules': ['mining_libs.admin_listener', 'mining_libs.blocknotify', 'mining_libs.client_service', 'mining_libs.discovery', 'mining_libs.downstream', 'mining_libs.fake_pool', 'mining_libs.getwork_listener',
+                   'mining_libs.jobs', 'mining_libs.jsoncodec', 'mining_libs.midstate', 'mining_libs.midstate_batch', 'mining_libs.midstate_openssl',
+                   'mining_libs.multicast_responder', 'mining_libs.reactor_monitor', 'mining_libs.recorder', 'mining_libs.stratum_listener', 'mining_libs.target', 'mining_libs.upstream',
                    'mining_libs.utils', 'mining_libs.version', 'mining_libs.worker_registry',
                    'midstatec.midstatec'],
     'install_requires': ['setuptools>=0.6c11', 'twisted>=12.2.0', 'stratum>=0.2.15', 'argparse'],
@@ -45,6 +45,8 @@ if py2exe != None:
                        'bundle_files': 1,
                        'compressed': True,
                        'dll_excludes': ['mswsock.dll', 'powrprof.dll'],
+                       # Loaded lazily, only when C extension isn't available
+                       'includes': ['mining_libs.midstate', 'mining_libs.midstate_openssl'],
                       },
                   },
         'console': ['mining_proxy.py'],